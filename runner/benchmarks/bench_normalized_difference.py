@@ -0,0 +1,76 @@
+# Micro-benchmark of the normalized difference kernel
+#
+# Compares the peak memory allocated and the run time of the former
+# (array1 - array2) / (array1 + array2) expression with the in-place
+# runner.functions.normalized_difference kernel, for float32 and uint16 inputs.
+#
+# Usage: python benchmarks/bench_normalized_difference.py [--size 4000]
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from runner.functions import normalized_difference
+
+
+def legacy(array1, array2):
+    array1 = np.asarray(array1, dtype=np.float32)
+    array2 = np.asarray(array2, dtype=np.float32)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (array1 - array2) / (array1 + array2)
+
+
+def measure(func, *args, repeat=5, **kwargs):
+    """Returns the peak traced allocation in bytes and the best run time in seconds"""
+    tracemalloc.start()
+    result = func(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+
+    return peak, min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=4000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    shape = (args.size, args.size)
+    band1 = rng.integers(7000, 30000, size=shape, dtype=np.uint16)
+    band2 = rng.integers(7000, 30000, size=shape, dtype=np.uint16)
+
+    output_bytes = band1.size * np.dtype(np.float32).itemsize
+    out = np.empty(shape, dtype=np.float32)
+
+    print(
+        f"{shape[0]}x{shape[1]} pixels, float32 output {output_bytes / 2**20:.1f} MiB"
+    )
+    print(f"{'inputs':<8} {'kernel':<28} {'peak MiB':>9} {'x output':>9} {'time s':>8}")
+
+    for dtype in (np.float32, np.uint16):
+        array1, array2 = band1.astype(dtype), band2.astype(dtype)
+
+        for name, func, kwargs in [
+            ("legacy expression", legacy, {}),
+            ("normalized_difference", normalized_difference, {}),
+            ("normalized_difference(out)", normalized_difference, {"out": out}),
+        ]:
+            peak, elapsed = measure(func, array1, array2, **kwargs)
+            print(
+                f"{np.dtype(dtype).name:<8} {name:<28} {peak / 2**20:>9.1f} "
+                f"{peak / output_bytes:>9.2f} {elapsed:>8.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
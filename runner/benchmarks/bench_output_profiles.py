@@ -0,0 +1,127 @@
+# Benchmark of the output profiles
+#
+# Compares the encode time and the output size of each runner.functions
+# output profile on a synthetic NDWI, an index with smooth water bodies, noise
+# and a nodata margin, in each of the index encodings, and on the water mask
+# thresholded from it in each of the mask encodings. The former outputs,
+# single-threaded LZW with 512x512 tiles since the COG driver ignores
+# blockxsize and blockysize, are the baseline. The ratio is the size of the
+# encoded array in memory over the size of the file.
+#
+# Usage: python benchmarks/bench_output_profiles.py [--size 4000] [--repeat 3]
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from rasterio.transform import from_origin
+
+from runner.functions import (
+    encode_index,
+    index_profile,
+    mask_profile,
+    open_output,
+)
+from runner.profiles import INDEX_ENCODINGS, MASK_ENCODINGS, OUTPUT_PROFILES
+
+
+def synthetic_ndwi(size, seed=0):
+    """Returns a float32 NDWI with blobs of water, noise and a nodata margin"""
+    rng = np.random.default_rng(seed)
+
+    y, x = np.mgrid[0:size, 0:size] / size
+    ndwi = np.zeros((size, size), dtype=np.float32)
+    for cx, cy, radius in rng.uniform(0, 1, size=(20, 3)):
+        ndwi += np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / (radius * 0.02))
+
+    ndwi = np.tanh(ndwi) * 1.2 - 0.6
+    ndwi += rng.normal(scale=0.05, size=ndwi.shape)
+    ndwi = np.clip(ndwi, -1, 1).astype(np.float32)
+
+    # the scene does not cover the AOI to its edge
+    ndwi[:, : size // 5] = np.nan
+
+    return ndwi
+
+
+def encode(path, data, profile, streaming, repeat):
+    """Returns the best encode time in seconds and the size in bytes of data at path"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with open_output(path, streaming=streaming, **profile) as dst:
+            if streaming:
+                for _, window in dst.block_windows(1):
+                    dst.write(data[window.toslices()], 1, window=window)
+            else:
+                dst.write(data, 1)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings), os.path.getsize(path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=4000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    ndwi = synthetic_ndwi(args.size)
+    mask = np.where(np.isnan(ndwi), 0, ndwi > 0).astype(np.uint8)
+
+    base = {
+        "count": 1,
+        "width": args.size,
+        "height": args.size,
+        "crs": "EPSG:32611",
+        "transform": from_origin(300000, 4300000, 30, 30),
+    }
+
+    former = {"driver": "COG", "compress": "lzw", "blockxsize": 256, "blockysize": 256}
+
+    float32 = {"dtype": "float32", "nodata": np.nan}
+    uint8 = {"dtype": "uint8", "nodata": 0}
+
+    cases = [("ndwi", "former", "float32", ndwi, {**former, **float32})]
+    cases += [
+        (
+            "ndwi",
+            name,
+            encoding,
+            encode_index(ndwi.copy(), encoding),
+            index_profile(name, encoding),
+        )
+        for name in OUTPUT_PROFILES
+        for encoding in INDEX_ENCODINGS
+    ]
+    cases += [("mask", "former", "uint8", mask, {**former, **uint8})]
+    cases += [
+        ("mask", name, encoding, mask, {**mask_profile(name, encoding), **uint8})
+        for name in OUTPUT_PROFILES
+        for encoding in MASK_ENCODINGS
+    ]
+
+    print(f"{args.size}x{args.size} pixels, best of {args.repeat}")
+    print(
+        f"{'raster':<6} {'profile':<8} {'encoding':<8} {'write':<6} {'time s':>8} "
+        f"{'MiB':>8} {'ratio':>7}"
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for raster, name, encoding, data, options in cases:
+            profile = {**base, **options}
+
+            for streaming in (False, True):
+                path = os.path.join(tmp_dir, f"{raster}-{name}-{encoding}.tif")
+                elapsed, size = encode(path, data, profile, streaming, args.repeat)
+                print(
+                    f"{raster:<6} {name:<8} {encoding:<8} "
+                    f"{'blocks' if streaming else 'array':<6} {elapsed:>8.3f} "
+                    f"{size / 2**20:>8.2f} {data.nbytes / size:>7.1f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# Start-up benchmark of the runner command line
+#
+# Measures the wall time of fresh interpreters running `runner --help` and the
+# early-exit paths of pattern-8 (without --produce-output) and pattern-9
+# (--vegetation-index none), against the same commands with every command
+# module imported up front as the eager group used to do.
+#
+# Usage: python benchmarks/bench_startup.py [--repeat 5]
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+from runner.app import commands
+
+LAZY = "from runner.app import app_group; app_group()"
+
+EAGER = (
+    "import importlib; from runner.app import app_group, commands; "
+    "[importlib.import_module(module) for module, _, _ in commands.values()]; "
+    "app_group()"
+)
+
+CASES = [
+    ("runner --help", ["--help"]),
+    (
+        "pattern-8 (no output)",
+        ["pattern-8", "--input-item", "item", "--aoi", "0,0,1,1"]
+        + ["--epsg", "EPSG:4326", "--band", "green", "--band", "nir08"],
+    ),
+    (
+        "pattern-9 (none)",
+        ["pattern-9", "--input-item", "item", "--aoi", "0,0,1,1"]
+        + ["--epsg", "EPSG:4326", "--vegetation-index", "none"],
+    ),
+]
+
+
+def measure(code, args, repeat=5):
+    """Returns the median wall time in seconds of a fresh interpreter running code"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", code, *args],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{len(commands)} commands, median of {args.repeat} runs")
+    print(f"{'command':<24} {'eager s':>8} {'lazy s':>8} {'speed-up':>9}")
+
+    for name, cli_args in CASES:
+        eager = measure(EAGER, cli_args, args.repeat)
+        lazy = measure(LAZY, cli_args, args.repeat)
+        print(f"{name:<24} {eager:>8.3f} {lazy:>8.3f} {eager / lazy:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
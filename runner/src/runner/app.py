@@ -1,41 +1,64 @@
+import importlib
 import click
-from runner.pattern_1 import pattern_1
-from runner.pattern_2 import pattern_2
-from runner.pattern_3 import pattern_3
-from runner.pattern_4 import pattern_4
-from runner.pattern_5 import pattern_5
-from runner.pattern_6 import pattern_6
-from runner.pattern_7 import pattern_7
-from runner.pattern_8 import pattern_8
-from runner.pattern_9 import pattern_9
-from runner.pattern_10 import pattern_10
-from runner.pattern_11 import pattern_11
-from runner.crop import crop_cli
-from runner.ndi import ndi_cli
-from runner.otsu import otsu_cli
-
-
-@click.group()
-def app_group():
-    pass
 
+# command name: (module, command attribute, short help)
+# the short help is listed by --help without importing the command module
+commands = {
+    "pattern-1": ("runner.pattern_1", "pattern_1", "Water bodies detection"),
+    "pattern-2": ("runner.pattern_2", "pattern_2", "Water bodies detection"),
+    "pattern-3": ("runner.pattern_3", "pattern_3", "Water bodies detection"),
+    "pattern-4": ("runner.pattern_4", "pattern_4", "NDVI and NDWI vegetation indexes"),
+    "pattern-5": ("runner.pattern_5", "pattern_5", "Vegetation index computation"),
+    "pattern-6": ("runner.pattern_6", "pattern_6", "Vegetation index mean"),
+    "pattern-7": ("runner.pattern_7", "pattern_7", "Water bodies detection"),
+    "pattern-8": ("runner.pattern_8", "pattern_8", "Water bodies detection"),
+    "pattern-9": ("runner.pattern_9", "pattern_9", "Vegetation index computation"),
+    "pattern-10": ("runner.pattern_10", "pattern_10", "Vegetation index computation"),
+    "pattern-11": ("runner.pattern_11", "pattern_11", "Water bodies detection"),
+    "crop-cli": ("runner.crop", "crop_cli", "Crop"),
+    "ndi-cli": ("runner.ndi", "ndi_cli", "Nomalized Difference Index CLI"),
+    "otsu-cli": ("runner.otsu", "otsu_cli", "Water bodies detection"),
+}
+
+
+class LazyGroup(click.Group):
+    """A click Group importing the module of a command only when the command is invoked"""
+
+    def __init__(self, *args, lazy_commands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in self.lazy_commands and cmd_name not in self.commands:
+            module, attribute, _ = self.lazy_commands[cmd_name]
+            command = getattr(importlib.import_module(module), attribute)
+            self.add_command(command, cmd_name)
+
+        return super().get_command(ctx, cmd_name)
 
-patterns = [
-    pattern_1,
-    pattern_2,
-    pattern_3,
-    pattern_4,
-    pattern_5,
-    pattern_6,
-    pattern_7,
-    pattern_8,
-    pattern_9,
-    pattern_10,
-    pattern_11,
-    crop_cli,
-    ndi_cli,
-    otsu_cli,
-]
-
-for pattern in patterns:
-    app_group.add_command(pattern)
+    def format_commands(self, ctx, formatter):
+        names = self.list_commands(ctx)
+
+        if not names:
+            return
+
+        limit = formatter.width - 6 - max(len(name) for name in names)
+
+        rows = []
+        for name in names:
+            if name in self.commands:
+                short_help = self.commands[name].get_short_help_str(limit)
+            else:
+                short_help = self.lazy_commands[name][2]
+            rows.append((name, short_help))
+
+        with formatter.section("Commands"):
+            formatter.write_dl(rows)
+
+
+@click.group(cls=LazyGroup, lazy_commands=commands)
+def app_group():
+    pass
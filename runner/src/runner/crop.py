@@ -1,12 +1,23 @@
 # crop CLI
 import os
 import click
-from runner.functions import crop, get_item, get_asset, aoi2box
+from runner.functions import (
+    crop,
+    get_item,
+    get_asset,
+    get_scale_offset,
+    aoi2box,
+    open_output,
+    output_profile,
+    BandStatistics,
+    create_output_item,
+)
+from runner.profiles import (
+    OUTPUT_PROFILES,
+    DEFAULT_OUTPUT_PROFILE,
+)
 import pystac
-import rasterio
 from loguru import logger
-import shutil
-import rio_stac
 
 
 @click.command(
@@ -43,7 +54,15 @@ import rio_stac
     help="STAC collection",
     required=False,
 )
-def crop_cli(item_url, aoi, band, epsg, collection_url):
+@click.option(
+    "--output-profile",
+    "profile",
+    help="Codec and overviews of the output rasters",
+    type=click.Choice(list(OUTPUT_PROFILES)),
+    default=DEFAULT_OUTPUT_PROFILE,
+    show_default=True,
+)
+def crop_cli(item_url, aoi, band, epsg, collection_url, profile):
 
     collection: pystac.Collection = (
         pystac.read_file(collection_url) if collection_url else None
@@ -63,31 +82,36 @@ def crop_cli(item_url, aoi, band, epsg, collection_url):
 
     bbox = aoi2box(aoi)
 
-    out_image, out_meta = crop(asset, bbox, epsg)
+    out_image, out_meta = crop(asset, bbox, epsg, native_dtype=True)
+    scale, offset = get_scale_offset(asset)
+
+    out_meta.update(output_profile(profile))
 
-    cropped = f"{band}_cropped.tif"
+    output_item_id = f"cropped-{band}-{item.id}".lower()
+
+    cropped = os.path.join(output_item_id, f"{band}_cropped.tif")
+
+    statistics = BandStatistics(nodata=out_meta["nodata"])
+    statistics.update(out_image[0])
 
-    with rasterio.open(cropped, "w", **out_meta) as dst_dataset:
+    with open_output(cropped, **out_meta) as dst_dataset:
         logger.info(f"Write {cropped}")
         dst_dataset.write(out_image[0], indexes=1)
+        # keep the native data type, the reflectance scaling is applied when computing indices
+        dst_dataset.scales = (scale,)
+        dst_dataset.offsets = (offset,)
 
     logger.info("Creating a STAC Catalog")
     cat = pystac.Catalog(id="catalog", description=f"Cropped {item.id} {band}")
 
-    output_item_id = f"cropped-{band}-{item.id}".lower()
-
-    os.makedirs(output_item_id, exist_ok=True)
-    shutil.copy(cropped, output_item_id)
-
-    out_item: pystac.Item = rio_stac.stac.create_stac_item(
-        source=cropped,
-        input_datetime=item.datetime,
-        id=output_item_id,
-        asset_roles=["data", "visual"],
-        asset_href=os.path.basename(cropped),
-        asset_name="data",
-        with_proj=True,
-        with_raster=True,
+    out_item: pystac.Item = create_output_item(
+        output_item_id,
+        os.path.basename(cropped),
+        out_meta,
+        [statistics],
+        item.datetime,
+        scales=[scale],
+        offsets=[offset],
     )
 
     out_item.properties["renders"] = {
@@ -105,7 +129,6 @@ def crop_cli(item_url, aoi, band, epsg, collection_url):
         logger.info(f"Adding collection {collection.id} to the output item")
         out_item.collection_id = collection.id
 
-    os.remove(cropped)
     cat.add_items([out_item])
 
     cat.normalize_and_save(
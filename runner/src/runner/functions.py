@@ -1,19 +1,258 @@
 import os
+import ast
+import math
+import queue
 import click
+import contextlib
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 import pystac
+import pystac.extensions.eo
 import rasterio
-from skimage.filters import threshold_otsu
+import rasterio.shutil
 from rasterio.mask import mask
+from rasterio.features import bounds as feature_bounds
+from rasterio.transform import array_bounds
+from rasterio.warp import transform_geom
+from rasterio.windows import Window, from_bounds
 from pyproj import Transformer
 from shapely import box
 from loguru import logger
 import rasterio
 import pystac
 import shutil
-import rio_stac
 import numpy as np
+from runner.profiles import (
+    OUTPUT_PROFILES,
+    DEFAULT_OUTPUT_PROFILE,
+    MASK_ENCODINGS,
+    DEFAULT_MASK_ENCODING,
+    INDEX_ENCODINGS,
+    DEFAULT_INDEX_ENCODING,
+)
 
-np.seterr(divide="ignore", invalid="ignore")
+PROJECTION_EXTENSION = "https://stac-extensions.github.io/projection/v1.1.0/schema.json"
+RASTER_EXTENSION = "https://stac-extensions.github.io/raster/v1.1.0/schema.json"
+
+
+def map_items(func, item_urls, *args, workers=1):
+    """Returns [func(item_url, *args) for item_url in item_urls], fanned out to a process pool when workers > 1
+
+    The results are returned in the order of item_urls and must be picklable.
+    """
+    if workers > 1 and len(item_urls) > 1:
+        logger.info(f"Processing {len(item_urls)} items with {workers} workers")
+        # each worker compresses its outputs with its share of the CPUs
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=set_output_threads,
+            initargs=(max(1, (os.cpu_count() or 1) // workers),),
+        ) as executor:
+            return list(executor.map(func, item_urls, *[repeat(arg) for arg in args]))
+
+    return [func(item_url, *args) for item_url in item_urls]
+
+
+@contextlib.contextmanager
+def output_path(path):
+    """Yields a temporary path next to path, moved to path with os.replace once written
+
+    The output is written once, in the item directory of the catalog, instead
+    of being copied there, and a failed write leaves no partial file at path.
+    """
+    directory, name = os.path.split(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    stem, extension = os.path.splitext(name)
+    tmp_path = os.path.join(directory, f".{stem}.tmp{extension}")
+
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+OUTPUT_THREADS = "ALL_CPUS"
+"""The number of threads compressing an output, see set_output_threads"""
+
+
+def set_output_threads(threads):
+    """Sets the number of threads compressing the outputs of the process, e.g. of a map_items worker"""
+    global OUTPUT_THREADS
+    OUTPUT_THREADS = threads
+
+
+DATASET_KEYS = [
+    "dtype",
+    "count",
+    "width",
+    "height",
+    "crs",
+    "transform",
+    "nodata",
+]
+"""The profile keys describing the dataset rather than its encoding"""
+
+
+def output_profile(name=DEFAULT_OUTPUT_PROFILE, categorical=False, nbits=None):
+    """Returns the COG creation options of an output profile
+
+    Every profile writes 256x256 tiles compressed with all the CPUs, or with
+    the share of a map_items worker, skips the tiles with nodata only and,
+    unless disabled, adds the overviews down to the tile size. The overviews
+    average the pixels, or pick the nearest one for categorical outputs such
+    as the water masks. The YES predictor is the horizontal or the floating
+    point one depending on the data type.
+
+    Args:
+        name (str): the profile name, one of OUTPUT_PROFILES
+        categorical (bool): whether the output values are classes
+        nbits (int): the bits of the samples when smaller than their data type
+
+    Returns:
+        dict: the options to update the rasterio profile of the output with
+    """
+    profile = {
+        "driver": "COG",
+        "blocksize": 256,
+        "num_threads": OUTPUT_THREADS,
+        "sparse_ok": "TRUE",
+        "overviews": "AUTO",
+        "overview_resampling": "NEAREST" if categorical else "AVERAGE",
+        **OUTPUT_PROFILES[name],
+    }
+
+    if nbits:
+        profile["nbits"] = nbits
+
+        if profile["compress"].startswith("lerc"):
+            # LERC does not take the packed samples, zstd packs them as well
+            del profile["max_z_error"]
+            profile["compress"] = "zstd"
+
+    return profile
+
+
+def mask_profile(name=DEFAULT_OUTPUT_PROFILE, encoding=DEFAULT_MASK_ENCODING):
+    """Returns the COG creation options of a water mask
+
+    The masks are written as uint8 with the codec of the output profile, as
+    1 bit samples (nbits), or as uint8 with the horizontal predictor turning
+    the runs of water and land into runs of zeros for deflate (deflate).
+    The 1 bit samples are still read as uint8, with the same values.
+
+    Args:
+        name (str): the output profile name, one of OUTPUT_PROFILES
+        encoding (str): the mask encoding, one of MASK_ENCODINGS
+
+    Returns:
+        dict: the options to update the rasterio profile of the mask with
+    """
+    profile = output_profile(
+        name, categorical=True, nbits=MASK_ENCODINGS[encoding].get("nbits")
+    )
+    profile.update(MASK_ENCODINGS[encoding])
+
+    return profile
+
+
+def index_profile(name=DEFAULT_OUTPUT_PROFILE, encoding=DEFAULT_INDEX_ENCODING):
+    """Returns the COG creation options, data type and nodata of an index, see encode_index"""
+    spec = INDEX_ENCODINGS[encoding]
+
+    profile = output_profile(name, nbits=spec.get("nbits"))
+    profile.update({"dtype": spec["dtype"], "nodata": spec["nodata"]})
+
+    return profile
+
+
+def index_scale_offset(encoding=DEFAULT_INDEX_ENCODING):
+    """Returns the (scale, offset) of an index encoding"""
+    return INDEX_ENCODINGS[encoding]["scale"], INDEX_ENCODINGS[encoding]["offset"]
+
+
+def encode_index(index, encoding=DEFAULT_INDEX_ENCODING):
+    """Returns a float32 normalized difference index in the data type of an encoding
+
+    The integer encodings store round((index - offset) / scale), with the
+    index clipped to [-1, 1] and the NaN pixels set to nodata: int16 keeps 4
+    decimals and uint8 steps of 1/127. The float16 encoding is written as
+    16 bit floats (nbits), the index is rounded to the nearest of them here
+    since GDAL truncates. The index buffer is overwritten.
+
+    Args:
+        index (np.ndarray): the float32 index, NaN where invalid
+        encoding (str): the index encoding, one of INDEX_ENCODINGS
+
+    Returns:
+        np.ndarray: the encoded index
+    """
+    spec = INDEX_ENCODINGS[encoding]
+    dtype = np.dtype(spec["dtype"])
+
+    if encoding == "float16":
+        np.copyto(index, index.astype(np.float16))
+
+    if dtype.kind == "f":
+        return index
+
+    invalid = np.isnan(index)
+
+    np.clip(index, -1.0, 1.0, out=index)
+    np.subtract(index, spec["offset"], out=index)
+    np.divide(index, spec["scale"], out=index)
+    np.rint(index, out=index)
+    np.copyto(index, spec["nodata"], where=invalid)
+
+    return index.astype(dtype)
+
+
+@contextlib.contextmanager
+def open_output(path, streaming=False, **profile):
+    """Opens an output raster for writing, moved to path once closed, see output_path
+
+    The COG driver keeps the whole raster in memory until it is closed. With
+    streaming set, the blocks are written to a tiled GTiff scratch file
+    instead and copied to a COG once closed.
+    """
+    with output_path(path) as tmp_path:
+        if not streaming or profile.get("driver") != "COG":
+            with rasterio.open(tmp_path, "w", **profile) as dataset:
+                yield dataset
+            return
+
+        blocks_path = f"{tmp_path}.blocks.tif"
+        blocksize = profile.get("blocksize", 512)
+
+        try:
+            with rasterio.open(
+                blocks_path,
+                "w",
+                **{key: profile[key] for key in DATASET_KEYS if key in profile},
+                driver="GTiff",
+                tiled=True,
+                blockxsize=blocksize,
+                blockysize=blocksize,
+                sparse_ok="TRUE",
+            ) as dataset:
+                yield dataset
+
+            rasterio.shutil.copy(
+                blocks_path,
+                tmp_path,
+                **{
+                    key: value
+                    for key, value in profile.items()
+                    if key not in DATASET_KEYS
+                },
+            )
+        finally:
+            if os.path.exists(blocks_path):
+                os.remove(blocks_path)
 
 
 def get_item(item_url):
@@ -27,51 +266,1042 @@ def get_item(item_url):
     return item
 
 
-def crop(asset: pystac.Asset, bbox, epsg):
-    """_summary_
+@lru_cache(maxsize=32)
+def get_transformer(src_crs, dst_crs):
+    """Returns a cached pyproj Transformer between two CRSs"""
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+@lru_cache(maxsize=256)
+def transform_bbox(bbox, src_crs, dst_crs, densify_pts=21):
+    """Returns the bounds of a bounding box reprojected with densified edges
+
+    The bbox (minx, miny, maxx, maxy) tuple and the CRSs are used as cache key
+    so the bands of an item sharing the same CRS are reprojected only once.
+    """
+    transformer = get_transformer(str(src_crs), str(dst_crs))
+    return transformer.transform_bounds(*bbox, densify_pts=densify_pts)
+
+
+def aoi_window(src, bounds):
+    """Returns the window of the pixels of a dataset whose centers fall within bounds"""
+    window = from_bounds(*bounds, transform=src.transform)
+
+    col_start = max(math.ceil(window.col_off - 0.5), 0)
+    row_start = max(math.ceil(window.row_off - 0.5), 0)
+    col_stop = min(math.floor(window.col_off + window.width + 0.5), src.width)
+    row_stop = min(math.floor(window.row_off + window.height + 0.5), src.height)
+
+    if col_stop <= col_start or row_stop <= row_start:
+        raise ValueError("Input shapes do not overlap raster.")
+
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def block_boundaries(size, *block_sizes):
+    """Returns the sorted offsets where a block of any of the block sizes starts, plus size"""
+    return sorted(
+        {0, size}
+        | {offset for block in block_sizes for offset in range(block, size, block)}
+    )
+
+
+def matching_windows(src1, src2, bidx=1):
+    """Yields the windows covering two aligned datasets block by block
+
+    When the block layouts differ, the windows are cut on the union of the block
+    boundaries so that each window falls within a single block of each dataset.
+    """
+    if (src1.width, src1.height, src1.transform) != (
+        src2.width,
+        src2.height,
+        src2.transform,
+    ):
+        raise ValueError(f"{src1.name} and {src2.name} are not on the same grid")
+
+    block_y1, block_x1 = src1.block_shapes[bidx - 1]
+    block_y2, block_x2 = src2.block_shapes[bidx - 1]
+
+    cols = block_boundaries(src1.width, block_x1, block_x2)
+    rows = block_boundaries(src1.height, block_y1, block_y2)
+
+    for row_start, row_stop in zip(rows[:-1], rows[1:]):
+        for col_start, col_stop in zip(cols[:-1], cols[1:]):
+            yield Window(
+                col_start, row_start, col_stop - col_start, row_stop - row_start
+            )
+
+
+def crop(asset: pystac.Asset, bbox, epsg, native_dtype=False):
+    """Crops an asset to a bounding box expressed in the given EPSG code
+
+    The pixels are read with a windowed read straight into the output buffer.
+    The bounding box geometry is only rasterized as a mask when the source
+    grid is rotated, i.e. when the box is not an axis-aligned rectangle in
+    the pixel space.
 
     Args:
-        asset (_type_): _description_
-        bbox (_type_): _description_
-        epsg (_type_): _description_
+        asset (pystac.Asset): the asset to crop
+        bbox (list): the bounding box as [minx, miny, maxx, maxy]
+        epsg (str): the CRS of the bounding box
+        native_dtype (bool): keep the asset data type instead of float32, see get_scale_offset
 
     Returns:
-        _type_: _description_
+        tuple: the cropped (bands, height, width) array and its metadata
     """
     with rasterio.open(asset.get_absolute_href()) as src:
-        transformer = Transformer.from_crs(epsg, src.crs, always_xy=True)
+        minx, miny, maxx, maxy = transform_bbox(tuple(bbox), epsg, src.crs)
+
+        logger.info(f"Crop {asset.get_absolute_href()}")
 
-        minx, miny = transformer.transform(bbox[0], bbox[1])
-        maxx, maxy = transformer.transform(bbox[2], bbox[3])
+        out_meta = src.meta.copy()
 
-        transformed_bbox = box(minx, miny, maxx, maxy)
+        if not src.transform.is_rectilinear:
+            transformed_bbox = box(minx, miny, maxx, maxy)
 
-        logger.info(f"Crop {asset.get_absolute_href()}")
+            out_image, out_transform = rasterio.mask.mask(
+                src, [transformed_bbox], crop=True
+            )
+            out_meta.update(
+                {
+                    "height": out_image.shape[1],
+                    "width": out_image.shape[2],
+                    "transform": out_transform,
+                }
+            )
+
+            if native_dtype:
+                return out_image, out_meta
 
-        out_image, out_transform = rasterio.mask.mask(
-            src, [transformed_bbox], crop=True
+            return out_image.astype(np.float32), out_meta
+
+        window = aoi_window(src, (minx, miny, maxx, maxy))
+
+        out_image = np.empty(
+            (src.count, window.height, window.width),
+            dtype=src.dtypes[0] if native_dtype else np.float32,
         )
-        out_meta = src.meta.copy()
+        src.read(window=window, out=out_image)
 
         out_meta.update(
             {
-                "height": out_image.shape[1],
-                "width": out_image.shape[2],
-                "transform": out_transform,
+                "height": window.height,
+                "width": window.width,
+                "transform": src.window_transform(window),
             }
         )
 
-        return out_image.astype(np.float32), out_meta
+        return out_image, out_meta
+
+
+def crop_bands(
+    item: pystac.Item, bands, bbox, epsg, max_workers=None, native_dtype=False
+):
+    """Crops the assets of an item defined with their common band names
+
+    The window is computed once from the first asset and the assets are read
+    concurrently, GDAL releasing the GIL during the reads. The assets must
+    share the same grid, as the Landsat bands of the same resolution do.
+
+    Args:
+        item (pystac.Item): the STAC Item
+        bands (list): the common band names
+        bbox (list): the bounding box as [minx, miny, maxx, maxy]
+        epsg (str): the CRS of the bounding box
+        max_workers (int): the number of reading threads, defaults to one per band
+        native_dtype (bool): keep the assets data type instead of float32, see get_scale_offsets
+
+    Returns:
+        tuple: the stacked (bands, height, width) array and the metadata shared
+        by the cropped bands
+    """
+    assets = []
+    for band in bands:
+        asset = get_asset(item, band)
+
+        if not asset:
+            msg = f"Common band name {band} not found in the assets"
+            logger.error(msg)
+            raise ValueError(msg)
+
+        logger.info(f"Read asset {band} from {asset.get_absolute_href()}")
+        assets.append(asset)
+
+    with rasterio.open(assets[0].get_absolute_href()) as src:
+        if not src.transform.is_rectilinear:
+            cropped = [crop(asset, bbox, epsg, native_dtype) for asset in assets]
+            return np.stack([c[0][0] for c in cropped]), cropped[0][1]
+
+        bounds = transform_bbox(tuple(bbox), epsg, src.crs)
+        window = aoi_window(src, bounds)
+        grid = (src.crs, src.transform, src.width, src.height)
+        dtype = src.dtypes[0] if native_dtype else np.float32
+
+        out_meta = src.meta.copy()
+        out_meta.update(
+            {
+                "height": window.height,
+                "width": window.width,
+                "transform": src.window_transform(window),
+            }
+        )
+
+    out_image = np.empty((len(assets), window.height, window.width), dtype=dtype)
+
+    def read_band(index):
+        href = assets[index].get_absolute_href()
+        with rasterio.open(href) as src:
+            if (src.crs, src.transform, src.width, src.height) != grid:
+                raise ValueError(
+                    f"{href} is not on the grid of {assets[0].get_absolute_href()}"
+                )
+            logger.info(f"Crop {href}")
+            src.read(1, window=window, out=out_image[index])
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(assets)) as executor:
+        list(executor.map(read_band, range(len(assets))))
+
+    return out_image, out_meta
+
+
+def get_scale_offset(asset: pystac.Asset):
+    """Returns the (scale, offset) of the first raster:bands entry of an asset, (1.0, 0.0) if not set"""
+    raster_bands = asset.extra_fields.get("raster:bands") or [{}]
+
+    return (
+        float(raster_bands[0].get("scale", 1.0)),
+        float(raster_bands[0].get("offset", 0.0)),
+    )
+
+
+def get_scale_offsets(item: pystac.Item, bands):
+    """Returns the (scale, offset) of the assets of an item defined with their common band names"""
+    return [get_scale_offset(get_asset(item, band)) for band in bands]
+
+
+def finite_range(data):
+    """Returns the (min, max) range of the finite values of a numpy array"""
+    low, high = np.nanmin(data), np.nanmax(data)
+
+    if not (np.isfinite(low) and np.isfinite(high)):
+        finite = data[np.isfinite(data)]
+        low, high = finite.min(), finite.max()
+
+    return float(low), float(high)
+
+
+def otsu_histogram(blocks, value_range=(-1.0, 1.0), bins=256):
+    """Accumulates the fixed-bin histogram of the values of an array or of an iterable of blocks
+
+    Non-finite values and values outside value_range are not counted.
+
+    Returns:
+        tuple: the bin counts and the bin centers
+    """
+    if isinstance(blocks, np.ndarray):
+        blocks = [blocks]
+
+    counts = np.zeros(bins, dtype=np.int64)
+
+    for block in blocks:
+        counts += np.histogram(block, bins=bins, range=value_range)[0]
+
+    edges = np.linspace(value_range[0], value_range[1], bins + 1)
+
+    return counts, (edges[:-1] + edges[1:]) / 2
+
+
+def otsu_threshold(blocks, value_range=(-1.0, 1.0), bins=256):
+    """Returns the Otsu threshold of an array or of an iterable of blocks
+
+    The blocks are consumed one at a time into a fixed-bin histogram so the
+    memory footprint does not depend on the raster size.
+
+    Args:
+        blocks (np.ndarray or iterable): the array or the blocks, e.g. read from src.block_windows()
+        value_range (tuple): the (min, max) range of the histogram
+        bins (int): the number of histogram bins
+
+    Returns:
+        float: the Otsu threshold
+    """
+    if value_range[0] == value_range[1]:
+        return float(value_range[0])
+
+    counts, centers = otsu_histogram(blocks, value_range=value_range, bins=bins)
+
+    if not counts.any():
+        raise ValueError("No finite values within the histogram range")
+
+    # skimage is only needed by the commands thresholding an index
+    from skimage.filters import threshold_otsu
+
+    return float(threshold_otsu(hist=(counts, centers)))
 
 
 def threshold(data):
     """Returns the Otsu threshold of a numpy array"""
-    return data > threshold_otsu(data[np.isfinite(data)])
+    return data > otsu_threshold(data, value_range=finite_range(data))
+
+
+def apply_scale_offset(array, scale_offset, out):
+    """Writes array * scale + offset into the float32 out buffer"""
+    scale, offset = scale_offset
+
+    if scale == 1 and offset == 0:
+        np.copyto(out, array, casting="same_kind")
+    else:
+        np.multiply(array, scale, out=out, dtype=np.float32, casting="same_kind")
+        np.add(out, offset, out=out)
+
+    return out
+
+
+def normalized_difference(
+    array1, array2, out=None, nodata=None, scale_offsets=None, chunk_size=1 << 16
+):
+    """Returns the normalized difference of two numpy arrays computed in float32
+
+    The arrays are processed in chunks: each chunk is scaled into the output
+    buffer and a small scratch buffer, and the index is evaluated there as
+    1 - 2 * array2 / (array1 + array2), so no full-size temporary is allocated.
+    Integer reflectance (e.g. uint16) is therefore converted to float only here.
+    Pixels where the sum is zero or flagged as nodata are set to NaN. The
+    index is clipped to [-1, 1]: the offset of the scaled reflectance makes
+    one of the bands slightly negative, e.g. the NIR of open water, which
+    takes the index past the bound of its sign.
+
+    Args:
+        array1 (np.ndarray): the first array
+        array2 (np.ndarray): the second array
+        out (np.ndarray): an optional float32 output buffer, it may be array1
+        nodata (float or np.ndarray): a nodata value of both arrays or a boolean
+            mask that is True where the pixels are invalid
+        scale_offsets (list): the (scale, offset) of each array, see get_scale_offsets
+        chunk_size (int): the number of pixels processed at once
+
+    Returns:
+        np.ndarray: the float32 normalized difference
+    """
+    shape = np.broadcast_shapes(array1.shape, array2.shape)
+
+    if out is None:
+        out = np.empty(shape, dtype=np.float32)
+    elif not out.flags.c_contiguous:
+        raise ValueError("The output buffer must be C-contiguous")
+
+    scale_offset1, scale_offset2 = scale_offsets or [(1.0, 0.0), (1.0, 0.0)]
+
+    flat1 = np.broadcast_to(array1, shape).reshape(-1)
+    flat2 = np.broadcast_to(array2, shape).reshape(-1)
+    flat_out = out.reshape(-1)
+
+    if isinstance(nodata, np.ndarray):
+        flat_nodata = np.broadcast_to(nodata, shape).reshape(-1)
+
+    scratch = np.empty(min(chunk_size, flat_out.size), dtype=np.float32)
+    valid_scratch = np.empty(scratch.size, dtype=bool)
+    invalid_scratch = np.empty(scratch.size, dtype=bool)
+
+    for start in range(0, flat_out.size, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        block = flat_out[chunk]
+        other = scratch[: block.size]
+        valid = valid_scratch[: block.size]
+
+        # flag the nodata before the block, which may alias array1, is overwritten
+        invalid = None
+        if isinstance(nodata, np.ndarray):
+            invalid = flat_nodata[chunk]
+        elif nodata is not None:
+            invalid = np.equal(flat1[chunk], nodata, out=invalid_scratch[: block.size])
+            invalid |= np.equal(flat2[chunk], nodata)
+
+        apply_scale_offset(flat2[chunk], scale_offset2, other)
+        apply_scale_offset(flat1[chunk], scale_offset1, block)
+
+        np.add(block, other, out=block)
+        np.not_equal(block, 0, out=valid)
+
+        if invalid is not None:
+            valid &= ~invalid
+
+        np.divide(other, block, out=block, where=valid)
+        np.multiply(block, -2, out=block)
+        np.add(block, 1, out=block)
+
+        # reflectance scaled below zero takes the index out of [-1, 1]
+        np.clip(block, -1, 1, out=block)
+
+        np.copyto(block, np.nan, where=np.logical_not(valid, out=valid))
+
+    return out
+
+
+INDEX_EXPRESSIONS = {
+    "ndvi": "(nir08 - red) / (nir08 + red)",
+    "ndwi": "(green - nir08) / (green + nir08)",
+    "mndwi": "(green - swir16) / (green + swir16)",
+    "ndbi": "(swir16 - nir08) / (swir16 + nir08)",
+}
+"""The expressions of the indices over the common band names, see compile_expression"""
+
+EXPRESSION_NODES = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.Pow,
+    ast.USub,
+    ast.UAdd,
+)
+"""The syntax allowed in an index expression"""
+
+
+def compile_expression(expression):
+    """Returns the code object and the sorted band names of an index expression
+
+    An index expression is arithmetic (+, -, *, /, **) over common band
+    names and numbers, e.g. "(nir08 - red) / (nir08 + red)", evaluated on
+    the reflectance of the bands.
+
+    Raises:
+        ValueError: when the expression is not such arithmetic
+    """
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except SyntaxError as error:
+        raise ValueError(f"Invalid index expression {expression}: {error}") from error
+
+    for node in ast.walk(tree):
+        if not isinstance(node, EXPRESSION_NODES) or (
+            isinstance(node, ast.Constant)
+            and (
+                isinstance(node.value, bool) or not isinstance(node.value, (int, float))
+            )
+        ):
+            raise ValueError(
+                f"Unsupported {type(node).__name__} in index expression {expression}"
+            )
+
+    bands = sorted({node.id for node in ast.walk(tree) if isinstance(node, ast.Name)})
+
+    return compile(tree, "<index expression>", "eval"), bands
+
+
+def parse_index(value):
+    """Returns the (name, expression) of an index given as a name of INDEX_EXPRESSIONS or as name=expression"""
+    name, separator, expression = value.partition("=")
+    name = name.strip().lower()
+
+    if not name.isidentifier():
+        raise ValueError(
+            f"Invalid index name {name}, use letters, digits and underscores"
+        )
+
+    if not separator:
+        if name not in INDEX_EXPRESSIONS:
+            raise ValueError(
+                f"Unknown index {name}, use one of {', '.join(INDEX_EXPRESSIONS)} "
+                "or name=expression"
+            )
+        expression = INDEX_EXPRESSIONS[name]
+
+    compile_expression(expression)
+
+    return name, expression
+
+
+def is_normalized_difference(expression):
+    """Returns whether an index expression is a normalized difference (a - b) / (a + b)"""
+    body = ast.parse(expression, mode="eval").body
+
+    if not (isinstance(body, ast.BinOp) and isinstance(body.op, ast.Div)):
+        return False
+
+    difference, total = body.left, body.right
+    if not (
+        isinstance(difference, ast.BinOp)
+        and isinstance(difference.op, ast.Sub)
+        and isinstance(total, ast.BinOp)
+        and isinstance(total.op, ast.Add)
+    ):
+        return False
+
+    return sorted(map(ast.dump, [difference.left, difference.right])) == sorted(
+        map(ast.dump, [total.left, total.right])
+    )
+
+
+def check_index_encoding(expressions, encoding=DEFAULT_INDEX_ENCODING):
+    """Checks that the index expressions fit in an index encoding
+
+    The integer encodings clip the values to [-1, 1], the range of the
+    normalized differences, so the other expressions, e.g. band ratios, need
+    one of the float encodings.
+
+    Raises:
+        ValueError: when an expression is not a normalized difference and the encoding is an integer one
+    """
+    if np.dtype(INDEX_ENCODINGS[encoding]["dtype"]).kind == "f":
+        return
+
+    unbounded = [
+        expression
+        for expression in expressions
+        if not is_normalized_difference(expression)
+    ]
+    if unbounded:
+        raise ValueError(
+            f"The {encoding} encoding only holds normalized differences in [-1, 1], "
+            f"use float32 or float16 for {', '.join(unbounded)}"
+        )
+
+
+def index_encodings(expressions, encoding=None):
+    """Returns the encoding of each index by index name
+
+    Without an encoding, the normalized differences are encoded with
+    DEFAULT_INDEX_ENCODING and the other expressions with float32, which
+    keeps their values unclipped.
+
+    Raises:
+        ValueError: when an expression does not fit in the encoding, see check_index_encoding
+    """
+    if encoding is not None:
+        check_index_encoding(expressions.values(), encoding)
+        return {name: encoding for name in expressions}
+
+    return {
+        name: (
+            DEFAULT_INDEX_ENCODING
+            if is_normalized_difference(expression)
+            else "float32"
+        )
+        for name, expression in expressions.items()
+    }
+
+
+def index_bands(expressions):
+    """Returns the sorted common band names used by index expressions"""
+    return sorted(
+        {
+            band
+            for expression in expressions
+            for band in compile_expression(expression)[1]
+        }
+    )
+
+
+def evaluate_indices(
+    bands, expressions, nodata=None, scale_offsets=None, block_size=256
+):
+    """Yields the blocks of several indices computed in a single pass over the bands
+
+    The bands are scaled to reflectance and the expressions evaluated block
+    of rows by block of rows, so the temporaries of the expressions are the
+    size of a block and each band block is scaled once for all the indices
+    using it. An index is NaN where one of its bands is nodata and where it
+    is not finite, e.g. where a normalized difference divides by zero. A
+    normalized difference is clipped to [-1, 1], as with normalized_difference.
+
+    Args:
+        bands (dict): the (height, width) arrays of the bands by common band name
+        expressions (dict): the index expressions by index name, see compile_expression
+        nodata (float): the nodata value of the bands
+        scale_offsets (dict): the (scale, offset) of the bands, see get_scale_offsets
+        block_size (int): the number of rows of a block
+
+    Yields:
+        tuple: the window of the block and the float32 blocks by index name
+
+    Raises:
+        ValueError: when an expression is invalid or uses a band missing from bands
+    """
+    compiled = {
+        name: compile_expression(expression) for name, expression in expressions.items()
+    }
+    bounded = {
+        name: is_normalized_difference(expression)
+        for name, expression in expressions.items()
+    }
+
+    used = index_bands(expressions.values())
+    missing = [band for band in used if band not in bands]
+    if missing:
+        raise ValueError(f"Bands {', '.join(missing)} missing for the indices")
+
+    scale_offsets = scale_offsets or {}
+    height, width = bands[used[0]].shape
+
+    buffers = {band: np.empty((block_size, width), dtype=np.float32) for band in used}
+
+    for row in range(0, height, block_size):
+        rows = slice(row, min(row + block_size, height))
+        size = rows.stop - rows.start
+
+        namespace = {}
+        invalid = {}
+        for band in used:
+            data = bands[band][rows]
+            if nodata is not None:
+                invalid[band] = data == nodata
+            namespace[band] = apply_scale_offset(
+                data, scale_offsets.get(band, (1.0, 0.0)), buffers[band][:size]
+            )
+
+        blocks = {}
+        for name, (code, names) in compiled.items():
+            with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+                block = np.asarray(
+                    eval(code, {"__builtins__": {}}, namespace), dtype=np.float32
+                )
+
+            # a constant expression still covers the block
+            if block.shape != (size, width):
+                block = np.array(np.broadcast_to(block, (size, width)))
+            # a bare band is its buffer, overwritten by the next block
+            elif any(np.shares_memory(block, buffers[band]) for band in names):
+                block = block.copy()
+
+            if bounded[name]:
+                np.clip(block, -1, 1, out=block)
+
+            valid = np.isfinite(block)
+            for band in names:
+                if band in invalid:
+                    valid &= ~invalid[band]
+            np.copyto(block, np.nan, where=~valid)
+
+            blocks[name] = block
+
+        yield Window(0, row, width, size), blocks
+
+
+def write_indices(
+    paths,
+    bands,
+    expressions,
+    profiles,
+    encodings,
+    nodata=None,
+    scale_offsets=None,
+):
+    """Computes several indices in a single pass and writes them concurrently
+
+    The blocks of the indices, see evaluate_indices, are handed to a writer
+    thread per index which encodes them, see encode_index, gathers their
+    statistics and writes them, GDAL releasing the GIL. Each writer then
+    closes its output, i.e. compresses it with its overviews, concurrently
+    with the others. A failure leaves no partial output.
+
+    Args:
+        paths (dict): the output path by index name
+        bands (dict): the (height, width) arrays of the bands by common band name
+        expressions (dict): the index expressions by index name
+        profiles (dict): the rasterio profile of the outputs by index name, see index_profile
+        encodings (dict): the encoding by index name, see index_encodings
+        nodata (float): the nodata value of the bands
+        scale_offsets (dict): the (scale, offset) of the bands
+
+    Returns:
+        dict: the BandStatistics of each index
+
+    Raises:
+        ValueError: when an expression does not fit in its encoding, see check_index_encoding
+    """
+    statistics = {}
+    for name, expression in expressions.items():
+        check_index_encoding([expression], encodings[name])
+
+        scale, offset = index_scale_offset(encodings[name])
+        statistics[name] = BandStatistics(
+            nodata=profiles[name]["nodata"],
+            value_range=((-1.0 - offset) / scale, (1.0 - offset) / scale),
+        )
+
+    queues = {name: queue.SimpleQueue() for name in expressions}
+
+    def write(name):
+        # the dataset is opened and closed in the thread of its GDAL environment
+        with open_output(paths[name], **profiles[name]) as dataset:
+            scale, offset = index_scale_offset(encodings[name])
+            dataset.scales = (scale,)
+            dataset.offsets = (offset,)
+
+            for item in iter(queues[name].get, None):
+                if isinstance(item, BaseException):
+                    raise item
+
+                window, block = item
+                block = encode_index(block, encodings[name])
+                statistics[name].update(block)
+                dataset.write(block, 1, window=window)
+
+            logger.info(f"Write {paths[name]}")
+
+    with ThreadPoolExecutor(max_workers=len(expressions)) as executor:
+        writers = {name: executor.submit(write, name) for name in expressions}
+
+        try:
+            for window, blocks in evaluate_indices(
+                bands, expressions, nodata, scale_offsets
+            ):
+                for name, block in blocks.items():
+                    if writers[name].done():
+                        writers[name].result()
+                    queues[name].put((window, block))
+        except BaseException as error:
+            for name in expressions:
+                queues[name].put(error)
+            raise
+
+        for name in expressions:
+            queues[name].put(None)
+
+        for writer in writers.values():
+            writer.result()
+
+    return statistics
+
+
+class BandStatistics:
+    """Accumulates the raster:bands statistics and histogram of a band block by block
+
+    The statistics are updated with the blocks as they are computed, so that
+    the output raster is never read back. The nodata and non-finite values
+    are left out. The histogram has bins buckets over value_range, the range
+    of the first block by default, i.e. of the whole band when it is updated
+    once. The values outside of value_range are not counted in the histogram.
+    """
+
+    def __init__(self, nodata=None, value_range=None, bins=10):
+        self.nodata = nodata
+        self.value_range = value_range
+        self.bins = bins
+        self.buckets = np.zeros(bins, dtype=np.int64)
+        self.edges = None
+        self.count = 0
+        self.valid = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def update(self, block):
+        """Adds the values of a block"""
+        if block.dtype == bool:
+            block = block.view(np.uint8)
+
+        self.count += block.size
+
+        valid = np.isfinite(block)
+        if self.nodata is not None and not np.isnan(self.nodata):
+            valid &= block != self.nodata
+
+        values = block[valid]
+        if not values.size:
+            return
+
+        minimum, maximum = values.min(), values.max()
+        self.minimum = minimum if self.minimum is None else min(self.minimum, minimum)
+        self.maximum = maximum if self.maximum is None else max(self.maximum, maximum)
+
+        if self.edges is None:
+            value_range = self.value_range or (float(minimum), float(maximum))
+            self.edges = np.histogram_bin_edges([], bins=self.bins, range=value_range)
+
+        self.buckets += np.histogram(values, bins=self.edges)[0]
+
+        # merges the block mean and sum of squared deviations (Chan et al.)
+        mean = values.mean(dtype=np.float64)
+        m2 = values.var(dtype=np.float64) * values.size
+        valid = self.valid + values.size
+        delta = mean - self.mean
+
+        self.mean += delta * values.size / valid
+        self.m2 += m2 + delta**2 * self.valid * values.size / valid
+        self.valid = valid
+
+    def to_dict(self):
+        """Returns the statistics and histogram fields of a raster:bands object"""
+        if not self.valid:
+            return {"statistics": {"valid_percent": 0.0}}
+
+        return {
+            "statistics": {
+                "mean": float(self.mean),
+                "minimum": self.minimum.item(),
+                "maximum": self.maximum.item(),
+                "stddev": math.sqrt(self.m2 / self.valid),
+                "valid_percent": self.valid / self.count * 100,
+            },
+            "histogram": {
+                "count": len(self.edges),
+                "min": float(self.edges[0]),
+                "max": float(self.edges[-1]),
+                "buckets": self.buckets.tolist(),
+            },
+        }
+
+
+def raster_band(meta, statistics, scale=1.0, offset=0.0):
+    """Returns the raster:bands object of an output band from its profile and statistics"""
+    band = {
+        "data_type": meta["dtype"],
+        "scale": scale,
+        "offset": offset,
+        "sampling": "area",
+    }
+
+    nodata = meta.get("nodata")
+    if nodata is not None:
+        if np.isnan(nodata):
+            band["nodata"] = "nan"
+        elif np.isinf(nodata):
+            band["nodata"] = "inf" if nodata > 0 else "-inf"
+        else:
+            band["nodata"] = float(nodata)
+
+    # e.g. the 1 bit water masks, read as uint8
+    if meta.get("nbits"):
+        band["bits_per_sample"] = int(meta["nbits"])
+
+    band.update(statistics.to_dict())
+
+    return band
+
+
+def bbox_to_geom(bbox):
+    """Returns the GeoJSON polygon of a bounding box"""
+    minx, miny, maxx, maxy = bbox
+
+    return {
+        "type": "Polygon",
+        "coordinates": [
+            [[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny]]
+        ],
+    }
+
+
+def create_output_item(
+    item_id,
+    href,
+    meta,
+    statistics,
+    input_datetime,
+    asset_name="data",
+    asset_roles=("data", "visual"),
+    scales=None,
+    offsets=None,
+):
+    """Returns the STAC Item of an output raster built from its profile and statistics
+
+    The item carries the same projection and raster:bands fields as
+    rio_stac.stac.create_stac_item with with_proj and with_raster set, but it
+    is built from the profile the raster was written with and from the
+    statistics gathered while its bands were computed instead of reading the
+    raster back.
+
+    Args:
+        item_id (str): the item id
+        href (str): the asset href, relative to the item
+        meta (dict): the rasterio profile of the raster
+        statistics (list): the BandStatistics of each band
+        input_datetime (datetime.datetime): the item datetime
+        asset_name (str): the asset key
+        asset_roles (list): the asset roles
+        scales (list): the scale of each band, 1 by default
+        offsets (list): the offset of each band, 0 by default
+
+    Returns:
+        pystac.Item: the STAC Item
+    """
+    crs = rasterio.crs.CRS.from_user_input(meta["crs"])
+    bounds = list(array_bounds(meta["height"], meta["width"], meta["transform"]))
+
+    geometry = transform_geom(crs, "EPSG:4326", bbox_to_geom(bounds))
+
+    properties = {
+        "proj:epsg": crs.to_epsg() if crs.is_epsg_code else None,
+        "proj:geometry": bbox_to_geom(bounds),
+        "proj:bbox": bounds,
+        "proj:shape": [meta["height"], meta["width"]],
+        "proj:transform": list(meta["transform"]),
+    }
+
+    if properties["proj:epsg"] is None:
+        properties["proj:wkt2"] = crs.to_wkt()
+
+    scales = scales or [1.0] * len(statistics)
+    offsets = offsets or [0.0] * len(statistics)
+
+    item = pystac.Item(
+        id=item_id,
+        geometry=geometry,
+        bbox=list(feature_bounds(geometry)),
+        datetime=input_datetime,
+        properties=properties,
+        stac_extensions=[PROJECTION_EXTENSION, RASTER_EXTENSION],
+    )
+
+    item.add_asset(
+        asset_name,
+        pystac.Asset(
+            href=href,
+            media_type=pystac.MediaType.GEOTIFF,
+            roles=list(asset_roles),
+            extra_fields={
+                "raster:bands": [
+                    raster_band(meta, band_statistics, scale, offset)
+                    for band_statistics, scale, offset in zip(
+                        statistics, scales, offsets
+                    )
+                ]
+            },
+        ),
+    )
+
+    return item
+
+
+WATER_BODIES_RENDERS = {
+    "overview": {
+        "title": "Detected Water Bodies",
+        "assets": ["data"],
+        "nodata": 0,
+        "colormap": {
+            "1": "0000FF",
+        },
+        "resampling": "nearest",
+    }
+}
+"""The renders of the water bodies items"""
+
+
+def water_bodies_item(
+    item_url, aoi, bands, epsg, profile, mask_encoding, renders=None, directory=""
+):
+    """Detects the water bodies of an item and returns the output STAC Item as a dictionary
+
+    The raster is written in its own item directory, under directory, so several
+    items can be processed concurrently, see map_items. The renders, when set,
+    are added to the properties of the output item.
+    """
+    item = get_item(item_url)
+
+    logger.info(f"Read {item.id} from {item.get_self_href()}")
+
+    bbox = aoi2box(aoi)
+
+    out_image, out_meta = crop_bands(item, bands, bbox, epsg, native_dtype=True)
+
+    cropped_assets = dict(zip(bands, out_image))
+    scale_offsets = dict(zip(bands, get_scale_offsets(item, bands)))
+
+    nd = normalized_difference(
+        cropped_assets[bands[0]],
+        cropped_assets[bands[1]],
+        nodata=out_meta["nodata"],
+        scale_offsets=[scale_offsets[bands[0]], scale_offsets[bands[1]]],
+    )
+
+    water_bodies = threshold(nd)
+
+    out_meta.update(mask_profile(profile, mask_encoding), dtype="uint8")
+
+    water_body = os.path.join(directory, item.id, "otsu.tif")
+
+    statistics = BandStatistics(nodata=out_meta["nodata"])
+    statistics.update(water_bodies)
+
+    with open_output(water_body, **out_meta) as dst_dataset:
+        logger.info(f"Write {water_body}")
+        dst_dataset.write(water_bodies, indexes=1)
+
+    out_item = create_output_item(
+        item.id,
+        os.path.basename(water_body),
+        out_meta,
+        [statistics],
+        item.datetime,
+    )
+
+    if renders is not None:
+        out_item.properties["renders"] = renders
+
+    return out_item.to_dict()
+
+
+VEGETATION_INDICES = {
+    "ndvi": ("nir08", "red"),
+    "ndwi": ("green", "nir08"),
+}
+"""The bands of the normalized difference of each vegetation index"""
+
+
+def vegetation_index_item(
+    item_url, aoi, epsg, vegetation_index, profile, index_encoding, directory=""
+):
+    """Computes a vegetation index of an item and returns the output STAC Item as a dictionary
+
+    The index is written encoded with index_encoding, in a directory named
+    after the index under directory, with the scale and offset that decode it.
+    """
+    item = get_item(item_url)
+
+    logger.info(f"Read {item.id} from {item.get_self_href()}")
+
+    bbox = aoi2box(aoi)
+
+    bands = VEGETATION_INDICES[vegetation_index]
+
+    out_image, out_meta = crop_bands(item, bands, bbox, epsg, native_dtype=True)
+
+    logger.info(f"Computing {vegetation_index.upper()}")
+
+    scale_offsets = get_scale_offsets(item, bands)
+
+    output = normalized_difference(
+        out_image[0],
+        out_image[1],
+        nodata=out_meta["nodata"],
+        scale_offsets=scale_offsets,
+    )
+
+    out_meta.update(index_profile(profile, index_encoding))
+    scale, offset = index_scale_offset(index_encoding)
+
+    output_tif = os.path.join(directory, vegetation_index, f"{vegetation_index}.tif")
+
+    # the statistics describe the encoded values, as written
+    output = encode_index(output, index_encoding)
+    statistics = BandStatistics(nodata=out_meta["nodata"])
+    statistics.update(output)
+
+    with open_output(output_tif, **out_meta) as dst_dataset:
+        logger.info(f"Write output {output_tif}")
+        dst_dataset.write(output, indexes=1)
+        dst_dataset.scales = (scale,)
+        dst_dataset.offsets = (offset,)
 
+    out_item = create_output_item(
+        vegetation_index,
+        os.path.basename(output_tif),
+        out_meta,
+        [statistics],
+        item.datetime,
+        scales=[scale],
+        offsets=[offset],
+    )
 
-def normalized_difference(array1, array2):
-    """Returns the normalized difference of two numpy arrays"""
-    return (array1 - array2) / (array1 + array2)
+    return out_item.to_dict()
 
 
 def aoi2box(aoi):
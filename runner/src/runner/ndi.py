@@ -2,10 +2,20 @@ import os
 import click
 import rasterio
 import pystac
-import shutil
-import rio_stac
 from loguru import logger
-from runner.functions import normalized_difference, get_item
+from runner.functions import (
+    normalized_difference,
+    get_item,
+    matching_windows,
+    open_output,
+    output_profile,
+    BandStatistics,
+    create_output_item,
+)
+from runner.profiles import (
+    OUTPUT_PROFILES,
+    DEFAULT_OUTPUT_PROFILE,
+)
 
 
 @click.command(
@@ -31,7 +41,22 @@ from runner.functions import normalized_difference, get_item
     help="STAC collection",
     required=False,
 )
-def ndi_cli(item_1, item_2, ls9_item, collection_url):
+@click.option(
+    "--streaming/--in-memory",
+    "streaming",
+    default=True,
+    show_default=True,
+    help="Process the input bands block by block instead of reading them whole",
+)
+@click.option(
+    "--output-profile",
+    "profile",
+    help="Codec and overviews of the output rasters",
+    type=click.Choice(list(OUTPUT_PROFILES)),
+    default=DEFAULT_OUTPUT_PROFILE,
+    show_default=True,
+)
+def ndi_cli(item_1, item_2, ls9_item, collection_url, streaming, profile):
 
     collection: pystac.Collection = (
         pystac.read_file(collection_url) if collection_url else None
@@ -47,53 +72,68 @@ def ndi_cli(item_1, item_2, ls9_item, collection_url):
     asset_1: pystac.Asset = item_1.assets.get("data")
     asset_2: pystac.Asset = item_2.assets.get("data")
 
-    # read data
-    with rasterio.open(asset_1.get_absolute_href()) as src1:
-        data1 = src1.read(1)
-        out_meta = src1.meta.copy()
-
-    with rasterio.open(asset_2.get_absolute_href()) as src2:
-        data2 = src2.read(1)
-
-    # calculate normalized difference
-    ndi_data = normalized_difference(data1, data2)
+    output_item_id = f"ndi-{ls9_item.id}".lower()
 
-    ndi = "ndi.tif"
+    ndi = os.path.join(output_item_id, "ndi.tif")
 
-    out_meta.update(
-        {
-            "dtype": "float32",
-            "driver": "COG",
-            "tiled": True,
-            "compress": "lzw",
-            "blockxsize": 256,
-            "blockysize": 256,
-        }
-    )
+    with rasterio.open(asset_1.get_absolute_href()) as src1, rasterio.open(
+        asset_2.get_absolute_href()
+    ) as src2:
+        out_meta = src1.meta.copy()
 
-    with rasterio.open(ndi, "w", **out_meta) as dst_dataset:
-        logger.info(f"Write {ndi}")
-        dst_dataset.write(ndi_data, indexes=1)
+        # the cropped bands carry their reflectance scale and offset
+        scale_offsets = [
+            (src1.scales[0], src1.offsets[0]),
+            (src2.scales[0], src2.offsets[0]),
+        ]
+
+        out_meta.update(output_profile(profile), dtype="float32")
+
+        if streaming:
+            # the blocks come one by one, the histogram spans the range of the index
+            statistics = BandStatistics(
+                nodata=out_meta["nodata"], value_range=(-1.0, 1.0)
+            )
+
+            with open_output(ndi, streaming=True, **out_meta) as dst_dataset:
+                logger.info(f"Write {ndi} block by block")
+                for window in matching_windows(src1, src2):
+                    ndi_block = normalized_difference(
+                        src1.read(1, window=window),
+                        src2.read(1, window=window),
+                        nodata=src1.nodata,
+                        scale_offsets=scale_offsets,
+                    )
+                    statistics.update(ndi_block)
+                    dst_dataset.write(ndi_block, indexes=1, window=window)
+
+        else:
+            data1 = src1.read(1)
+            data2 = src2.read(1)
+
+            # calculate normalized difference
+            ndi_data = normalized_difference(
+                data1, data2, nodata=src1.nodata, scale_offsets=scale_offsets
+            )
+
+            statistics = BandStatistics(nodata=out_meta["nodata"])
+            statistics.update(ndi_data)
+
+            with open_output(ndi, **out_meta) as dst_dataset:
+                logger.info(f"Write {ndi}")
+                dst_dataset.write(ndi_data, indexes=1)
 
     logger.info("Creating a STAC Catalog")
     cat = pystac.Catalog(
         id="catalog", description=f"Normalized difference from {ls9_item.id}"
     )
 
-    output_item_id = f"ndi-{ls9_item.id}".lower()
-
-    os.makedirs(output_item_id, exist_ok=True)
-    shutil.copy(ndi, output_item_id)
-
-    out_item = rio_stac.stac.create_stac_item(
-        source=ndi,
-        input_datetime=ls9_item.datetime,
-        id=output_item_id,
-        asset_roles=["data", "visual"],
-        asset_href=os.path.basename(ndi),
-        asset_name="data",
-        with_proj=True,
-        with_raster=True,
+    out_item = create_output_item(
+        output_item_id,
+        os.path.basename(ndi),
+        out_meta,
+        [statistics],
+        ls9_item.datetime,
     )
 
     out_item.properties["renders"] = {
@@ -111,7 +151,6 @@ def ndi_cli(item_1, item_2, ls9_item, collection_url):
         logger.info(f"Adding collection {collection.id} to the output item")
         out_item.collection_id = collection.id
 
-    os.remove(ndi)
     cat.add_items([out_item])
 
     cat.normalize_and_save(
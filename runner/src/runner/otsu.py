@@ -3,9 +3,20 @@ import click
 import pystac
 import rasterio
 from loguru import logger
-import shutil
-import rio_stac
-from runner.functions import threshold, get_item
+from runner.functions import (
+    otsu_threshold,
+    get_item,
+    open_output,
+    mask_profile,
+    BandStatistics,
+    create_output_item,
+)
+from runner.profiles import (
+    MASK_ENCODINGS,
+    DEFAULT_MASK_ENCODING,
+    OUTPUT_PROFILES,
+    DEFAULT_OUTPUT_PROFILE,
+)
 
 
 @click.command(
@@ -24,7 +35,23 @@ from runner.functions import threshold, get_item
     help="STAC collection",
     required=False,
 )
-def otsu_cli(item_ndi, ls9_item, collection_url):
+@click.option(
+    "--output-profile",
+    "profile",
+    help="Codec and overviews of the output rasters",
+    type=click.Choice(list(OUTPUT_PROFILES)),
+    default=DEFAULT_OUTPUT_PROFILE,
+    show_default=True,
+)
+@click.option(
+    "--mask-encoding",
+    "mask_encoding",
+    help="Encoding of the water mask: uint8, 1 bit samples or deflated uint8",
+    type=click.Choice(list(MASK_ENCODINGS)),
+    default=DEFAULT_MASK_ENCODING,
+    show_default=True,
+)
+def otsu_cli(item_ndi, ls9_item, collection_url, profile, mask_encoding):
     """
     Detects water bodies using the Otsu thresholding method on the NDI.
     """
@@ -45,27 +72,30 @@ def otsu_cli(item_ndi, ls9_item, collection_url):
         logger.error(msg)
         raise ValueError(msg)
 
-    # read data
+    output_item_id = f"water-body-{ls9_item.id}".lower()
+
+    otsu = os.path.join(output_item_id, "otsu.tif")
+
+    # stream the blocks twice: histogram first, then the thresholded blocks
     with rasterio.open(asset_ndi.get_absolute_href()) as src:
-        data = src.read(1)
         out_meta = src.meta.copy()
 
-    # apply Otsu thresholding
-    otsu_data = threshold(data)
+        otsu_value = otsu_threshold(
+            src.read(1, window=window) for _, window in src.block_windows(1)
+        )
+        logger.info(f"Otsu threshold {otsu_value}")
 
-    otsu = "otsu.tif"
+        out_meta.update(mask_profile(profile, mask_encoding), dtype="uint8")
 
-    out_meta.update(
-        {
-            "dtype": "uint8",
-            "driver": "GTiff",
-            "compress": "lzw",
-            "tiled": True,
-        }
-    )
+        statistics = BandStatistics(nodata=out_meta["nodata"], value_range=(0, 1))
 
-    with rasterio.open(otsu, "w", **out_meta) as dst_dataset:
-        dst_dataset.write(otsu_data.astype(rasterio.uint8), 1)
+        with open_output(otsu, streaming=True, **out_meta) as dst_dataset:
+            for _, window in src.block_windows(1):
+                water_bodies = (src.read(1, window=window) > otsu_value).astype(
+                    rasterio.uint8
+                )
+                statistics.update(water_bodies)
+                dst_dataset.write(water_bodies, 1, window=window)
 
     logger.info(f"Otsu output written to {otsu}")
 
@@ -74,19 +104,13 @@ def otsu_cli(item_ndi, ls9_item, collection_url):
         id="catalog", description=f"Detected water bodies from {ls9_item.id}"
     )
 
-    output_item_id = f"water-body-{ls9_item.id}".lower()
-
-    os.makedirs(output_item_id, exist_ok=True)
-    shutil.copy(otsu, output_item_id)
-
     # Create a STAC Item for the output
-    out_item = rio_stac.stac.create_stac_item(
-        source=otsu,
-        input_datetime=ls9_item.datetime,
-        id=output_item_id,
-        asset_roles=["data", "visual"],
-        asset_href=os.path.basename(otsu),
-        asset_name="data",
+    out_item = create_output_item(
+        output_item_id,
+        os.path.basename(otsu),
+        out_meta,
+        [statistics],
+        ls9_item.datetime,
     )
 
     out_item.properties["renders"] = {
@@ -105,7 +129,6 @@ def otsu_cli(item_ndi, ls9_item, collection_url):
         logger.info(f"Adding collection {collection.id} to the output item")
         out_item.collection_id = collection.id
 
-    os.remove(otsu)
     cat.add_items([out_item])
 
     cat.normalize_and_save(
@@ -12,17 +12,19 @@
 import os
 import click
 import pystac
-import rasterio
 from loguru import logger
-import shutil
-import rio_stac
 from runner.functions import (
     aoi2box,
     crop,
-    get_asset,
-    normalized_difference,
-    threshold,
-    get_item,
+    open_output,
+    output_profile,
+    water_bodies_item,
+)
+from runner.profiles import (
+    MASK_ENCODINGS,
+    DEFAULT_MASK_ENCODING,
+    OUTPUT_PROFILES,
+    DEFAULT_OUTPUT_PROFILE,
 )
 
 
@@ -62,69 +64,29 @@ from runner.functions import (
     required=True,
     multiple=False,
 )
-def pattern_11(item_url, aoi, bands, epsg, dem):
-
-    item = get_item(item_url)
-
-    logger.info(f"Read {item.id} from {item.get_self_href()}")
-
-    cropped_assets = {}
-
-    for band in bands:
-        asset = get_asset(item, band)
-        logger.info(f"Read asset {band} from {asset.get_absolute_href()}")
-
-        if not asset:
-            msg = f"Common band name {band} not found in the assets"
-            logger.error(msg)
-            raise ValueError(msg)
-
-        bbox = aoi2box(aoi)
-
-        out_image, out_meta = crop(asset, bbox, epsg)
-
-        cropped_assets[band] = out_image[0]
-
-    nd = normalized_difference(cropped_assets[bands[0]], cropped_assets[bands[1]])
-
-    water_bodies = threshold(nd)
+@click.option(
+    "--output-profile",
+    "profile",
+    help="Codec and overviews of the output rasters",
+    type=click.Choice(list(OUTPUT_PROFILES)),
+    default=DEFAULT_OUTPUT_PROFILE,
+    show_default=True,
+)
+@click.option(
+    "--mask-encoding",
+    "mask_encoding",
+    help="Encoding of the water mask: uint8, 1 bit samples or deflated uint8",
+    type=click.Choice(list(MASK_ENCODINGS)),
+    default=DEFAULT_MASK_ENCODING,
+    show_default=True,
+)
+def pattern_11(item_url, aoi, bands, epsg, dem, profile, mask_encoding):
 
-    out_meta.update(
-        {
-            "dtype": "uint8",
-            "driver": "COG",
-            "tiled": True,
-            "compress": "lzw",
-            "blockxsize": 256,
-            "blockysize": 256,
-        }
+    out_item = pystac.Item.from_dict(
+        water_bodies_item(item_url, aoi, bands, epsg, profile, mask_encoding)
     )
 
-    water_body = "otsu.tif"
-
-    with rasterio.open(water_body, "w", **out_meta) as dst_dataset:
-        logger.info("Write otsu.tif")
-        dst_dataset.write(water_bodies, indexes=1)
-
-    if os.path.isdir(item_url):
-        catalog = pystac.read_file(os.path.join(item_url, "catalog.json"))
-        item = next(catalog.get_items())
-    else:
-        item = pystac.read_file(item_url)
-
-    os.makedirs(item.id, exist_ok=True)
-    shutil.copy(water_body, item.id)
-
-    out_item = rio_stac.stac.create_stac_item(
-        source=water_body,
-        input_datetime=item.datetime,
-        id=item.id,
-        asset_roles=["data", "visual"],
-        asset_href=os.path.basename(water_body),
-        asset_name="data",
-        with_proj=True,
-        with_raster=True,
-    )
+    bbox = aoi2box(aoi)
 
     # DEM
     logger.info(f"Cropping DEM {dem} {type(dem)}")
@@ -135,12 +97,16 @@ def pattern_11(item_url, aoi, bands, epsg, dem):
 
     out_image, out_meta = crop(input_dem_asset, bbox, epsg)
 
-    with rasterio.open("dem.tif", "w", **out_meta) as dst_dataset:
-        logger.info("Write dem.tif")
+    out_meta.update(output_profile(profile))
+
+    dem_tif = os.path.join(out_item.id, "dem.tif")
+
+    with open_output(dem_tif, **out_meta) as dst_dataset:
+        logger.info(f"Write {dem_tif}")
         dst_dataset.write(out_image[0], indexes=1)
 
     dem_asset = pystac.Asset(
-        href=os.path.basename("dem.tif"),
+        href=os.path.basename(dem_tif),
         title="Digital Elevation Model",
         media_type=pystac.MediaType.GEOTIFF,
         roles=["data", "visual"],
@@ -150,9 +116,6 @@ def pattern_11(item_url, aoi, bands, epsg, dem):
         "dem",
         dem_asset,
     )
-    shutil.copy("dem.tif", item.id)
-    os.remove("dem.tif")
-    os.remove(water_body)
 
     logger.info("Creating a STAC Catalog")
     cat = pystac.Catalog(id="catalog", description="water-bodies")
@@ -8,20 +8,19 @@
 
 # Implementation: process the vegetation index for two dates taking input two Landsat-9 acquisitions producing a STAC Catalog with two STAC Items
 
-import os
 import click
 import pystac
-import rasterio
 from loguru import logger
-import shutil
-import rio_stac
 from runner.functions import (
-    aoi2box,
-    crop,
-    get_asset,
-    normalized_difference,
-    threshold,
-    get_item,
+    map_items,
+    water_bodies_item,
+    WATER_BODIES_RENDERS,
+)
+from runner.profiles import (
+    MASK_ENCODINGS,
+    DEFAULT_MASK_ENCODING,
+    OUTPUT_PROFILES,
+    DEFAULT_OUTPUT_PROFILE,
 )
 
 
@@ -60,89 +59,52 @@ from runner.functions import (
     required=True,
     multiple=True,
 )
-def pattern_2(item_url_1, item_url_2, aoi, bands, epsg):
+@click.option(
+    "--workers",
+    "workers",
+    help="Number of items processed in parallel processes",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+)
+@click.option(
+    "--output-profile",
+    "profile",
+    help="Codec and overviews of the output rasters",
+    type=click.Choice(list(OUTPUT_PROFILES)),
+    default=DEFAULT_OUTPUT_PROFILE,
+    show_default=True,
+)
+@click.option(
+    "--mask-encoding",
+    "mask_encoding",
+    help="Encoding of the water mask: uint8, 1 bit samples or deflated uint8",
+    type=click.Choice(list(MASK_ENCODINGS)),
+    default=DEFAULT_MASK_ENCODING,
+    show_default=True,
+)
+def pattern_2(
+    item_url_1, item_url_2, aoi, bands, epsg, workers, profile, mask_encoding
+):
 
     logger.info("Creating a STAC Catalog")
     cat = pystac.Catalog(id="catalog", description="water-bodies")
 
-    for item_url in [item_url_1, item_url_2]:
-
-        item = get_item(item_url)
-
-        logger.info(f"Read {item.id} from {item.get_self_href()}")
-
-        cropped_assets = {}
-
-        for band in bands:
-            asset = get_asset(item, band)
-            logger.info(f"Read asset {band} from {asset.get_absolute_href()}")
-
-            if not asset:
-                msg = f"Common band name {band} not found in the assets"
-                logger.error(msg)
-                raise ValueError(msg)
-
-            bbox = aoi2box(aoi)
-
-            out_image, out_meta = crop(asset, bbox, epsg)
-
-            cropped_assets[band] = out_image[0]
-
-        nd = normalized_difference(cropped_assets[bands[0]], cropped_assets[bands[1]])
-
-        water_bodies = threshold(nd)
-
-        out_meta.update(
-            {
-                "dtype": "uint8",
-                "driver": "COG",
-                "tiled": True,
-                "compress": "lzw",
-                "blockxsize": 256,
-                "blockysize": 256,
-            }
-        )
-
-        water_body = "otsu.tif"
-
-        with rasterio.open(water_body, "w", **out_meta) as dst_dataset:
-            logger.info("Write otsu.tif")
-            dst_dataset.write(water_bodies, indexes=1)
-
-        if os.path.isdir(item_url):
-            catalog = pystac.read_file(os.path.join(item_url, "catalog.json"))
-            item = next(catalog.get_items())
-        else:
-            item = pystac.read_file(item_url)
-
-        os.makedirs(item.id, exist_ok=True)
-        shutil.copy(water_body, item.id)
-
-        out_item = rio_stac.stac.create_stac_item(
-            source=water_body,
-            input_datetime=item.datetime,
-            id=item.id,
-            asset_roles=["data", "visual"],
-            asset_href=os.path.basename(water_body),
-            asset_name="data",
-            with_proj=True,
-            with_raster=True,
-        )
-
-        out_item.properties["renders"] = {
-            "overview": {
-                "title": "Detected Water Bodies",
-                "assets": ["data"],
-                "nodata": 0,
-                "colormap": {
-                    "1": "0000FF",
-                },
-                "resampling": "nearest",
-            }
-        }
+    item_urls = [item_url_1, item_url_2]
+
+    out_items = map_items(
+        water_bodies_item,
+        item_urls,
+        aoi,
+        bands,
+        epsg,
+        profile,
+        mask_encoding,
+        WATER_BODIES_RENDERS,
+        workers=workers,
+    )
 
-        os.remove(water_body)
-        cat.add_items([out_item])
+    cat.add_items([pystac.Item.from_dict(out_item) for out_item in out_items])
 
     cat.normalize_and_save(
         root_href="./", catalog_type=pystac.CatalogType.SELF_CONTAINED
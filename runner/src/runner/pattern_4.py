@@ -11,11 +11,33 @@
 import os
 import click
 import pystac
-import rasterio
 from loguru import logger
-import shutil
-import rio_stac
-from runner.functions import aoi2box, crop, get_asset, normalized_difference, get_item
+from runner.functions import (
+    aoi2box,
+    crop_bands,
+    get_scale_offsets,
+    get_item,
+    index_bands,
+    index_encodings,
+    index_profile,
+    index_scale_offset,
+    parse_index,
+    write_indices,
+    create_output_item,
+)
+from runner.profiles import (
+    INDEX_ENCODINGS,
+    OUTPUT_PROFILES,
+    DEFAULT_OUTPUT_PROFILE,
+)
+
+
+def parse_indices(ctx, param, values):
+    """Returns the expressions of the --index values by index name"""
+    try:
+        return dict(parse_index(value) for value in values)
+    except ValueError as error:
+        raise click.BadParameter(str(error)) from error
 
 
 @click.command(
@@ -40,62 +62,87 @@ from runner.functions import aoi2box, crop, get_asset, normalized_difference, ge
     help="EPSG code",
     required=True,
 )
-def pattern_4(item_url, aoi, epsg):
+@click.option(
+    "--output-profile",
+    "profile",
+    help="Codec and overviews of the output rasters",
+    type=click.Choice(list(OUTPUT_PROFILES)),
+    default=DEFAULT_OUTPUT_PROFILE,
+    show_default=True,
+)
+@click.option(
+    "--index-encoding",
+    "index_encoding",
+    help="Data type of the indices: float32, float16, or int16 and uint8 with a scale and offset, "
+    "int16 for the normalized differences and float32 for the other indices if not set",
+    type=click.Choice(list(INDEX_ENCODINGS)),
+    default=None,
+)
+@click.option(
+    "--index",
+    "indices",
+    help="Index to compute: ndvi, ndwi, mndwi, ndbi or name=expression over common band names, "
+    "float32 or float16 encoded unless a normalized difference",
+    multiple=True,
+    default=["ndvi", "ndwi"],
+    show_default=True,
+    callback=parse_indices,
+)
+def pattern_4(item_url, aoi, epsg, profile, index_encoding, indices):
+
+    try:
+        encodings = index_encodings(indices, index_encoding)
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint="--index-encoding") from error
 
     item = get_item(item_url)
 
     logger.info(f"Read {item.id} from {item.get_self_href()}")
 
-    cropped_assets = {}
+    bbox = aoi2box(aoi)
 
-    for band in ["red", "green", "nir08"]:
-        asset = get_asset(item, band)
-        logger.info(f"Read asset {band} from {asset.get_absolute_href()}")
+    bands = index_bands(indices.values())
 
-        if not asset:
-            msg = f"Common band name {band} not found in the assets"
-            logger.error(msg)
-            raise ValueError(msg)
+    out_image, out_meta = crop_bands(item, bands, bbox, epsg, native_dtype=True)
 
-        bbox = aoi2box(aoi)
+    cropped_assets = dict(zip(bands, out_image))
+    scale_offsets = dict(zip(bands, get_scale_offsets(item, bands)))
+    nodata = out_meta["nodata"]
 
-        out_image, out_meta = crop(asset, bbox, epsg)
+    profiles = {
+        name: {**out_meta, **index_profile(profile, encodings[name])}
+        for name in indices
+    }
 
-        cropped_assets[band] = out_image[0]
+    output_tifs = {name: os.path.join(name, name, f"{name}.tif") for name in indices}
 
-    ndvi = normalized_difference(cropped_assets["nir08"], cropped_assets["red"])
-    ndwi = normalized_difference(cropped_assets["green"], cropped_assets["nir08"])
+    logger.info(f"Computing {', '.join(indices)}")
 
-    out_meta.update(
-        {
-            "dtype": "uint8",
-            "driver": "COG",
-            "tiled": True,
-            "compress": "lzw",
-            "blockxsize": 256,
-            "blockysize": 256,
-        }
+    # the statistics describe the encoded values, as written
+    statistics = write_indices(
+        output_tifs,
+        cropped_assets,
+        indices,
+        profiles,
+        encodings,
+        nodata=nodata,
+        scale_offsets=scale_offsets,
     )
 
-    for name, output in [("ndvi", ndvi), ("ndwi", ndwi)]:
+    for name, output_tif in output_tifs.items():
 
-        with rasterio.open(f"{name}.tif", "w", **out_meta) as dst_dataset:
-            logger.info(f"Write output {name}.tif")
-            dst_dataset.write(output, indexes=1)
+        scale, offset = index_scale_offset(encodings[name])
 
         cat = pystac.Catalog(id="catalog", description=f"{name} vegetation index")
 
-        os.makedirs(name, exist_ok=True)
-
-        out_item = rio_stac.stac.create_stac_item(
-            source=f"{name}.tif",
-            input_datetime=item.datetime,
-            id=name,
-            asset_roles=["data", "visual"],
-            asset_href=os.path.basename(f"{name}.tif"),
-            asset_name="data",
-            with_proj=True,
-            with_raster=True,
+        out_item = create_output_item(
+            name,
+            os.path.basename(output_tif),
+            profiles[name],
+            [statistics[name]],
+            item.datetime,
+            scales=[scale],
+            offsets=[offset],
         )
 
         cat.add_items([out_item])
@@ -103,7 +150,5 @@ def pattern_4(item_url, aoi, epsg):
         cat.normalize_and_save(
             root_href=f"./{name}", catalog_type=pystac.CatalogType.SELF_CONTAINED
         )
-        shutil.copy(f"{name}.tif", os.path.join(name, name, f"{name}.tif"))
-        os.remove(f"{name}.tif")
 
     logger.info("Done!")
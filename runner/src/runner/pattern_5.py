@@ -8,14 +8,18 @@
 
 # Implementation: process the NDVI and NDWI taking as input a Landsat-9 acquisition and generating a stack of STAC Catalogs
 
-import os
 import click
 import pystac
-import rasterio
 from loguru import logger
-import shutil
-import rio_stac
-from runner.functions import aoi2box, crop, get_asset, normalized_difference, get_item
+from runner.functions import (
+    vegetation_index_item,
+)
+from runner.profiles import (
+    INDEX_ENCODINGS,
+    DEFAULT_INDEX_ENCODING,
+    OUTPUT_PROFILES,
+    DEFAULT_OUTPUT_PROFILE,
+)
 
 
 @click.command(
@@ -47,79 +51,36 @@ from runner.functions import aoi2box, crop, get_asset, normalized_difference, ge
     help="Vegetation index to compute",
     required=True,
 )
-def pattern_5(item_url, aoi, epsg, vegetation_index):
-
-    item = get_item(item_url)
-
-    logger.info(f"Read {item.id} from {item.get_self_href()}")
-
-    cropped_assets = {}
-
-    for band in ["red", "green", "nir08"]:
-        asset = get_asset(item, band)
-        logger.info(f"Read asset {band} from {asset.get_absolute_href()}")
-
-        if not asset:
-            msg = f"Common band name {band} not found in the assets"
-            logger.error(msg)
-            raise ValueError(msg)
-
-        bbox = aoi2box(aoi)
-
-        out_image, out_meta = crop(asset, bbox, epsg)
-
-        cropped_assets[band] = out_image[0]
-
-    if vegetation_index == "ndvi":
-        logger.info("Computing NDVI")
-
-        # Compute NDVI using the NIR and red bands
-        output = normalized_difference(cropped_assets["nir08"], cropped_assets["red"])
-        name = "ndvi"
-
-    if vegetation_index == "ndwi":
-        logger.info("Computing NDWI")
-
-        # Compute NDWI using the green and NIR bands
-        output = normalized_difference(cropped_assets["green"], cropped_assets["nir08"])
-        name = "ndwi"
+@click.option(
+    "--output-profile",
+    "profile",
+    help="Codec and overviews of the output rasters",
+    type=click.Choice(list(OUTPUT_PROFILES)),
+    default=DEFAULT_OUTPUT_PROFILE,
+    show_default=True,
+)
+@click.option(
+    "--index-encoding",
+    "index_encoding",
+    help="Data type of the index: float32, float16, or int16 and uint8 with a scale and offset",
+    type=click.Choice(list(INDEX_ENCODINGS)),
+    default=DEFAULT_INDEX_ENCODING,
+    show_default=True,
+)
+def pattern_5(item_url, aoi, epsg, vegetation_index, profile, index_encoding):
 
-    out_meta.update(
-        {
-            "dtype": "uint8",
-            "driver": "COG",
-            "tiled": True,
-            "compress": "lzw",
-            "blockxsize": 256,
-            "blockysize": 256,
-        }
+    out_item = vegetation_index_item(
+        item_url, aoi, epsg, vegetation_index, profile, index_encoding
     )
 
-    with rasterio.open(f"{name}.tif", "w", **out_meta) as dst_dataset:
-        logger.info(f"Write output {name}.tif")
-        dst_dataset.write(output, indexes=1)
-
-    cat = pystac.Catalog(id="catalog", description=f"{name} vegetation index")
-
-    os.makedirs(name, exist_ok=True)
-
-    out_item = rio_stac.stac.create_stac_item(
-        source=f"{name}.tif",
-        input_datetime=item.datetime,
-        id=name,
-        asset_roles=["data", "visual"],
-        asset_href=os.path.basename(f"{name}.tif"),
-        asset_name="data",
-        with_proj=True,
-        with_raster=True,
+    cat = pystac.Catalog(
+        id="catalog", description=f"{vegetation_index} vegetation index"
     )
 
-    cat.add_items([out_item])
+    cat.add_items([pystac.Item.from_dict(out_item)])
 
     cat.normalize_and_save(
         root_href="./", catalog_type=pystac.CatalogType.SELF_CONTAINED
     )
-    shutil.copy(f"{name}.tif", os.path.join(name, f"{name}.tif"))
-    os.remove(f"{name}.tif")
 
     logger.info("Done!")
@@ -13,7 +13,13 @@ import sys
 import click
 from loguru import logger
 import numpy as np
-from runner.functions import aoi2box, crop, get_asset, normalized_difference, get_item
+from runner.functions import (
+    aoi2box,
+    crop_bands,
+    get_scale_offsets,
+    normalized_difference,
+    get_item,
+)
 
 
 @click.command(
@@ -44,27 +50,25 @@ def pattern_6(item_url, aoi, epsg):
 
     logger.info(f"Read {item.id} from {item.get_self_href()}")
 
-    cropped_assets = {}
-
-    for band in ["red", "nir08"]:
-        asset = get_asset(item, band)
-        logger.info(f"Read asset {band} from {asset.get_absolute_href()}")
-
-        if not asset:
-            msg = f"Common band name {band} not found in the assets"
-            logger.error(msg)
-            raise ValueError(msg)
+    bbox = aoi2box(aoi)
 
-        bbox = aoi2box(aoi)
+    bands = ["red", "nir08"]
 
-        out_image, out_meta = crop(asset, bbox, epsg)
+    out_image, out_meta = crop_bands(item, bands, bbox, epsg)
 
-        cropped_assets[band] = out_image[0]
+    cropped_assets = dict(zip(bands, out_image))
+    scale_offsets = dict(zip(bands, get_scale_offsets(item, bands)))
 
     # calculate the mean of the NDVI excluding NaN values
     logger.info("Calculating NDVI mean...")
     mean = np.nanmean(
-        normalized_difference(cropped_assets["nir08"], cropped_assets["red"])
+        normalized_difference(
+            cropped_assets["nir08"],
+            cropped_assets["red"],
+            out=cropped_assets["nir08"],
+            nodata=out_meta["nodata"],
+            scale_offsets=[scale_offsets["nir08"], scale_offsets["red"]],
+        )
     )
 
     sys.stdout.write(str(mean))
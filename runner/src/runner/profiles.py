@@ -0,0 +1,46 @@
+"""The output profiles and encodings of the runner commands
+
+The module imports neither rasterio nor numpy, the commands list its names
+in their options without loading the geospatial stack, see runner.functions.
+"""
+
+OUTPUT_PROFILES = {
+    "lzw": {"compress": "lzw"},
+    "deflate": {"compress": "deflate", "predictor": "YES", "level": 6},
+    "zstd": {"compress": "zstd", "predictor": "YES", "level": 9},
+    "lerc": {"compress": "lerc_zstd", "max_z_error": 0},
+    "fast": {"compress": "zstd", "predictor": "YES", "level": 1, "overviews": "NONE"},
+}
+"""The codec and overviews of each output profile, see runner.functions.output_profile"""
+
+DEFAULT_OUTPUT_PROFILE = "lzw"
+
+MASK_ENCODINGS = {
+    "uint8": {},
+    "nbits": {"nbits": 1, "predictor": "NO"},
+    "deflate": {"compress": "deflate", "predictor": "YES", "level": 6},
+}
+"""The creation options of each water mask encoding, on top of the output profile"""
+
+DEFAULT_MASK_ENCODING = "uint8"
+
+INDEX_ENCODINGS = {
+    "float32": {
+        "dtype": "float32",
+        "nodata": float("nan"),
+        "scale": 1.0,
+        "offset": 0.0,
+    },
+    "float16": {
+        "dtype": "float32",
+        "nbits": 16,
+        "nodata": float("nan"),
+        "scale": 1.0,
+        "offset": 0.0,
+    },
+    "int16": {"dtype": "int16", "nodata": -32768, "scale": 1e-4, "offset": 0.0},
+    "uint8": {"dtype": "uint8", "nodata": 255, "scale": 1 / 127, "offset": -1.0},
+}
+"""The data type, nodata, scale and offset of each normalized difference index encoding"""
+
+DEFAULT_INDEX_ENCODING = "int16"
@@ -19,6 +19,71 @@ from io import StringIO
 from click.testing import CliRunner
 from eoap_cwlwrap import wrap
 from pathlib import Path
+from datetime import datetime
+import numpy as np
+import pystac
+import rasterio
+from rasterio.transform import from_origin
+
+
+def create_item(
+    directory,
+    bands=("red", "green", "nir08"),
+    shape=(200, 300),
+    item_id="synthetic-item",
+):
+    """Creates a Landsat-like STAC Item with one synthetic uint16 asset per band"""
+    transform = from_origin(300000, 4300000, 30, 30)
+
+    item = pystac.Item(
+        id=item_id,
+        geometry=None,
+        bbox=None,
+        datetime=datetime(2023, 10, 15),
+        properties={},
+    )
+
+    rng = np.random.default_rng(42)
+
+    for index, band in enumerate(bands):
+        href = os.path.join(directory, f"{band}.tif")
+        data = rng.integers(7000, 20000, size=shape, dtype=np.uint16)
+        data[: shape[0] // 2] //= index + 1
+
+        with rasterio.open(
+            href,
+            "w",
+            driver="GTiff",
+            dtype="uint16",
+            count=1,
+            height=shape[0],
+            width=shape[1],
+            crs="EPSG:32611",
+            transform=transform,
+            nodata=0,
+            tiled=True,
+            blockxsize=64,
+            blockysize=64,
+        ) as dst:
+            dst.write(data, 1)
+
+        item.add_asset(
+            band,
+            pystac.Asset(
+                href=href,
+                media_type=pystac.MediaType.COG,
+                roles=["data"],
+                extra_fields={
+                    "eo:bands": [{"name": band, "common_name": band}],
+                    "raster:bands": [{"nodata": 0, "scale": 2.75e-05, "offset": -0.2}],
+                },
+            ),
+        )
+
+    item.set_self_href(os.path.join(directory, "item.json"))
+    item.save_object(include_self_link=False)
+
+    return item
 
 
 class TestCWL(unittest.TestCase):
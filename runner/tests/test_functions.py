@@ -0,0 +1,852 @@
+import datetime
+import itertools
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pystac
+import rasterio
+import rasterio.mask
+from pyproj import Transformer
+from rasterio.transform import from_origin
+from shapely import box
+from skimage.filters import threshold_otsu
+
+from runner.functions import (
+    INDEX_ENCODINGS,
+    INDEX_EXPRESSIONS,
+    MASK_ENCODINGS,
+    OUTPUT_PROFILES,
+    BandStatistics,
+    aoi_window,
+    check_index_encoding,
+    index_encodings,
+    crop,
+    crop_bands,
+    compile_expression,
+    create_output_item,
+    encode_index,
+    evaluate_indices,
+    get_asset,
+    get_scale_offset,
+    get_scale_offsets,
+    get_transformer,
+    index_bands,
+    index_profile,
+    index_scale_offset,
+    is_normalized_difference,
+    map_items,
+    mask_profile,
+    matching_windows,
+    normalized_difference,
+    open_output,
+    otsu_threshold,
+    output_profile,
+    parse_index,
+    raster_band,
+    threshold,
+    transform_bbox,
+    write_indices,
+)
+from tests.helpers import create_item
+
+
+def output_threads(item_url):
+    """Returns the compression threads of the outputs of a map_items worker"""
+    return output_profile()["num_threads"]
+
+
+class TestFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.raster = os.path.join(self.tmp_dir, "band.tif")
+
+        self.data = np.arange(200 * 300, dtype=np.uint16).reshape(1, 200, 300)
+
+        profile = {
+            "driver": "GTiff",
+            "dtype": "uint16",
+            "count": 1,
+            "height": 200,
+            "width": 300,
+            "crs": "EPSG:32611",
+            "transform": from_origin(300000, 4300000, 30, 30),
+            "nodata": 0,
+        }
+
+        with rasterio.open(self.raster, "w", **profile) as dst:
+            dst.write(self.data)
+
+        self.asset = pystac.Asset(href=self.raster)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _bbox(self, minx, miny, maxx, maxy):
+        transformer = Transformer.from_crs("EPSG:32611", "EPSG:4326", always_xy=True)
+        lon_min, lat_min = transformer.transform(minx, miny)
+        lon_max, lat_max = transformer.transform(maxx, maxy)
+        return [lon_min, lat_min, lon_max, lat_max]
+
+    def test_aoi_window(self):
+        with rasterio.open(self.raster) as src:
+            window = aoi_window(src, (300300, 4298500, 301500, 4299700))
+
+        self.assertEqual(
+            (window.col_off, window.row_off, window.width, window.height),
+            (10, 10, 40, 40),
+        )
+
+    def test_aoi_window_no_overlap(self):
+        with rasterio.open(self.raster) as src:
+            with self.assertRaises(ValueError):
+                aoi_window(src, (0, 0, 10, 10))
+
+    def test_get_transformer_cached(self):
+        self.assertIs(
+            get_transformer("EPSG:4326", "EPSG:32611"),
+            get_transformer("EPSG:4326", "EPSG:32611"),
+        )
+
+    def test_transform_bbox_covers_edges(self):
+        bbox = (-118.985, 38.432, -118.183, 38.938)
+
+        minx, miny, maxx, maxy = transform_bbox(bbox, "EPSG:4326", "EPSG:32611")
+
+        transformer = Transformer.from_crs("EPSG:4326", "EPSG:32611", always_xy=True)
+        for lon in (bbox[0], bbox[2]):
+            for lat in (bbox[1], bbox[3]):
+                x, y = transformer.transform(lon, lat)
+                self.assertTrue(minx <= x <= maxx)
+                self.assertTrue(miny <= y <= maxy)
+
+        for lon, lat in [
+            ((bbox[0] + bbox[2]) / 2, bbox[1]),
+            ((bbox[0] + bbox[2]) / 2, bbox[3]),
+            (bbox[0], (bbox[1] + bbox[3]) / 2),
+            (bbox[2], (bbox[1] + bbox[3]) / 2),
+        ]:
+            x, y = transformer.transform(lon, lat)
+            self.assertTrue(minx <= x <= maxx)
+            self.assertTrue(miny <= y <= maxy)
+
+    def test_crop_matches_mask(self):
+        bbox = self._bbox(300310, 4298510, 301490, 4299690)
+
+        out_image, out_meta = crop(self.asset, bbox, "EPSG:4326")
+
+        self.assertEqual(out_image.dtype, np.float32)
+        self.assertEqual(out_image.shape, (1, out_meta["height"], out_meta["width"]))
+
+        with rasterio.open(self.raster) as src:
+            minx, miny, maxx, maxy = transform_bbox(tuple(bbox), "EPSG:4326", src.crs)
+            expected, expected_transform = rasterio.mask.mask(
+                src, [box(minx, miny, maxx, maxy)], crop=True
+            )
+
+        # the masked crop pads the edges with nodata, the windowed read does not
+        row_off = round((expected_transform.f - out_meta["transform"].f) / 30)
+        col_off = round((out_meta["transform"].c - expected_transform.c) / 30)
+        inner = expected[
+            :,
+            row_off : row_off + out_meta["height"],
+            col_off : col_off + out_meta["width"],
+        ]
+
+        np.testing.assert_array_equal(out_image, inner.astype(np.float32))
+        self.assertEqual((expected > 0).sum(), out_image.size)
+
+    def test_crop_bands(self):
+        item = create_item(self.tmp_dir)
+        bbox = self._bbox(300310, 4298510, 301490, 4299690)
+
+        out_image, out_meta = crop_bands(item, ["nir08", "red"], bbox, "EPSG:4326")
+
+        self.assertEqual(out_image.shape, (2, out_meta["height"], out_meta["width"]))
+
+        for index, band in enumerate(["nir08", "red"]):
+            expected, expected_meta = crop(get_asset(item, band), bbox, "EPSG:4326")
+            np.testing.assert_array_equal(out_image[index], expected[0])
+            self.assertEqual(out_meta["transform"], expected_meta["transform"])
+
+    def test_crop_bands_missing_band(self):
+        item = create_item(self.tmp_dir, bands=["red"])
+
+        with self.assertRaises(ValueError):
+            crop_bands(item, ["red", "swir16"], [0, 0, 1, 1], "EPSG:4326")
+
+    def _ndwi(self):
+        rng = np.random.default_rng(0)
+        data = np.concatenate(
+            [rng.normal(-0.4, 0.1, 60000), rng.normal(0.3, 0.1, 40000)]
+        ).astype(np.float32)
+        data[::97] = np.nan
+        return np.clip(data, -1, 1).reshape(250, 400)
+
+    def test_threshold_matches_skimage(self):
+        data = self._ndwi()
+
+        expected = data > threshold_otsu(data[np.isfinite(data)])
+
+        np.testing.assert_array_equal(threshold(data), expected)
+
+    def test_otsu_threshold_blocks(self):
+        data = self._ndwi()
+
+        in_memory = otsu_threshold(data, bins=1024)
+        streamed = otsu_threshold(
+            (data[row : row + 64] for row in range(0, data.shape[0], 64)), bins=1024
+        )
+
+        self.assertEqual(in_memory, streamed)
+        self.assertAlmostEqual(
+            in_memory, threshold_otsu(data[np.isfinite(data)]), delta=2 / 256
+        )
+
+    def test_otsu_threshold_no_values(self):
+        with self.assertRaises(ValueError):
+            otsu_threshold(np.full((4, 4), np.nan, dtype=np.float32))
+
+    def test_matching_windows(self):
+        tiled = os.path.join(self.tmp_dir, "tiled.tif")
+
+        with rasterio.open(self.raster) as src:
+            profile = src.profile
+            profile.update({"tiled": True, "blockxsize": 64, "blockysize": 48})
+
+            with rasterio.open(tiled, "w", **profile) as dst:
+                dst.write(self.data)
+
+        with rasterio.open(self.raster) as src1, rasterio.open(tiled) as src2:
+            coverage = np.zeros((src1.height, src1.width), dtype=np.uint8)
+
+            for window in matching_windows(src1, src2):
+                coverage[window.toslices()] += 1
+
+                for src in (src1, src2):
+                    block_y, block_x = src.block_shapes[0]
+                    self.assertEqual(
+                        window.row_off // block_y,
+                        (window.row_off + window.height - 1) // block_y,
+                    )
+                    self.assertEqual(
+                        window.col_off // block_x,
+                        (window.col_off + window.width - 1) // block_x,
+                    )
+
+        self.assertTrue((coverage == 1).all())
+
+    def test_normalized_difference(self):
+        rng = np.random.default_rng(1)
+        array1 = rng.integers(0, 30000, size=(50, 60), dtype=np.uint16)
+        array2 = rng.integers(0, 30000, size=(50, 60), dtype=np.uint16)
+        array1[0, :5] = 0
+        array2[0, :3] = 0
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            a, b = array1.astype(np.float64), array2.astype(np.float64)
+            expected = (a - b) / (a + b)
+
+        result = normalized_difference(array1, array2)
+
+        self.assertEqual(result.dtype, np.float32)
+        np.testing.assert_allclose(result, expected, atol=1e-6)
+
+        result = normalized_difference(array1, array2, nodata=0)
+
+        self.assertTrue(np.isnan(result[0, :5]).all())
+        np.testing.assert_allclose(result[1:], expected[1:], atol=1e-6)
+
+    def test_normalized_difference_out(self):
+        array1 = np.array([[0.2, 0.0], [0.5, 0.1]], dtype=np.float32)
+        array2 = np.array([[0.1, 0.0], [0.5, 0.3]], dtype=np.float32)
+        expected = normalized_difference(array1, array2)
+        mask = np.array([[False, False], [False, True]])
+
+        result = normalized_difference(array1, array2, out=array1, nodata=mask)
+
+        self.assertIs(result, array1)
+        np.testing.assert_allclose(result[0, 0], 1 / 3, rtol=1e-6)
+        self.assertTrue(np.isnan(result[0, 1]))
+        self.assertEqual(result[1, 0], 0)
+        self.assertTrue(np.isnan(result[1, 1]))
+        self.assertFalse(np.isnan(expected[1, 1]))
+
+    def test_normalized_difference_scale_offsets(self):
+        rng = np.random.default_rng(2)
+        array1 = rng.integers(7000, 30000, size=(300, 301), dtype=np.uint16)
+        array2 = rng.integers(7000, 30000, size=(300, 301), dtype=np.uint16)
+        scale_offsets = [(2.75e-05, -0.2), (2.75e-05, -0.2)]
+
+        reflectance1 = array1 * 2.75e-05 - 0.2
+        reflectance2 = array2 * 2.75e-05 - 0.2
+        expected = (reflectance1 - reflectance2) / (reflectance1 + reflectance2)
+        self.assertGreater(np.abs(expected).max(), 1)
+        expected = np.clip(expected, -1, 1)
+
+        result = normalized_difference(
+            array1, array2, scale_offsets=scale_offsets, chunk_size=1000
+        )
+
+        self.assertFalse(np.isnan(result).any())
+        np.testing.assert_allclose(result, expected, rtol=1e-3, atol=1e-4)
+
+    def test_threshold_scaled_reflectance(self):
+        item = create_item(self.tmp_dir)
+        bands = ["green", "nir08"]
+        arrays = []
+        for band in bands:
+            with rasterio.open(get_asset(item, band).href) as src:
+                arrays.append(src.read(1))
+        green, nir08 = arrays
+
+        # open water: positive green, slightly negative NIR reflectance
+        green[0, :3] = [8500, 9000, 8000]
+        nir08[0, :3] = [7200, 7100, 7250]
+
+        nd = normalized_difference(
+            green, nir08, nodata=0, scale_offsets=get_scale_offsets(item, bands)
+        )
+
+        reflectance = [green * 2.75e-05 - 0.2, nir08 * 2.75e-05 - 0.2]
+        expected = (reflectance[0] - reflectance[1]) / (reflectance[0] + reflectance[1])
+
+        # a single pixel with a near-zero sum used to flood the Otsu histogram
+        self.assertGreater(np.abs(expected).max(), 1000)
+        self.assertFalse(np.isnan(nd).any())
+        np.testing.assert_allclose(nd, np.clip(expected, -1, 1), atol=1e-4)
+        np.testing.assert_array_equal(nd[0, :3], [1, 1, 1])
+
+        water = threshold(nd)
+
+        self.assertTrue(water[0, :3].all())
+        self.assertAlmostEqual(water.mean(), 0.531, delta=0.01)
+        self.assertEqual(
+            water.mean(),
+            (nd > threshold_otsu(nd)).mean(),
+        )
+
+    def test_crop_bands_native_dtype(self):
+        item = create_item(self.tmp_dir)
+        bbox = self._bbox(300310, 4298510, 301490, 4299690)
+
+        native, native_meta = crop_bands(
+            item, ["green", "nir08"], bbox, "EPSG:4326", native_dtype=True
+        )
+        promoted, _ = crop_bands(item, ["green", "nir08"], bbox, "EPSG:4326")
+
+        self.assertEqual(native.dtype, np.uint16)
+        self.assertEqual(native_meta["dtype"], "uint16")
+        np.testing.assert_array_equal(native.astype(np.float32), promoted)
+
+        self.assertEqual(
+            get_scale_offsets(item, ["green", "nir08"]),
+            [(2.75e-05, -0.2), (2.75e-05, -0.2)],
+        )
+        self.assertEqual(get_scale_offset(self.asset), (1.0, 0.0))
+
+    def test_open_output(self):
+        path = os.path.join(self.tmp_dir, "item", "output.tif")
+
+        with rasterio.open(self.raster) as src:
+            profile = src.profile
+        profile.update({"driver": "COG", "compress": "lzw"})
+
+        with open_output(path, **profile) as dst:
+            # nothing is written at the final location until the raster is closed
+            self.assertFalse(os.path.exists(path))
+            dst.write(self.data)
+
+        self.assertEqual(os.listdir(os.path.dirname(path)), ["output.tif"])
+        with rasterio.open(path) as src:
+            np.testing.assert_array_equal(src.read(), self.data)
+
+    def test_open_output_streaming(self):
+        path = os.path.join(self.tmp_dir, "item", "output.tif")
+
+        with rasterio.open(self.raster) as src:
+            profile = src.profile
+        profile.update(output_profile("zstd"))
+
+        with open_output(path, streaming=True, **profile) as dst:
+            self.assertEqual(dst.driver, "GTiff")
+            for _, window in dst.block_windows(1):
+                dst.write(self.data[0][window.toslices()], 1, window=window)
+
+        self.assertEqual(os.listdir(os.path.dirname(path)), ["output.tif"])
+        with rasterio.open(path) as src:
+            self.assertEqual(src.tags(ns="IMAGE_STRUCTURE")["LAYOUT"], "COG")
+            np.testing.assert_array_equal(src.read(), self.data)
+
+    def test_output_profiles(self):
+        data = self.data.astype("float32") / 1000
+        data[:, :128] = 0
+
+        for name in OUTPUT_PROFILES:
+            path = os.path.join(self.tmp_dir, f"{name}.tif")
+
+            with rasterio.open(self.raster) as src:
+                profile = src.profile
+            profile.update(output_profile(name), dtype="float32")
+
+            with open_output(path, **profile) as dst:
+                dst.write(data)
+
+            with rasterio.open(path) as src:
+                # every profile is lossless and tiles 256x256
+                np.testing.assert_array_equal(src.read(), data)
+                self.assertEqual(src.block_shapes, [(256, 256)])
+                self.assertEqual(
+                    src.compression.name.lower(), OUTPUT_PROFILES[name]["compress"]
+                )
+                self.assertEqual(src.overviews(1), [] if name == "fast" else [2])
+
+    def test_output_profile_workers(self):
+        self.assertEqual(output_profile()["num_threads"], "ALL_CPUS")
+
+        with mock.patch("os.cpu_count", return_value=8):
+            self.assertEqual(
+                map_items(output_threads, ["a", "b", "c"], workers=3), [2, 2, 2]
+            )
+            self.assertEqual(map_items(output_threads, ["a", "b"], workers=16), [1, 1])
+
+        self.assertEqual(output_profile()["num_threads"], "ALL_CPUS")
+
+    def test_output_profile_categorical(self):
+        self.assertEqual(output_profile()["overview_resampling"], "AVERAGE")
+        self.assertEqual(
+            output_profile("zstd", categorical=True)["overview_resampling"], "NEAREST"
+        )
+
+    def test_mask_encodings(self):
+        mask = (self.data % 7 == 0).astype("uint8")
+
+        for name in OUTPUT_PROFILES:
+            for encoding in MASK_ENCODINGS:
+                path = os.path.join(self.tmp_dir, f"{name}-{encoding}.tif")
+
+                with rasterio.open(self.raster) as src:
+                    profile = src.profile
+                profile.update(mask_profile(name, encoding), dtype="uint8")
+
+                with open_output(path, streaming=True, **profile) as dst:
+                    dst.write(mask)
+
+                with rasterio.open(path) as src:
+                    np.testing.assert_array_equal(src.read(), mask)
+                    self.assertEqual(src.dtypes, ("uint8",))
+                    self.assertEqual(
+                        src.tags(1, ns="IMAGE_STRUCTURE").get("NBITS"),
+                        "1" if encoding == "nbits" else None,
+                    )
+
+    def test_mask_raster_band(self):
+        with rasterio.open(self.raster) as src:
+            meta = src.meta.copy()
+        meta.update(mask_profile("zstd", "nbits"), dtype="uint8")
+
+        statistics = BandStatistics(nodata=meta["nodata"])
+        statistics.update(np.array([[0, 1], [1, 1]], dtype="uint8"))
+
+        band = (
+            create_output_item(
+                "mask",
+                "otsu.tif",
+                meta,
+                [statistics],
+                datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc),
+            )
+            .assets["data"]
+            .extra_fields["raster:bands"][0]
+        )
+
+        self.assertEqual((band["data_type"], band["bits_per_sample"]), ("uint8", 1))
+        self.assertEqual(band["statistics"]["valid_percent"], 75.0)
+        self.assertNotIn("bits_per_sample", raster_band({"dtype": "uint8"}, statistics))
+
+    def test_encode_index(self):
+        index = np.linspace(-1.2, 1.2, 2401, dtype=np.float32)
+        index[0] = np.nan
+
+        for encoding, step in [
+            ("float32", 0),
+            ("float16", 2**-10),
+            ("int16", 1e-4),
+            ("uint8", 1 / 127),
+        ]:
+            encoded = encode_index(index.copy(), encoding)
+            profile = index_profile("lzw", encoding)
+            scale, offset = index_scale_offset(encoding)
+
+            self.assertEqual(encoded.dtype, profile["dtype"])
+
+            if np.isnan(profile["nodata"]):
+                self.assertTrue(np.isnan(encoded[0]))
+                expected = index[1:]
+            else:
+                self.assertEqual(encoded[0], profile["nodata"])
+                self.assertNotIn(profile["nodata"], encoded[1:])
+                expected = np.clip(index[1:], -1, 1)
+
+            decoded = encoded[1:] * scale + offset
+            self.assertLessEqual(np.abs(decoded - expected).max(), step / 2 + 1e-6)
+
+    def test_encode_index_output(self):
+        index = np.array([[np.nan, -1.0], [0.0, 1.0]], dtype=np.float32)
+
+        for name, encoding in itertools.product(["zstd", "lerc"], INDEX_ENCODINGS):
+            path = os.path.join(self.tmp_dir, f"{name}-{encoding}.tif")
+
+            with rasterio.open(self.raster) as src:
+                profile = src.profile
+            profile.update(index_profile(name, encoding), width=2, height=2)
+
+            with open_output(path, **profile) as dst:
+                dst.write(encode_index(index.copy(), encoding), 1)
+                dst.scales = (index_scale_offset(encoding)[0],)
+                dst.offsets = (index_scale_offset(encoding)[1],)
+
+            with rasterio.open(path) as src:
+                data = src.read(1, masked=True)
+                np.testing.assert_allclose(
+                    data * src.scales[0] + src.offsets[0],
+                    np.ma.masked_invalid(index),
+                    atol=1e-6,
+                )
+                self.assertTrue(data.mask[0, 0])
+
+    def test_compile_expression(self):
+        code, bands = compile_expression("(nir08 - red) / (nir08 + red) * 2.5")
+
+        self.assertEqual(bands, ["nir08", "red"])
+        self.assertEqual(eval(code, {}, {"nir08": 3.0, "red": 1.0}), 1.25)
+
+        for expression in [
+            "__import__('os')",
+            "red.__class__",
+            "red[0]",
+            "'red'",
+            "red if nir08 else green",
+            "True * red",
+            "(red",
+        ]:
+            with self.assertRaises(ValueError):
+                compile_expression(expression)
+
+    def test_parse_index(self):
+        self.assertEqual(parse_index("NDVI"), ("ndvi", INDEX_EXPRESSIONS["ndvi"]))
+        self.assertEqual(parse_index("ratio=nir08 / red"), ("ratio", "nir08 / red"))
+        self.assertEqual(
+            index_bands(INDEX_EXPRESSIONS.values()),
+            ["green", "nir08", "red", "swir16"],
+        )
+
+        with self.assertRaises(ValueError):
+            parse_index("evi")
+
+        with self.assertRaises(ValueError):
+            parse_index("ratio=open(red)")
+
+        for value in ["../x=red", "a/b=red", "=red", "1x=red"]:
+            with self.assertRaises(ValueError):
+                parse_index(value)
+
+    def test_check_index_encoding(self):
+        normalized = [*INDEX_EXPRESSIONS.values(), "(red * 2 - 1) / (1 + red * 2)"]
+        for encoding in INDEX_ENCODINGS:
+            check_index_encoding(normalized, encoding)
+
+        for expression in ["nir08 / red", "nir08", "(nir08 - red) / (nir08 + green)"]:
+            self.assertFalse(is_normalized_difference(expression))
+
+            for encoding in ["float32", "float16"]:
+                check_index_encoding([expression], encoding)
+
+            for encoding in ["int16", "uint8"]:
+                with self.assertRaises(ValueError):
+                    check_index_encoding([expression], encoding)
+
+    def test_index_encodings(self):
+        expressions = dict(map(parse_index, ["ndvi", "ratio=nir08/red"]))
+
+        self.assertEqual(
+            index_encodings(expressions), {"ndvi": "int16", "ratio": "float32"}
+        )
+        self.assertEqual(
+            index_encodings(expressions, "float16"),
+            {"ndvi": "float16", "ratio": "float16"},
+        )
+
+        with self.assertRaises(ValueError):
+            index_encodings(expressions, "uint8")
+
+    def _bands(self):
+        rng = np.random.default_rng(2)
+        bands = {
+            band: rng.integers(0, 30000, size=(70, 40), dtype=np.uint16)
+            for band in ["green", "nir08", "red", "swir16"]
+        }
+        bands["red"][0, :5] = 0
+        scale_offsets = {band: (2.75e-05, -0.2) for band in bands}
+
+        return bands, scale_offsets
+
+    def test_evaluate_indices(self):
+        bands, scale_offsets = self._bands()
+        expressions = dict(map(parse_index, INDEX_EXPRESSIONS))
+
+        indices = {name: np.empty((70, 40), dtype=np.float32) for name in expressions}
+        rows = []
+        for window, blocks in evaluate_indices(
+            bands, expressions, nodata=0, scale_offsets=scale_offsets, block_size=32
+        ):
+            rows.append(window.height)
+            for name, block in blocks.items():
+                self.assertEqual(block.dtype, np.float32)
+                indices[name][window.toslices()] = block
+
+        self.assertEqual(rows, [32, 32, 6])
+
+        for name, (band1, band2) in {
+            "ndvi": ("nir08", "red"),
+            "ndwi": ("green", "nir08"),
+            "mndwi": ("green", "swir16"),
+            "ndbi": ("swir16", "nir08"),
+        }.items():
+            scale, offset = scale_offsets[band1]
+            reflectance1 = (bands[band1] * scale + offset).astype(np.float32)
+            reflectance2 = (bands[band2] * scale + offset).astype(np.float32)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                expected = (reflectance1 - reflectance2) / (reflectance1 + reflectance2)
+            expected = np.clip(expected, -1, 1)
+            expected[(bands[band1] == 0) | (bands[band2] == 0)] = np.nan
+
+            self.assertEqual(np.nanmax(np.abs(indices[name])), 1)
+            np.testing.assert_allclose(indices[name], expected, atol=1e-5)
+
+        self.assertTrue(np.isnan(indices["ndvi"][0, :5]).all())
+        self.assertTrue(np.isfinite(indices["ndwi"][0, :5]).any())
+
+    def test_evaluate_indices_missing_band(self):
+        bands, _ = self._bands()
+
+        with self.assertRaises(ValueError):
+            next(
+                evaluate_indices(bands, {"nbr": "(nir08 - swir22) / (nir08 + swir22)"})
+            )
+
+    def test_write_indices(self):
+        bands, scale_offsets = self._bands()
+        expressions = dict(
+            map(parse_index, ["ndvi", "ndwi", "gnd=(nir08 - green) / (green + nir08)"])
+        )
+        paths = {
+            name: os.path.join(self.tmp_dir, name, f"{name}.tif")
+            for name in expressions
+        }
+
+        with rasterio.open(self.raster) as src:
+            profile = src.profile
+        profile.update(index_profile("zstd", "int16"), width=40, height=70)
+
+        statistics = write_indices(
+            paths,
+            bands,
+            expressions,
+            {name: profile for name in expressions},
+            {name: "int16" for name in expressions},
+            nodata=0,
+            scale_offsets=scale_offsets,
+        )
+
+        self.assertEqual(list(statistics), list(expressions))
+
+        for name, blocks in zip(
+            expressions,
+            zip(
+                *(
+                    blocks.values()
+                    for _, blocks in evaluate_indices(
+                        bands, expressions, nodata=0, scale_offsets=scale_offsets
+                    )
+                )
+            ),
+        ):
+            expected = encode_index(np.vstack(blocks), "int16")
+
+            with rasterio.open(paths[name]) as src:
+                data = src.read(1)
+                self.assertEqual(src.scales[0], 1e-4)
+
+            np.testing.assert_array_equal(data, expected)
+            self.assertEqual(
+                statistics[name].to_dict()["statistics"]["valid_percent"],
+                100 * np.mean(expected != profile["nodata"]),
+            )
+
+    def test_write_indices_bare_band(self):
+        rng = np.random.default_rng(3)
+        bands = {
+            band: rng.integers(0, 30000, size=(600, 40), dtype=np.uint16)
+            for band in ["nir08", "red"]
+        }
+        expressions = dict(map(parse_index, ["nir=nir08", "ndvi"]))
+        paths = {
+            name: os.path.join(self.tmp_dir, name, f"{name}.tif")
+            for name in expressions
+        }
+
+        with rasterio.open(self.raster) as src:
+            profile = src.profile
+        profile.update(width=40, height=600)
+
+        encodings = index_encodings(expressions)
+        self.assertEqual(encodings, {"nir": "float32", "ndvi": "int16"})
+
+        write_indices(
+            paths,
+            bands,
+            expressions,
+            {
+                name: {**profile, **index_profile("lzw", encoding)}
+                for name, encoding in encodings.items()
+            },
+            encodings,
+            nodata=0,
+            scale_offsets={"nir08": (1e-4, 0.0), "red": (1e-4, 0.0)},
+        )
+
+        expected = bands["nir08"] * 1e-4
+        expected[bands["nir08"] == 0] = np.nan
+
+        with rasterio.open(paths["nir"]) as src:
+            np.testing.assert_allclose(src.read(1), expected, rtol=1e-6)
+
+        with rasterio.open(paths["ndvi"]) as src:
+            np.testing.assert_allclose(
+                src.read(1),
+                encode_index(
+                    normalized_difference(bands["nir08"], bands["red"], nodata=0),
+                    "int16",
+                ),
+                atol=1,
+            )
+
+    def test_write_indices_failure(self):
+        bands, _ = self._bands()
+        paths = {"ndvi": os.path.join(self.tmp_dir, "ndvi", "ndvi.tif")}
+
+        with rasterio.open(self.raster) as src:
+            profile = src.profile
+        profile.update(index_profile("lzw", "int16"), width=40, height=70)
+
+        with self.assertRaises(ValueError):
+            write_indices(
+                paths,
+                bands,
+                {"ndvi": "(nir08 - swir22) / (nir08 + swir22)"},
+                {"ndvi": profile},
+                {"ndvi": "int16"},
+            )
+
+        self.assertEqual(os.listdir(os.path.dirname(paths["ndvi"])), [])
+
+    def test_open_output_failure(self):
+        path = os.path.join(self.tmp_dir, "item", "output.tif")
+
+        with self.assertRaises(ValueError):
+            with open_output(
+                path, driver="GTiff", dtype="uint8", count=1, width=1, height=1
+            ):
+                raise ValueError("failed write")
+
+        self.assertEqual(os.listdir(os.path.dirname(path)), [])
+
+    def test_band_statistics(self):
+        data = np.random.default_rng(0).normal(size=(200, 300)).astype("float32")
+        data[:10] = -9999
+        data[10, :5] = np.nan
+
+        statistics = BandStatistics(nodata=-9999)
+        statistics.update(data)
+
+        values = data[np.isfinite(data) & (data != -9999)]
+        buckets, edges = np.histogram(values, bins=10)
+
+        self.assertEqual(
+            statistics.to_dict(),
+            {
+                "statistics": {
+                    "mean": float(values.mean(dtype="float64")),
+                    "minimum": float(values.min()),
+                    "maximum": float(values.max()),
+                    "stddev": float(values.std(dtype="float64")),
+                    "valid_percent": values.size / data.size * 100,
+                },
+                "histogram": {
+                    "count": 11,
+                    "min": float(edges[0]),
+                    "max": float(edges[-1]),
+                    "buckets": buckets.tolist(),
+                },
+            },
+        )
+
+    def test_band_statistics_blocks(self):
+        data = np.random.default_rng(0).uniform(-1, 1, size=(200, 300))
+
+        whole = BandStatistics(value_range=(-1, 1))
+        whole.update(data)
+
+        blocks = BandStatistics(value_range=(-1, 1))
+        for rows in np.array_split(data, 7):
+            blocks.update(rows)
+
+        expected, actual = whole.to_dict(), blocks.to_dict()
+        self.assertEqual(actual["histogram"], expected["histogram"])
+        for key, value in expected["statistics"].items():
+            self.assertAlmostEqual(actual["statistics"][key], value)
+
+    def test_band_statistics_no_values(self):
+        statistics = BandStatistics(nodata=0)
+        statistics.update(np.zeros((4, 4), dtype="uint8"))
+
+        self.assertEqual(statistics.to_dict(), {"statistics": {"valid_percent": 0.0}})
+
+    def test_create_output_item(self):
+        with rasterio.open(self.raster) as src:
+            meta = src.meta.copy()
+
+        statistics = BandStatistics(nodata=meta["nodata"])
+        statistics.update(self.data[0])
+
+        item = create_output_item(
+            "output",
+            "band.tif",
+            meta,
+            [statistics],
+            datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc),
+            scales=[2.75e-05],
+            offsets=[-0.2],
+        )
+
+        self.assertEqual(item.properties["proj:epsg"], 32611)
+        self.assertEqual(item.properties["proj:shape"], [200, 300])
+        self.assertEqual(
+            item.properties["proj:bbox"], [300000.0, 4294000.0, 309000.0, 4300000.0]
+        )
+        np.testing.assert_allclose(
+            item.bbox, self._bbox(300000, 4294000, 309000, 4300000), atol=1e-2
+        )
+
+        band = item.assets["data"].extra_fields["raster:bands"][0]
+        self.assertEqual(
+            (band["data_type"], band["nodata"], band["scale"], band["offset"]),
+            ("uint16", 0.0, 2.75e-05, -0.2),
+        )
+        self.assertEqual(band["statistics"]["maximum"], 200 * 300 - 1)
+        self.assertEqual(sum(band["histogram"]["buckets"]), 200 * 300 - 1)
@@ -0,0 +1,103 @@
+import filecmp
+import os
+import shutil
+import tempfile
+import unittest
+
+from click.testing import CliRunner
+from pyproj import Transformer
+
+from runner.app import app_group
+from tests.helpers import create_item
+
+
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.runner = CliRunner()
+
+        self.item_urls = []
+        for item_id in ["item-1", "item-2"]:
+            directory = os.path.join(self.tmp_dir, "inputs", item_id)
+            os.makedirs(directory)
+            item = create_item(directory, item_id=item_id)
+            self.item_urls.append(item.get_self_href())
+
+        transformer = Transformer.from_crs("EPSG:32611", "EPSG:4326", always_xy=True)
+        minx, miny = transformer.transform(300310, 4294510)
+        maxx, maxy = transformer.transform(308490, 4299690)
+        self.aoi = f"{minx},{miny},{maxx},{maxy}"
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _run(self, pattern, workers):
+        output_dir = os.path.join(self.tmp_dir, f"{pattern}-{workers}")
+        os.makedirs(output_dir)
+
+        cwd = os.getcwd()
+        os.chdir(output_dir)
+        try:
+            if pattern == "pattern-3":
+                inputs = ["--input-item", self.item_urls[0]]
+                inputs += ["--input-item", self.item_urls[1]]
+            else:
+                inputs = ["--input-item-1", self.item_urls[0]]
+                inputs += ["--input-item-2", self.item_urls[1]]
+
+            result = self.runner.invoke(
+                app_group,
+                [pattern]
+                + inputs
+                + [
+                    "--aoi",
+                    self.aoi,
+                    "--epsg",
+                    "EPSG:4326",
+                    "--band",
+                    "green",
+                    "--band",
+                    "nir08",
+                    "--workers",
+                    str(workers),
+                ],
+            )
+        finally:
+            os.chdir(cwd)
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        return output_dir
+
+    def _assert_same_output(self, pattern):
+        sequential = self._run(pattern, 1)
+        concurrent = self._run(pattern, 2)
+
+        self.assertEqual(sorted(os.listdir(sequential)), sorted(os.listdir(concurrent)))
+
+        for relative in [
+            "catalog.json",
+            "item-1/item-1.json",
+            "item-1/otsu.tif",
+            "item-2/item-2.json",
+            "item-2/otsu.tif",
+        ]:
+            self.assertTrue(
+                filecmp.cmp(
+                    os.path.join(sequential, relative),
+                    os.path.join(concurrent, relative),
+                    shallow=False,
+                ),
+                relative,
+            )
+
+        self.assertFalse(os.path.exists(os.path.join(concurrent, "otsu.tif")))
+
+    def test_pattern_2_workers(self):
+        self._assert_same_output("pattern-2")
+
+    def test_pattern_7_workers(self):
+        self._assert_same_output("pattern-7")
+
+    def test_pattern_3_batch(self):
+        self._assert_same_output("pattern-3")
@@ -1,7 +1,10 @@
+import importlib
+import subprocess
+import sys
 import unittest
 from click.testing import CliRunner
 
-from runner.app import app_group
+from runner.app import app_group, commands
 
 
 class TestCli(unittest.TestCase):
@@ -13,6 +16,84 @@ class TestCli(unittest.TestCase):
         self.assertEqual(result.exit_code, 0)
         self.assertIn("Usage: app [OPTIONS] COMMAND [ARGS]...", result.output)
 
+        for name, (_, _, short_help) in commands.items():
+            self.assertIn(name, result.output)
+            self.assertIn(short_help, result.output)
+
+    def test_lazy_commands(self):
+        for name, (module, attribute, short_help) in commands.items():
+            command = getattr(importlib.import_module(module), attribute)
+            self.assertEqual(command.name, name)
+            self.assertEqual(command.short_help, short_help)
+
+    def test_output_profile_option(self):
+        from runner.profiles import DEFAULT_OUTPUT_PROFILE, OUTPUT_PROFILES
+
+        for name, (module, attribute, _) in commands.items():
+            if name == "pattern-6":
+                continue
+
+            command = getattr(importlib.import_module(module), attribute)
+            (option,) = [param for param in command.params if param.name == "profile"]
+            self.assertEqual(list(option.type.choices), list(OUTPUT_PROFILES), name)
+            self.assertEqual(option.default, DEFAULT_OUTPUT_PROFILE, name)
+
+    def test_mask_encoding_option(self):
+        from runner.profiles import DEFAULT_MASK_ENCODING, MASK_ENCODINGS
+
+        for name in [
+            "pattern-1",
+            "pattern-2",
+            "pattern-3",
+            "pattern-7",
+            "pattern-8",
+            "pattern-11",
+            "otsu-cli",
+        ]:
+            module, attribute, _ = commands[name]
+            command = getattr(importlib.import_module(module), attribute)
+            (option,) = [
+                param for param in command.params if param.name == "mask_encoding"
+            ]
+            self.assertEqual(list(option.type.choices), list(MASK_ENCODINGS), name)
+            self.assertEqual(option.default, DEFAULT_MASK_ENCODING, name)
+
+    def test_index_encoding_option(self):
+        from runner.profiles import DEFAULT_INDEX_ENCODING, INDEX_ENCODINGS
+
+        for name in ["pattern-4", "pattern-5", "pattern-9", "pattern-10"]:
+            module, attribute, _ = commands[name]
+            command = getattr(importlib.import_module(module), attribute)
+            (option,) = [
+                param for param in command.params if param.name == "index_encoding"
+            ]
+            self.assertEqual(list(option.type.choices), list(INDEX_ENCODINGS), name)
+
+            # pattern-4 resolves the encoding of each index, see index_encodings
+            default = None if name == "pattern-4" else DEFAULT_INDEX_ENCODING
+            self.assertEqual(option.default, default, name)
+
+    def test_help_does_not_import_commands(self):
+        code = (
+            "import sys; from runner.app import app_group; "
+            "app_group(['--help'], standalone_mode=False); "
+            "print(sorted(m for m in ('rasterio', 'rio_stac', 'skimage') if m in sys.modules))"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        )
+        self.assertEqual(result.stdout.splitlines()[-1], "[]")
+
+    def test_early_exit_commands_do_not_import_rasterio(self):
+        code = (
+            "import sys; import runner.pattern_8, runner.pattern_9; "
+            "print(sorted(m for m in ('rasterio', 'rio_stac', 'skimage') if m in sys.modules))"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        )
+        self.assertEqual(result.stdout.splitlines()[-1], "[]")
+
     def test_pattern_1(self):
         result = self.runner.invoke(
             app_group,
@@ -0,0 +1,116 @@
+# Benchmark of the pooled keep-alive HTTP clients of stage-in
+#
+# Serves synthetic assets from a local aiohttp server and measures the
+# per-asset download latency and the number of TCP connections opened by the
+# stac_asset HTTP client on the pooled connector of stage_in.client, against
+# the same client on a connector forcing a new connection per request as the
+# former force_close monkeypatch did. Plain HTTP on localhost underestimates
+# the gain on TLS connections to a remote host.
+#
+# Usage: python benchmarks/bench_pooling.py [--assets 200] [--size 65536]
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import aiohttp
+import stac_asset
+from aiohttp import web
+
+from stage_in.client import create_clients, create_connector
+
+
+async def start_server(size):
+    """Starts an aiohttp server answering any path with size bytes"""
+    body = os.urandom(size)
+    connections = set()
+
+    async def handler(request):
+        connections.add(request.transport.get_extra_info("peername"))
+        return web.Response(body=body, content_type="image/tiff")
+
+    app = web.Application()
+    app.router.add_get("/{name}", handler)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+
+    port = site._server.sockets[0].getsockname()[1]
+
+    return runner, f"http://127.0.0.1:{port}", connections
+
+
+async def measure(connector, base_url, directory, assets, concurrency):
+    """Returns the per-asset latencies in seconds of the downloads of the assets"""
+    clients = create_clients(stac_asset.Config(), connector)
+    client = clients[0]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def download(index):
+        async with semaphore:
+            start = time.perf_counter()
+            await client.download_href(
+                f"{base_url}/asset-{index}.tif",
+                os.path.join(directory, f"asset-{index}.tif"),
+            )
+            return time.perf_counter() - start
+
+    try:
+        return await asyncio.gather(*[download(index) for index in range(assets)])
+    finally:
+        for client in clients:
+            await client.close()
+        await connector.close()
+
+
+async def run(assets, size):
+    runner, base_url, connections = await start_server(size)
+
+    print(f"{assets} assets of {size / 1024:.0f} KiB")
+    print(
+        f"{'connector':<12} {'concurrency':>11} {'connections':>11} "
+        f"{'median ms':>9} {'p95 ms':>8} {'total s':>8}"
+    )
+
+    try:
+        for concurrency in (1, 8):
+            for name, connector_factory in [
+                ("force_close", lambda: aiohttp.TCPConnector(force_close=True)),
+                ("pooled", create_connector),
+            ]:
+                connections.clear()
+
+                with tempfile.TemporaryDirectory() as directory:
+                    start = time.perf_counter()
+                    latencies = await measure(
+                        connector_factory(), base_url, directory, assets, concurrency
+                    )
+                    total = time.perf_counter() - start
+
+                latencies = sorted(latencies)
+                print(
+                    f"{name:<12} {concurrency:>11} {len(connections):>11} "
+                    f"{statistics.median(latencies) * 1000:>9.2f} "
+                    f"{latencies[int(len(latencies) * 0.95)] * 1000:>8.2f} "
+                    f"{total:>8.3f}"
+                )
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--assets", type=int, default=200)
+    parser.add_argument("--size", type=int, default=65536)
+    args = parser.parse_args()
+
+    asyncio.run(run(args.assets, args.size))
+
+
+if __name__ == "__main__":
+    main()
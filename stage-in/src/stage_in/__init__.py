@@ -1,3 +1,7 @@
 # SPDX-FileCopyrightText: 2025-present Fabrice Brito <fabrice.brito@terradue.com>
 #
 # SPDX-License-Identifier: MIT
+
+from stage_in.app import main, stage_item, stage_items
+
+__all__ = ["main", "stage_item", "stage_items"]
@@ -1,67 +1,552 @@
 import pystac
+import pystac.extensions.eo
 import stac_asset
 import asyncio
 import os
 import click
-from stac_asset import http_client
-import aiohttp
-import aiohttp
-from stac_asset import http_client
+import contextlib
+from loguru import logger
+from stac_asset.client import Clients
+from stage_in.client import (
+    DEFAULT_LIMIT,
+    DEFAULT_LIMIT_PER_HOST,
+    create_clients,
+    create_connector,
+    create_session,
+)
+from stage_in.cache import DEFAULT_MAX_SIZE, AssetCache, asset_version, cache_key
+from stage_in.clip import aoi2box, asset_file_name, clip_assets, is_raster
+from stage_in.download import download_assets
+from stage_in.segmented import DEFAULT_SEGMENT_THRESHOLD, DEFAULT_SEGMENTS
+from stage_in.scheduler import (
+    DEFAULT_CONCURRENCY,
+    ByteBudget,
+    asset_size,
+    gather_stream,
+    read_hrefs,
+)
+from stage_in.search import read_item, search_items
+from stage_in.throttle import Throttle
 
-import aiohttp
-from functools import wraps
+config = stac_asset.Config(warn=True)
 
-_original_init = aiohttp.TCPConnector.__init__
 
+def get_common_names(asset: pystac.Asset):
+    """Returns the common band names of an asset"""
+    eo_asset = pystac.extensions.eo.AssetEOExtension(asset)
 
-@wraps(_original_init)
-def _patched_init(self, *args, **kwargs):
-    kwargs["force_close"] = True
-    _original_init(self, *args, **kwargs)
+    return [
+        band.properties["common_name"]
+        for band in eo_asset.bands or []
+        if "common_name" in band.properties
+    ]
 
 
-aiohttp.TCPConnector.__init__ = _patched_init
+def select_assets(item: pystac.Item, asset_keys=(), common_names=(), roles=()):
+    """Returns the keys of the assets to stage
 
-config = stac_asset.Config(warn=True)
+    An asset is selected when its key is one of asset_keys or when one of its
+    bands has a common name in common_names, all the assets being selected when
+    neither is set. The selection is then restricted to the assets having at
+    least one of the roles.
+
+    Args:
+        item (pystac.Item): the STAC Item
+        asset_keys (list): the asset keys
+        common_names (list): the common band names
+        roles (list): the asset roles, e.g. data
+
+    Returns:
+        list: the selected asset keys
+    """
+    selected = []
+    for key, asset in item.get_assets().items():
+        if (asset_keys or common_names) and not (
+            key in asset_keys
+            or any(name in common_names for name in get_common_names(asset))
+        ):
+            continue
+
+        if roles and not any(role in roles for role in asset.roles or []):
+            continue
 
+        selected.append(key)
 
-async def main(href: str, output_dir: str):
-    item = pystac.read_file(href)
+    return selected
 
-    target_dir = os.path.join(output_dir, item.id)
+
+async def stage_item(
+    item: pystac.Item,
+    output_dir: str,
+    connector,
+    budget=None,
+    cache=None,
+    asset_keys=(),
+    common_names=(),
+    roles=(),
+    aoi=None,
+    epsg="EPSG:4326",
+    segment_threshold=DEFAULT_SEGMENT_THRESHOLD,
+    segments=DEFAULT_SEGMENTS,
+    verify_geotiff=False,
+    throttle=None,
+):
+    """Stages the selected assets of an item in output_dir/item.id
+
+    The HTTP assets are verified as they are downloaded, see
+    stage_in.download.download_assets.
+
+    Args:
+        item (pystac.Item): the STAC Item
+        output_dir (str): the directory of the staged items
+        connector (aiohttp.TCPConnector): the connection pool, see stage_in.client
+        budget (ByteBudget): the bytes in flight shared by the items
+        cache (AssetCache): the asset cache, see stage_in.cache
+        asset_keys (list): the keys of the assets to stage, see select_assets
+        common_names (list): the common band names of the assets to stage
+        roles (list): the roles of the assets to stage
+        aoi (str): the area of interest the GeoTIFF assets are clipped to
+        epsg (str): the CRS of the area of interest
+        segment_threshold (int): the size in bytes above which an asset is
+            downloaded in parallel byte ranges, see stage_in.segmented
+        segments (int): the number of byte ranges, 1 disables the segmented downloads
+        verify_geotiff (bool): check the TIFF structure of the GeoTIFF assets
+        throttle (Throttle): the request and download rates shared by the items
+
+    Returns:
+        pystac.Item: the staged item
+    """
+    target_dir = os.path.abspath(os.path.join(output_dir, item.id))
     os.makedirs(target_dir, exist_ok=True)
 
-    cwd = os.getcwd()
-    os.chdir(target_dir)
+    item_config = config.copy()
 
-    item = await stac_asset.download_item(item=item, directory=".", config=config)
+    if asset_keys or common_names or roles:
+        # an empty include list would stage all the assets
+        item_config.include = select_assets(item, asset_keys, common_names, roles)
 
-    os.chdir(cwd)
+        if not item_config.include:
+            raise ValueError(f"No asset of {item.id} matches the asset filters")
+
+    clients = create_clients(item_config, connector, throttle)
+    request_clients = Clients(item_config, clients)
+    keys = item_config.include or list(item.assets)
+
+    # the cache version, the size and the download of an asset share its HEAD
+    heads = {}
+
+    cache_keys = {}
+    if cache is not None:
+        # the clipped assets depend on the area of interest, they are not cached
+        for key in keys:
+            asset = item.assets[key]
+            target = os.path.join(target_dir, asset_file_name(asset))
+
+            if (aoi and is_raster(asset)) or os.path.exists(target):
+                continue
+
+            version = await asset_version(request_clients, asset, heads)
+
+            if version is None:
+                continue
+
+            cache_keys[key] = cache_key(asset.get_absolute_href(), version)
+
+            if cache.get(cache_keys[key], target):
+                logger.info(f"Stage {key} of {item.id} from the asset cache")
+                del cache_keys[key]
+
+    size = 0
+    if budget is not None and budget.limit is not None:
+        # a clipped asset weighs a fraction of its size, count it in full anyway
+        for key in keys:
+            target = os.path.join(target_dir, asset_file_name(item.assets[key]))
+            if not os.path.exists(target):
+                size += await asset_size(request_clients, item.assets[key], heads)
+
+    async with budget.reserve(size) if budget else contextlib.nullcontext():
+        if aoi:
+            await clip_assets(
+                item,
+                keys,
+                aoi2box(aoi),
+                epsg,
+                target_dir,
+                item_config,
+                clients,
+                throttle,
+            )
+
+        await download_assets(
+            item,
+            [key for key in keys if not (aoi and is_raster(item.assets[key]))],
+            target_dir,
+            request_clients,
+            segment_threshold,
+            segments,
+            item_config.http_max_attempts,
+            verify_geotiff,
+            item_config.warn,
+            throttle=throttle,
+            heads=heads,
+        )
+
+        logger.info(f"Stage {len(keys)} assets of {item.id} in {target_dir}")
+
+        # the process working directory is shared by the concurrent items
+        item = await stac_asset.download_item(
+            item=item, directory=target_dir, config=item_config, clients=clients
+        )
+
+    for key, asset_cache_key in cache_keys.items():
+        # the assets failing to download are removed from the item
+        if key in item.assets:
+            cache.put(asset_cache_key, item.assets[key].get_absolute_href())
+
+    return item
 
-    cat = pystac.Catalog(
-        id="catalog",
-        description=f"Catalog with staged {item.id}",
-        title=f"Catalog with staged {item.id}",
-    )
-    cat.add_item(item)
 
-    cat.normalize_hrefs(target_dir)
+def save_catalog(items, directory):
+    """Saves the staged items in a self-contained catalog in directory"""
+    if len(items) == 1:
+        description = f"Catalog with staged {items[0].id}"
+    else:
+        description = f"Catalog with {len(items)} staged items"
+
+    cat = pystac.Catalog(id="catalog", description=description, title=description)
+    cat.add_items(items)
+
+    cat.normalize_hrefs(directory)
     cat.save(catalog_type=pystac.CatalogType.SELF_CONTAINED)
 
     return cat
 
 
+async def stage_items(
+    hrefs,
+    output_dir: str,
+    concurrency=DEFAULT_CONCURRENCY,
+    max_connections=DEFAULT_LIMIT,
+    connections_per_host=DEFAULT_LIMIT_PER_HOST,
+    max_bytes_in_flight=None,
+    combined=False,
+    cache_dir=None,
+    cache_size=DEFAULT_MAX_SIZE,
+    search=None,
+    requests_per_second=None,
+    bytes_per_second=None,
+    **options,
+):
+    """Stages items concurrently under global limits
+
+    The items share one connection pool. Their metadata is fetched ahead, as
+    the hrefs and the search pages arrive, while at most concurrency items are
+    staged at once, and the assets of the items being staged weigh at most
+    max_bytes_in_flight bytes when set.
+
+    The items are staged in explicit directories and the run keeps its state
+    to itself, the process working directory being left untouched, so that
+    several runs can share an event loop or run in the threads of a pool.
+
+    Args:
+        hrefs (list): the STAC Item hrefs, or STAC Items
+        output_dir (str): the directory of the staged items
+        concurrency (int): the maximum number of items staged at once
+        max_connections (int): the maximum number of connections
+        connections_per_host (int): the maximum number of connections to the same host
+        max_bytes_in_flight (int): the maximum number of bytes downloaded at once
+        combined (bool): save one catalog with all the items in output_dir
+            instead of one catalog per item in output_dir/item.id
+        cache_dir (str): the directory of the asset cache, no cache by default
+        cache_size (int): the maximum size in bytes of the asset cache
+        search (dict): the STAC API search whose items are staged after the
+            hrefs, the url key and the arguments of stage_in.search.search_items
+        requests_per_second (float): the maximum HTTP request rate of the run
+        bytes_per_second (float): the maximum HTTP download rate of the run
+        **options: the asset selection, area of interest and segmented
+            downloads options, see stage_item
+
+    Returns:
+        list: the saved catalogs
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    budget = ByteBudget(max_bytes_in_flight)
+    cache = AssetCache(cache_dir, cache_size) if cache_dir else None
+    throttle = Throttle(requests_per_second, bytes_per_second)
+
+    async with create_connector(
+        limit=max_connections, limit_per_host=connections_per_host
+    ) as connector:
+        async with create_session(config, connector, throttle) as session:
+
+            async def entries():
+                for href in hrefs:
+                    yield href
+
+                if search:
+                    async for feature in search_items(session, **search):
+                        yield feature
+
+            async def stage(entry):
+                item = await read_item(session, entry)
+
+                async with semaphore:
+                    return await stage_item(
+                        item,
+                        output_dir,
+                        connector,
+                        budget,
+                        cache,
+                        throttle=throttle,
+                        **options,
+                    )
+
+            items = await gather_stream(entries(), stage)
+
+    if cache is not None:
+        logger.info(f"Asset cache: {cache.hits} hits, {cache.misses} misses")
+
+    logger.info(f"Throttle: {throttle.summary()}")
+
+    if combined:
+        return [save_catalog(items, output_dir)]
+
+    return [save_catalog([item], os.path.join(output_dir, item.id)) for item in items]
+
+
+async def main(href: str, output_dir: str, **kwargs):
+    """Stages an item into a self-contained catalog in output_dir/item.id"""
+    cats = await stage_items([href], output_dir, **kwargs)
+
+    return cats[0]
+
+
 @click.command()
-@click.argument("href")
+@click.argument("hrefs", nargs=-1)
+@click.option(
+    "--input-file",
+    "input_file",
+    type=click.Path(exists=True, dir_okay=False),
+    help="File listing the STAC Item hrefs, one per line, or JSONL",
+)
+@click.option(
+    "--search-url",
+    "search_url",
+    help="STAC API whose search results are staged, e.g. https://planetarycomputer.microsoft.com/api/stac/v1",
+)
+@click.option(
+    "--collection",
+    "collections",
+    multiple=True,
+    help="Collection of the STAC API search",
+)
+@click.option(
+    "--bbox",
+    "bbox",
+    help="Bounding box of the STAC API search, minx,miny,maxx,maxy in EPSG:4326",
+)
+@click.option(
+    "--datetime",
+    "datetime",
+    help="Datetime or interval of the STAC API search, e.g. 2023-10-01/2023-10-31",
+)
+@click.option(
+    "--search-max-items",
+    "search_max_items",
+    type=click.IntRange(min=1),
+    help="Maximum number of items of the STAC API search, all by default",
+)
 @click.option(
     "--output-dir",
     default=".",
     show_default=True,
     help="Directory where the catalog will be saved",
 )
-def cli(href, output_dir):
-    """Download STAC item and stage into a self-contained STAC catalog."""
-    asyncio.run(main(href, output_dir))
+@click.option(
+    "--asset",
+    "asset_keys",
+    multiple=True,
+    help="Key of an asset to stage, all the assets by default",
+)
+@click.option(
+    "--common-name",
+    "common_names",
+    multiple=True,
+    help="Common band name of an asset to stage, e.g. nir08",
+)
+@click.option(
+    "--role",
+    "roles",
+    multiple=True,
+    help="Only stage the assets with this role, e.g. data",
+)
+@click.option(
+    "--aoi",
+    "aoi",
+    help="Area of interest expressed as a bounding box, the GeoTIFF assets are clipped to it",
+)
+@click.option(
+    "--epsg",
+    "epsg",
+    default="EPSG:4326",
+    show_default=True,
+    help="EPSG code of the area of interest",
+)
+@click.option(
+    "--concurrency",
+    "concurrency",
+    type=click.IntRange(min=1),
+    default=DEFAULT_CONCURRENCY,
+    show_default=True,
+    help="Maximum number of items staged at once",
+)
+@click.option(
+    "--max-connections",
+    "max_connections",
+    type=click.IntRange(min=1),
+    default=DEFAULT_LIMIT,
+    show_default=True,
+    help="Maximum number of connections",
+)
+@click.option(
+    "--connections-per-host",
+    "connections_per_host",
+    type=click.IntRange(min=1),
+    default=DEFAULT_LIMIT_PER_HOST,
+    show_default=True,
+    help="Maximum number of pooled keep-alive connections to the same host",
+)
+@click.option(
+    "--max-bytes-in-flight",
+    "max_bytes_in_flight",
+    type=click.IntRange(min=1),
+    help="Maximum number of bytes of the assets downloaded at once, unbounded by default",
+)
+@click.option(
+    "--max-requests-per-second",
+    "requests_per_second",
+    type=click.FloatRange(min=0, min_open=True),
+    help="Maximum number of HTTP requests per second, unbounded by default",
+)
+@click.option(
+    "--max-bytes-per-second",
+    "bytes_per_second",
+    type=click.FloatRange(min=0, min_open=True),
+    help="Maximum number of bytes downloaded per second over HTTP, unbounded by default",
+)
+@click.option(
+    "--segment-threshold",
+    "segment_threshold",
+    type=click.IntRange(min=1),
+    default=DEFAULT_SEGMENT_THRESHOLD,
+    show_default=True,
+    help="Size in bytes above which an asset is downloaded in parallel byte ranges",
+)
+@click.option(
+    "--segments",
+    "segments",
+    type=click.IntRange(min=1),
+    default=DEFAULT_SEGMENTS,
+    show_default=True,
+    help="Number of parallel byte ranges of a large asset, 1 to disable",
+)
+@click.option(
+    "--verify-geotiff",
+    "verify_geotiff",
+    is_flag=True,
+    help="Check the TIFF header and image file directories of the downloaded GeoTIFF assets",
+)
+@click.option(
+    "--cache-dir",
+    "cache_dir",
+    envvar="STAGE_IN_CACHE_DIR",
+    type=click.Path(file_okay=False),
+    help="Directory of the persistent asset cache shared by the runs, no cache by default",
+)
+@click.option(
+    "--cache-size",
+    "cache_size",
+    type=click.IntRange(min=0),
+    default=DEFAULT_MAX_SIZE,
+    show_default=True,
+    help="Maximum size in bytes of the asset cache, the least recently used assets are evicted",
+)
+@click.option(
+    "--combined-catalog",
+    "combined",
+    is_flag=True,
+    help="Save one catalog with all the items instead of one catalog per item",
+)
+def cli(
+    hrefs,
+    input_file,
+    search_url,
+    collections,
+    bbox,
+    datetime,
+    search_max_items,
+    output_dir,
+    asset_keys,
+    common_names,
+    roles,
+    aoi,
+    epsg,
+    concurrency,
+    max_connections,
+    connections_per_host,
+    max_bytes_in_flight,
+    requests_per_second,
+    bytes_per_second,
+    segment_threshold,
+    segments,
+    verify_geotiff,
+    cache_dir,
+    cache_size,
+    combined,
+):
+    """Download STAC items and stage them into self-contained STAC catalogs."""
+    try:
+        hrefs = list(hrefs) + (read_hrefs(input_file) if input_file else [])
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint="--input-file") from error
+
+    if not hrefs and not search_url:
+        raise click.UsageError("Set at least one HREF, --input-file or --search-url")
+
+    search = None
+    if search_url:
+        search = {
+            "url": search_url,
+            "collections": collections,
+            "bbox": aoi2box(bbox) if bbox else None,
+            "datetime": datetime,
+            "max_items": search_max_items,
+        }
+
+    asyncio.run(
+        stage_items(
+            hrefs,
+            output_dir,
+            concurrency=concurrency,
+            max_connections=max_connections,
+            connections_per_host=connections_per_host,
+            max_bytes_in_flight=max_bytes_in_flight,
+            requests_per_second=requests_per_second,
+            bytes_per_second=bytes_per_second,
+            combined=combined,
+            cache_dir=cache_dir,
+            cache_size=cache_size,
+            search=search,
+            asset_keys=asset_keys,
+            common_names=common_names,
+            roles=roles,
+            aoi=aoi,
+            epsg=epsg,
+            segment_threshold=segment_threshold,
+            segments=segments,
+            verify_geotiff=verify_geotiff,
+        )
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,161 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import uuid
+
+import aiohttp
+import pystac
+from loguru import logger
+from yarl import URL
+
+from stage_in.client import head_href
+
+DEFAULT_MAX_SIZE = 20 * 2**30
+"""The default maximum size in bytes of the asset cache."""
+
+# the Linux ioctl cloning a file on a copy-on-write file system, e.g. btrfs or xfs
+FICLONE = 0x40049409
+
+
+def link(source, target):
+    """Places source at target sharing its blocks when possible
+
+    A reflink is tried first, then a hardlink, then a plain copy.
+    """
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+
+    os.remove(target)
+
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+async def asset_version(clients, asset: pystac.Asset, heads=None):
+    """Returns what identifies the content of an asset, None when unknown
+
+    The file:checksum field identifies it without any request. Otherwise the
+    ETag, or the Last-Modified date and the Content-Length, of a HEAD request
+    on an HTTP asset or the size and modification time of a local file. The
+    HEAD request is shared through heads, see stage_in.client.head_href.
+    """
+    if "file:checksum" in asset.extra_fields:
+        return f"checksum:{asset.extra_fields['file:checksum']}"
+
+    href = asset.get_absolute_href()
+
+    if os.path.exists(href):
+        stat = os.stat(href)
+        return f"stat:{stat.st_size}:{stat.st_mtime_ns}"
+
+    try:
+        headers = await head_href(clients, href, heads)
+    except aiohttp.ClientResponseError:
+        return None
+
+    if headers is None:
+        return None
+
+    if "ETag" in headers:
+        return f"etag:{headers['ETag']}"
+
+    if "Last-Modified" in headers and "Content-Length" in headers:
+        return f"modified:{headers['Last-Modified']}:{headers['Content-Length']}"
+
+    return None
+
+
+def cache_key(href, version):
+    """Returns the cache key of an href and its version
+
+    The query string is ignored so that the URLs signed with different
+    tokens of the same asset share the key.
+    """
+    url = str(URL(href).with_query(None))
+
+    return hashlib.sha256(f"{url}\n{version}".encode()).hexdigest()
+
+
+class AssetCache:
+    """Persistent content-addressed cache of the staged assets
+
+    The assets are stored under the key of their href and version and placed
+    in the staging directories with reflinks or hardlinks. The least recently
+    used assets are evicted once the cache exceeds max_size bytes.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        """Returns the path of the cached asset of a key"""
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key, target):
+        """Places the cached asset of a key at target, returns False on a miss"""
+        path = self.path(key)
+
+        try:
+            link(path, target)
+            # the modification time orders the eviction
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted meanwhile, possibly by a run sharing the cache directory
+            if os.path.exists(target):
+                os.remove(target)
+            self.misses += 1
+            return False
+
+        self.hits += 1
+
+        return True
+
+    def put(self, key, source):
+        """Adds source to the cache under a key and evicts the oldest assets"""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # the asset appears atomically to the concurrent stagings
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        link(source, tmp_path)
+        os.replace(tmp_path, path)
+
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used assets until the cache fits in max_size"""
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # evicted meanwhile by a run sharing the cache directory
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        size = sum(entry[1] for entry in entries)
+
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+
+            logger.info(f"Evict {path} from the asset cache")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
@@ -0,0 +1,125 @@
+import asyncio
+
+import aiohttp
+from aiohttp_retry import RetryClient
+from stac_asset.http_client import HttpClient
+from stac_asset.planetary_computer_client import PlanetaryComputerClient
+
+from stage_in.throttle import ThrottleRetry
+
+DEFAULT_LIMIT = 64
+"""The default maximum number of connections of a staging run."""
+
+DEFAULT_LIMIT_PER_HOST = 8
+"""The default maximum number of connections to the same host."""
+
+DEFAULT_KEEPALIVE_TIMEOUT = 15.0
+"""The default number of seconds an idle connection is kept open for reuse."""
+
+
+def create_connector(
+    limit=DEFAULT_LIMIT,
+    limit_per_host=DEFAULT_LIMIT_PER_HOST,
+    keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+):
+    """Returns the connection pool shared by the HTTP clients of a staging run
+
+    The connections to the same host are kept alive and reused across the
+    assets and the items instead of paying a TCP and TLS handshake per asset.
+    """
+    return aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        keepalive_timeout=keepalive_timeout,
+        enable_cleanup_closed=True,
+    )
+
+
+def create_session(config, connector, throttle=None):
+    """Returns an aiohttp session on a shared connection pool
+
+    A server may close an idle keep-alive connection right when it is reused,
+    which surfaces as a ServerDisconnectedError or a ClientOSError. Both are
+    aiohttp.ClientError and the request is retried on a fresh connection.
+    The throttled responses are retried too, see stage_in.throttle, and the
+    requests wait for the throttle when set.
+    The session does not own the pool, closing it keeps the connections open.
+    """
+    session = aiohttp.ClientSession(
+        connector=connector,
+        connector_owner=False,
+        timeout=aiohttp.ClientTimeout(total=config.http_client_timeout),
+        headers=config.http_headers,
+        trace_configs=[throttle.trace_config()] if throttle else None,
+    )
+
+    return RetryClient(
+        client_session=session,
+        retry_options=ThrottleRetry(
+            throttle,
+            attempts=config.http_max_attempts,
+            exceptions={aiohttp.ClientError},
+        ),
+    )
+
+
+def download_session(session, throttle=None, attempts=3):
+    """Returns a RetryClient on the aiohttp session of session retrying the throttled responses only
+
+    The downloads retry the dropped connections and the corrupt assets
+    themselves, see stage_in.download.download_assets, so their requests are
+    not retried a second time by the session.
+    """
+    return RetryClient(
+        client_session=session._client,
+        retry_options=ThrottleRetry(throttle, attempts=attempts),
+    )
+
+
+def create_clients(config, connector, throttle=None):
+    """Returns the stac_asset HTTP clients sharing a connection pool
+
+    stac_asset closes the clients it is given once an item is downloaded, the
+    connection pool is closed by its owner at the end of the staging run.
+    """
+    return [
+        client_class(
+            create_session(config, connector, throttle),
+            config.http_assert_content_type,
+        )
+        for client_class in [HttpClient, PlanetaryComputerClient]
+    ]
+
+
+async def sign_href(clients, href):
+    """Returns the href signed for reading when it is a Planetary Computer blob"""
+    client = await clients.get_client(href)
+
+    if isinstance(client, PlanetaryComputerClient):
+        return await client._maybe_sign_href(href)
+
+    return href
+
+
+async def head_href(clients, href, heads=None):
+    """Returns the headers of a HEAD request on an HTTP href, None for other hrefs
+
+    With heads set, a dictionary shared by the callers, each href is requested
+    once and its headers are returned to all of them, e.g. to the cache
+    version, the size and the segmented download of an asset.
+    """
+    if heads is not None:
+        if href not in heads:
+            heads[href] = asyncio.ensure_future(head_href(clients, href))
+        return await heads[href]
+
+    client = await clients.get_client(href)
+
+    if not isinstance(client, HttpClient):
+        return None
+
+    async with client.session.head(
+        await sign_href(clients, href), allow_redirects=True
+    ) as response:
+        response.raise_for_status()
+        return response.headers
@@ -0,0 +1,289 @@
+import asyncio
+import math
+import os
+
+import pystac
+import pystac.extensions.projection
+import rasterio
+from loguru import logger
+from rasterio.enums import Interleaving
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+from stac_asset.client import Clients
+from yarl import URL
+
+from stage_in.client import sign_href
+
+# GDAL options for reading only the header and the intersecting tiles of a
+# remote COG with HTTP range requests
+gdal_env = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "VSI_CACHE": "TRUE",
+    "GDAL_HTTP_MAX_RETRY": "3",
+    "GDAL_HTTP_RETRY_DELAY": "1",
+}
+
+
+def aoi2box(aoi):
+    """Converts an area of interest expressed as a bounding box to a list of floats"""
+    return [float(c) for c in aoi.split(",")]
+
+
+def is_raster(asset: pystac.Asset):
+    """Returns True when an asset is a GeoTIFF that can be read with range requests"""
+    if asset.media_type:
+        return "image/tiff" in asset.media_type
+
+    return os.path.splitext(URL(asset.href).path)[1].lower() in [".tif", ".tiff"]
+
+
+def asset_file_name(asset: pystac.Asset):
+    """Returns the file name stac_asset gives to a staged asset"""
+    return os.path.basename(URL(asset.href).path)
+
+
+def covering_window(src, bounds):
+    """Returns the window of the pixels of a dataset intersecting bounds
+
+    The window is rounded outwards so that it covers the pixels a later crop
+    with the same area of interest reads, whatever its rounding.
+    """
+    window = from_bounds(*bounds, transform=src.transform)
+
+    col_start = max(math.floor(window.col_off), 0)
+    row_start = max(math.floor(window.row_off), 0)
+    col_stop = min(math.ceil(window.col_off + window.width), src.width)
+    row_stop = min(math.ceil(window.row_off + window.height), src.height)
+
+    if col_stop <= col_start or row_stop <= row_start:
+        raise ValueError(f"The area of interest does not overlap {src.name}")
+
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def block_rows(src, window):
+    """Yields the windows of the rows of blocks of a dataset covering a window"""
+    block_height = src.block_shapes[0][0]
+    row, stop = window.row_off, window.row_off + window.height
+
+    while row < stop:
+        next_row = min((row // block_height + 1) * block_height, stop)
+        yield Window(window.col_off, row, window.width, next_row - row)
+        row = next_row
+
+
+def block_bytes(src, window):
+    """Returns the bytes of the stored blocks of a GeoTIFF intersecting a window
+
+    The byte counts of the blocks are read from the TIFF tags, the window is
+    counted uncompressed for the other formats.
+    """
+    if src.driver != "GTiff":
+        return window.width * window.height * src.count * src.dtypes[0].itemsize
+
+    block_height, block_width = src.block_shapes[0]
+    indexes = [1] if src.interleaving == Interleaving.pixel else src.indexes
+
+    total = 0
+    for bidx in indexes:
+        for block_row in range(
+            window.row_off // block_height,
+            (window.row_off + window.height - 1) // block_height + 1,
+        ):
+            for block_col in range(
+                window.col_off // block_width,
+                (window.col_off + window.width - 1) // block_width + 1,
+            ):
+                # the sparse blocks are not stored, nor read
+                size = src.get_tag_item(
+                    f"BLOCK_SIZE_{block_col}_{block_row}", "TIFF", bidx=bidx
+                )
+                total += int(size or 0)
+
+    return total
+
+
+def clip_asset(href, bbox, epsg, path, throttle=None, loop=None):
+    """Writes the pixels of a raster intersecting a bounding box to a local GeoTIFF
+
+    Only the header and the tiles intersecting the bounding box are read, with
+    HTTP range requests for a remote COG. The tiles are read row by row, and
+    with a throttle the header and each row wait for the pause of the host
+    and a request token, and the rows take the tokens of their bytes, as the
+    aiohttp requests of the run do. The throttle runs in the event loop loop, the clip in a thread.
+
+    Args:
+        href (str): the raster href
+        bbox (list): the bounding box as [minx, miny, maxx, maxy]
+        epsg (str): the CRS of the bounding box
+        path (str): the local GeoTIFF path
+        throttle (stage_in.throttle.Throttle): limits the rates of the range reads
+        loop (asyncio.AbstractEventLoop): the event loop of the throttle
+
+    Returns:
+        tuple: the (height, width) shape, the affine transform and the
+        [minx, miny, maxx, maxy] bounds in EPSG:4326 of the clipped raster
+    """
+    host = URL(href).host
+
+    throttled = throttle is not None and host is not None
+
+    def wait(coroutine):
+        asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    # the header is read on open
+    if throttled:
+        wait(throttle.request(host))
+
+    with rasterio.Env(**gdal_env), rasterio.open(href) as src:
+        bounds = transform_bounds(epsg, src.crs, *bbox, densify_pts=21)
+        window = covering_window(src, bounds)
+
+        logger.info(f"Clip {window.width}x{window.height} pixels of {href}")
+
+        profile = src.profile
+        profile.update(
+            {
+                "driver": "GTiff",
+                "height": window.height,
+                "width": window.width,
+                "transform": src.window_transform(window),
+                "tiled": True,
+                "blockxsize": 256,
+                "blockysize": 256,
+                "compress": "deflate",
+            }
+        )
+
+        with rasterio.open(path, "w", **profile) as dst:
+            for row in block_rows(src, window):
+                if throttled:
+                    wait(throttle.request(host))
+                    wait(throttle.receive(block_bytes(src, row)))
+
+                dst.write(
+                    src.read(window=row),
+                    window=Window(
+                        0, row.row_off - window.row_off, row.width, row.height
+                    ),
+                )
+
+            dst.update_tags(**src.tags())
+
+            if src.scales and src.offsets:
+                dst.scales = src.scales
+                dst.offsets = src.offsets
+
+        clipped_bounds = transform_bounds(
+            src.crs,
+            "EPSG:4326",
+            *rasterio.windows.bounds(window, src.transform),
+            densify_pts=21,
+        )
+
+    return (window.height, window.width), profile["transform"], list(clipped_bounds)
+
+
+def bbox2geometry(bbox):
+    """Returns the GeoJSON polygon of a [minx, miny, maxx, maxy] bounding box"""
+    minx, miny, maxx, maxy = bbox
+    return {
+        "type": "Polygon",
+        "coordinates": [
+            [[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny]]
+        ],
+    }
+
+
+async def clip_assets(
+    item: pystac.Item,
+    keys,
+    bbox,
+    epsg,
+    target_dir,
+    config,
+    clients=None,
+    throttle=None,
+):
+    """Stages the raster assets of an item clipped to a bounding box
+
+    The clipped GeoTIFFs are written in target_dir under the file names
+    stac_asset uses, so that stac_asset.download_item skips them and only
+    downloads the other assets. The asset hrefs, the proj:shape and
+    proj:transform fields and the item bbox and geometry are updated.
+
+    Args:
+        item (pystac.Item): the STAC Item
+        keys (list): the keys of the assets to clip
+        bbox (list): the bounding box as [minx, miny, maxx, maxy]
+        epsg (str): the CRS of the bounding box
+        target_dir (str): the staging directory
+        config (stac_asset.Config): the stac_asset configuration
+        clients (list): the pre-configured stac_asset clients, see stage_in.client
+        throttle (stage_in.throttle.Throttle): limits the rates of the range reads
+
+    Returns:
+        list: the keys of the clipped assets
+    """
+    keys = [key for key in keys if is_raster(item.assets[key])]
+
+    if not keys:
+        return keys
+
+    # the pre-configured clients are closed by stac_asset.download_item
+    signing_clients = Clients(config, clients)
+    try:
+        hrefs = [
+            await sign_href(signing_clients, item.assets[key].get_absolute_href())
+            for key in keys
+        ]
+    finally:
+        if clients is None:
+            await signing_clients.close_all()
+
+    paths = [
+        os.path.abspath(os.path.join(target_dir, asset_file_name(item.assets[key])))
+        for key in keys
+    ]
+
+    loop = asyncio.get_running_loop()
+
+    # GDAL releases the GIL, the assets are clipped in concurrent threads
+    results = await asyncio.gather(
+        *[
+            asyncio.to_thread(clip_asset, href, bbox, epsg, path, throttle, loop)
+            for href, path in zip(hrefs, paths)
+        ]
+    )
+
+    item_shape = item.properties.get("proj:shape")
+    bounds = []
+
+    for key, path, (shape, transform, clipped_bounds) in zip(keys, paths, results):
+        asset = item.assets[key]
+        original_shape = asset.extra_fields.get("proj:shape", item_shape)
+
+        if item_shape is not None and original_shape == item_shape:
+            item.properties["proj:shape"] = list(shape)
+            item.properties["proj:transform"] = list(transform)[:6]
+            item_shape = None
+
+        asset.extra_fields["proj:shape"] = list(shape)
+        asset.extra_fields["proj:transform"] = list(transform)[:6]
+        asset.href = path
+
+        bounds.append(clipped_bounds)
+
+    item.bbox = [
+        min(b[0] for b in bounds),
+        min(b[1] for b in bounds),
+        max(b[2] for b in bounds),
+        max(b[3] for b in bounds),
+    ]
+    item.geometry = bbox2geometry(item.bbox)
+
+    pystac.extensions.projection.ProjectionExtension.add_to(item)
+
+    return keys
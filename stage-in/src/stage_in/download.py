@@ -0,0 +1,219 @@
+import os
+
+import aiohttp
+import pystac
+from loguru import logger
+from stac_asset.http_client import HttpClient
+
+from stage_in.client import download_session, head_href, sign_href
+from stage_in.clip import asset_file_name, is_raster
+from stage_in.scheduler import gather_tasks
+from stage_in.segmented import (
+    CHUNK_SIZE,
+    DEFAULT_SEGMENT_THRESHOLD,
+    DEFAULT_SEGMENTS,
+    RangesNotSupportedError,
+    download_segmented,
+)
+from stage_in.verify import CorruptAssetError, Verifier, check_geotiff
+
+
+async def download_streamed(session, url, path, verifier, throttle=None):
+    """Downloads url to path in one request, hashing the chunks as they are written
+
+    The body is written to path.part, renamed to path once the verifier
+    checked it. The Content-Length is the expected size when the verifier
+    has none and the body is not content-encoded. The throttle, when set,
+    limits the download rate.
+
+    Raises:
+        stage_in.verify.CorruptAssetError: when the file does not match the verifier
+    """
+    part_path = f"{path}.part"
+
+    async with session.get(url) as response:
+        response.raise_for_status()
+
+        if (
+            verifier.size is None
+            and response.content_length is not None
+            and "Content-Encoding" not in response.headers
+        ):
+            verifier.size = response.content_length
+
+        with open(part_path, "wb") as f:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                f.write(chunk)
+                verifier.update(chunk)
+
+                if throttle is not None:
+                    await throttle.receive(len(chunk))
+
+    verifier.check()
+    os.replace(part_path, path)
+
+
+def remove_partial(path):
+    """Removes a downloaded file and its partial download files"""
+    for partial_path in [path, f"{path}.part", f"{path}.part.json"]:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+async def download_assets(
+    item: pystac.Item,
+    keys,
+    target_dir,
+    clients,
+    threshold=DEFAULT_SEGMENT_THRESHOLD,
+    segments=DEFAULT_SEGMENTS,
+    attempts=3,
+    verify_geotiff=False,
+    warn=False,
+    throttle=None,
+    heads=None,
+):
+    """Downloads and verifies the HTTP assets of an item
+
+    Each asset is hashed while it is written and checked against its
+    file:checksum and its file:size, or the Content-Length, before it is
+    renamed to its final name. The assets larger than threshold bytes on a
+    server accepting range requests are downloaded in segments, see
+    stage_in.segmented. With verify_geotiff set, the TIFF structure of the
+    GeoTIFF assets is checked as well, see stage_in.verify.check_geotiff.
+
+    A corrupt or interrupted asset is downloaded again, up to attempts times,
+    and is never left in target_dir under its final name. This is the only
+    retry of the downloads:
+    their requests retry the throttled responses only, see
+    stage_in.client.download_session, and the interrupted byte ranges of a
+    segmented download are requested again by stage_in.segmented, which
+    leaves the corrupt ones to this loop. An asset still failing after the last
+    attempt is removed from the item with warn set, like stac_asset does with
+    the assets it fails to download, along with its partial download files,
+    and fails the item otherwise. The partial files of an interrupted segmented
+    download are then kept in target_dir to resume on the next run, see
+    stage_in.segmented.
+
+    The assets are written under the file names stac_asset uses so that
+    stac_asset.download_item skips them. The assets of other clients, e.g.
+    local files, and the assets answering an HTTP error status are left to
+    stac_asset.
+
+    Args:
+        item (pystac.Item): the STAC Item
+        keys (list): the keys of the candidate assets
+        target_dir (str): the staging directory
+        clients (stac_asset.client.Clients): the stac_asset clients
+        threshold (int): the size in bytes above which an asset is segmented
+        segments (int): the number of byte ranges, 1 disables the segmented downloads
+        attempts (int): the number of attempts of each asset
+        verify_geotiff (bool): check the TIFF structure of the GeoTIFF assets
+        warn (bool): remove the failing assets from the item instead of raising
+        throttle (stage_in.throttle.Throttle): limits the download rate
+        heads (dict): the HEAD requests shared by the item, see stage_in.client.head_href
+
+    Returns:
+        list: the keys of the downloaded assets
+
+    Raises:
+        stage_in.verify.CorruptAssetError: when an asset is still corrupt after
+            the last attempt and warn is not set
+    """
+
+    async def download(key):
+        asset = item.assets[key]
+        href = asset.get_absolute_href()
+        path = os.path.join(target_dir, asset_file_name(asset))
+
+        client = await clients.get_client(href)
+
+        if os.path.exists(path) or not isinstance(client, HttpClient):
+            return None
+
+        session = download_session(client.session, throttle, attempts)
+
+        size = asset.extra_fields.get("file:size")
+        checksum = asset.extra_fields.get("file:checksum")
+
+        headers = None
+        if segments > 1 and (size is None or size >= threshold):
+            try:
+                headers = await head_href(clients, href, heads)
+            except aiohttp.ClientResponseError:
+                pass
+
+        segmented = (
+            headers is not None
+            and headers.get("Accept-Ranges") == "bytes"
+            and int(headers.get("Content-Length", 0)) >= threshold
+        )
+
+        for attempt in range(1, attempts + 1):
+            verifier = Verifier(f"{key} of {item.id}", size, checksum)
+            url = await sign_href(clients, href)
+
+            try:
+                if segmented:
+                    content_length = int(headers["Content-Length"])
+                    logger.info(
+                        f"Download {key} of {item.id} in {segments} ranges "
+                        f"of {content_length} bytes"
+                    )
+                    try:
+                        await download_segmented(
+                            session,
+                            url,
+                            path,
+                            content_length,
+                            headers.get("ETag", headers.get("Last-Modified")),
+                            segments,
+                            attempts,
+                            verifier,
+                            throttle,
+                        )
+                    except RangesNotSupportedError as error:
+                        # the server advertised the ranges it does not serve
+                        logger.warning(f"Download {key} of {item.id} at once: {error}")
+                        remove_partial(path)
+                        segmented = False
+                        verifier = Verifier(f"{key} of {item.id}", size, checksum)
+
+                if not segmented:
+                    await download_streamed(session, url, path, verifier, throttle)
+
+                if verify_geotiff and is_raster(asset):
+                    check_geotiff(path)
+
+                return key
+
+            except aiohttp.ClientResponseError:
+                remove_partial(path)
+                return None
+
+            except (
+                CorruptAssetError,
+                aiohttp.ClientPayloadError,
+                aiohttp.ClientConnectionError,
+            ) as error:
+                # the byte ranges of a segmented download were already requested again
+                retried = isinstance(error, CorruptAssetError) or not segmented
+                if retried:
+                    remove_partial(path)
+
+                if retried and attempt < attempts:
+                    logger.warning(f"Download {key} of {item.id} again: {error}")
+                    continue
+
+                if not warn:
+                    # an interrupted segmented download resumes on the next run
+                    raise
+
+                logger.warning(f"Remove {key} from {item.id}: {error}")
+                remove_partial(path)
+                del item.assets[key]
+                return None
+
+    downloaded = await gather_tasks([download(key) for key in keys])
+
+    return [key for key in downloaded if key is not None]
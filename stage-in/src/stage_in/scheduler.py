@@ -0,0 +1,141 @@
+import asyncio
+import contextlib
+import json
+import os
+
+import aiohttp
+import pystac
+from stac_asset.client import Clients
+
+from stage_in.client import head_href
+
+DEFAULT_CONCURRENCY = 4
+"""The default maximum number of items staged at once."""
+
+
+def read_hrefs(path):
+    """Returns the hrefs listed in a file
+
+    Each non-empty line is either a plain href, a JSON string or, for JSONL
+    files, a JSON object with an href key or a STAC Item with a self link.
+
+    Raises:
+        ValueError: when a STAC Item has no self link
+    """
+    hrefs = []
+    with open(path) as f:
+        for number, line in enumerate(f, start=1):
+            line = line.strip()
+
+            if not line or line.startswith("#"):
+                continue
+
+            if line[0] not in '{"':
+                hrefs.append(line)
+                continue
+
+            value = json.loads(line)
+
+            if isinstance(value, str):
+                hrefs.append(value)
+            elif "href" in value:
+                hrefs.append(value["href"])
+            else:
+                href = pystac.Item.from_dict(value).get_self_href()
+
+                if href is None:
+                    raise ValueError(
+                        f"The item of line {number} of {path} has no self link"
+                    )
+
+                hrefs.append(href)
+
+    return hrefs
+
+
+class ByteBudget:
+    """Bounds the number of bytes of the assets downloaded at once
+
+    An item larger than the limit is staged alone rather than never.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, size):
+        """Waits until size bytes fit in the budget and holds them"""
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.limit is None
+                or self.in_flight == 0
+                or self.in_flight + size <= self.limit
+            )
+            self.in_flight += size
+
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.in_flight -= size
+                self.condition.notify_all()
+
+
+async def asset_size(clients: Clients, asset: pystac.Asset, heads=None):
+    """Returns the size in bytes of an asset, 0 when unknown
+
+    The file:size field is used when present, the Content-Length of a HEAD
+    request otherwise, shared through heads, see stage_in.client.head_href.
+    """
+    if "file:size" in asset.extra_fields:
+        return int(asset.extra_fields["file:size"])
+
+    href = asset.get_absolute_href()
+
+    if os.path.exists(href):
+        return os.path.getsize(href)
+
+    try:
+        headers = await head_href(clients, href, heads)
+    except aiohttp.ClientResponseError:
+        return 0
+
+    if headers is None:
+        return 0
+
+    return int(headers.get("Content-Length", 0))
+
+
+async def gather_tasks(coroutines):
+    """Runs coroutines as tasks, cancels the others as soon as one fails"""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def gather_stream(entries, func):
+    """Runs func on the entries of an async iterable as tasks as they arrive
+
+    The results are returned in the order of the entries. The tasks started
+    are cancelled as soon as one fails or the iteration fails.
+    """
+    tasks = []
+
+    try:
+        async for entry in entries:
+            tasks.append(asyncio.ensure_future(func(entry)))
+
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
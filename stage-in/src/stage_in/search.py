@@ -0,0 +1,116 @@
+import asyncio
+
+import pystac
+from loguru import logger
+from yarl import URL
+
+DEFAULT_PAGE_SIZE = 100
+"""The default number of items of a STAC API search page."""
+
+
+async def read_item(session, entry):
+    """Returns the STAC Item of an href, a STAC Item dictionary or a STAC Item
+
+    The HTTP hrefs are fetched with the pooled session instead of a blocking
+    pystac.read_file.
+    """
+    if isinstance(entry, pystac.Item):
+        return entry
+
+    if isinstance(entry, dict):
+        return pystac.Item.from_dict(entry)
+
+    if URL(entry).scheme in ["http", "https"]:
+        async with session.get(entry) as response:
+            response.raise_for_status()
+            data = await response.json(content_type=None)
+
+        item = pystac.Item.from_dict(data)
+        item.set_self_href(entry)
+
+        return item
+
+    return await asyncio.to_thread(pystac.read_file, entry)
+
+
+def search_endpoint(url):
+    """Returns the /search endpoint of a STAC API landing page or search URL"""
+    url = str(url).rstrip("/")
+
+    return url if url.endswith("/search") else f"{url}/search"
+
+
+async def search_items(
+    session,
+    url,
+    collections=(),
+    bbox=None,
+    datetime=None,
+    max_items=None,
+    page_size=DEFAULT_PAGE_SIZE,
+):
+    """Yields the items of a STAC API search as its pages arrive
+
+    The pages are followed through their next links, a POST next link
+    carrying the body of the next request, merged with the search body when
+    its merge flag is set.
+
+    Args:
+        session (aiohttp.ClientSession): the HTTP session
+        url (str): the STAC API landing page or /search URL
+        collections (list): the collection ids
+        bbox (list): the bounding box as [minx, miny, maxx, maxy]
+        datetime (str): the datetime or interval, e.g. 2023-10-01/2023-10-31
+        max_items (int): the maximum number of items, all by default
+        page_size (int): the number of items per page
+
+    Yields:
+        dict: the STAC Item dictionaries
+    """
+    body = {"limit": page_size if max_items is None else min(page_size, max_items)}
+
+    if collections:
+        body["collections"] = list(collections)
+    if bbox:
+        body["bbox"] = list(bbox)
+    if datetime:
+        body["datetime"] = datetime
+
+    url, method, count, page = search_endpoint(url), "POST", 0, 0
+
+    while url:
+        page += 1
+
+        if method == "POST":
+            request = session.post(url, json=body)
+        else:
+            request = session.get(url)
+
+        async with request as response:
+            response.raise_for_status()
+            collection = await response.json(content_type=None)
+
+        features = collection.get("features", [])
+        logger.info(f"Search page {page}: {len(features)} items")
+
+        for feature in features:
+            yield feature
+
+            count += 1
+            if max_items is not None and count >= max_items:
+                return
+
+        next_link = next(
+            (link for link in collection.get("links", []) if link["rel"] == "next"),
+            None,
+        )
+
+        if next_link is None or not features:
+            return
+
+        url = next_link["href"]
+        method = next_link.get("method", "GET").upper()
+
+        if method == "POST":
+            next_body = next_link.get("body", {})
+            body = {**body, **next_body} if next_link.get("merge") else next_body
@@ -0,0 +1,221 @@
+import asyncio
+import json
+import math
+import os
+import time
+
+import aiohttp
+from loguru import logger
+
+from stage_in.scheduler import gather_tasks
+
+DEFAULT_SEGMENT_THRESHOLD = 64 * 2**20
+"""The default size in bytes above which an asset is downloaded in segments."""
+
+DEFAULT_SEGMENTS = 4
+"""The default number of byte ranges of an asset downloaded in parallel."""
+
+CHUNK_SIZE = 2**20
+
+SAVE_INTERVAL = 1.0
+"""The number of seconds between two saves of the download progress."""
+
+
+class RangesNotSupportedError(Exception):
+    """Raised when a server answers a byte range request with the whole asset"""
+
+
+def load_progress(path, size, validator):
+    """Returns the segments of an interrupted download, None when it cannot resume
+
+    The download resumes only when the asset kept the same size and
+    validator, i.e. ETag or Last-Modified date.
+    """
+    try:
+        with open(path) as f:
+            progress = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if progress.get("size") != size or progress.get("validator") != validator:
+        return None
+
+    return progress["segments"]
+
+
+def save_progress(path, size, validator, segments):
+    """Saves the [start, position, end) segments of a download atomically"""
+    tmp_path = f"{path}.tmp"
+
+    with open(tmp_path, "w") as f:
+        json.dump({"size": size, "validator": validator, "segments": segments}, f)
+
+    os.replace(tmp_path, path)
+
+
+def split(size, segments):
+    """Returns the [start, position, end) byte ranges splitting size in segments"""
+    step = max(math.ceil(size / segments), 1)
+
+    return [[start, start, min(start + step, size)] for start in range(0, size, step)]
+
+
+async def download_segmented(
+    session,
+    url,
+    path,
+    size,
+    validator=None,
+    segments=DEFAULT_SEGMENTS,
+    attempts=3,
+    verifier=None,
+    throttle=None,
+):
+    """Downloads url to path with parallel byte range requests
+
+    The byte ranges are written at their offset in a preallocated path.part
+    file with os.pwrite, and their progress is saved in the path.part.json
+    sidecar file so that an interrupted download resumes where it left off.
+    A range whose connection drops is requested again from its last written
+    byte. path.part is renamed to path once complete.
+
+    The verifier hashes the contiguous prefix of the file as it grows,
+    instead of a second pass over the complete file. The chunks extending
+    the prefix are hashed from memory, and the bytes of the next ranges,
+    written ahead of it, are read back from the page cache in a thread once
+    the prefix reaches them. Without a checksum they are only counted. A
+    resumed download hashes its already written prefix first.
+
+    Args:
+        session (aiohttp.ClientSession): the HTTP session
+        url (str): the asset URL, signed when needed
+        path (str): the local path
+        size (int): the asset size in bytes
+        validator (str): the ETag or Last-Modified date of the asset
+        segments (int): the number of byte ranges
+        attempts (int): the number of attempts of each byte range
+        verifier (stage_in.verify.Verifier): checks the file before it is renamed
+        throttle (stage_in.throttle.Throttle): limits the download rate
+
+    Raises:
+        stage_in.verify.CorruptAssetError: when the file does not match the verifier
+        RangesNotSupportedError: when the server answers a range with the whole asset
+    """
+    part_path = f"{path}.part"
+    progress_path = f"{part_path}.json"
+
+    ranges = None
+    if os.path.exists(part_path):
+        ranges = load_progress(progress_path, size, validator)
+
+    if ranges is None:
+        ranges = split(size, segments)
+    else:
+        remaining = sum(end - position for _, position, end in ranges)
+        logger.info(f"Resume the download of {path}, {remaining} bytes left")
+
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    saved = time.monotonic()
+
+    def save(force=False):
+        nonlocal saved
+        if force or time.monotonic() - saved >= SAVE_INTERVAL:
+            save_progress(progress_path, size, validator, ranges)
+            saved = time.monotonic()
+
+    hashed = 0
+    hashing = asyncio.Lock()
+
+    def written_prefix():
+        # the end of the contiguous bytes written from the start of the file
+        for _, position, end in sorted(ranges):
+            if position < end:
+                return position
+        return size
+
+    def read_back(start, stop):
+        # runs in a thread, the bytes come back from the page cache
+        while start < stop:
+            chunk = os.pread(fd, min(CHUNK_SIZE, stop - start), start)
+            verifier.update(chunk)
+            start += len(chunk)
+
+    async def hash_prefix():
+        nonlocal hashed
+
+        async with hashing:
+            while hashed < (prefix := written_prefix()):
+                if verifier.hasher is None:
+                    verifier.skip(prefix - hashed)
+                else:
+                    await asyncio.to_thread(read_back, hashed, prefix)
+                hashed = prefix
+
+    async def fetch(segment):
+        nonlocal hashed
+
+        for attempt in range(1, attempts + 1):
+            if segment[1] >= segment[2]:
+                return
+
+            try:
+                async with session.get(
+                    url, headers={"Range": f"bytes={segment[1]}-{segment[2] - 1}"}
+                ) as response:
+                    response.raise_for_status()
+
+                    if response.status != 206:
+                        raise RangesNotSupportedError(
+                            f"{url} does not support range requests"
+                        )
+
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        os.pwrite(fd, chunk, segment[1])
+
+                        if verifier is not None and not hashing.locked():
+                            if segment[1] == hashed:
+                                # the chunk extends the prefix, hashed from memory
+                                verifier.update(chunk)
+                                hashed += len(chunk)
+                            segment[1] += len(chunk)
+
+                            if hashed < written_prefix():
+                                await hash_prefix()
+                        else:
+                            segment[1] += len(chunk)
+
+                        save()
+
+                        if throttle is not None:
+                            await throttle.receive(len(chunk))
+
+                if segment[1] < segment[2]:
+                    raise aiohttp.ClientPayloadError(f"Truncated range of {url}")
+
+            except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError) as error:
+                if attempt == attempts:
+                    raise
+                logger.warning(f"Retry the range {segment} of {url}: {error}")
+
+    try:
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            os.ftruncate(fd, size)
+
+        if verifier is not None:
+            await hash_prefix()
+
+        # the ranges are cancelled before the file is closed when one fails
+        await gather_tasks([fetch(segment) for segment in ranges])
+
+        if verifier is not None:
+            await hash_prefix()
+            verifier.check()
+    finally:
+        os.close(fd)
+        save(force=True)
+
+    os.replace(part_path, path)
+    os.remove(progress_path)
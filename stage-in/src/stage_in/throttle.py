@@ -0,0 +1,161 @@
+import asyncio
+import datetime
+import email.utils
+import random
+import time
+
+import aiohttp
+from aiohttp_retry import ExponentialRetry
+
+THROTTLE_STATUSES = {429, 503}
+"""The statuses of the responses of a server throttling the requests."""
+
+
+class TokenBucket:
+    """Limits an amount per second, e.g. requests or bytes, with bursts up to capacity
+
+    A consumer asking for more tokens than available borrows them and waits
+    until the debt is refilled, so that the rate holds over time whatever
+    the size of the requests.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self, amount=1):
+        """Takes amount tokens, returns the number of seconds waited for them"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+
+        if self.tokens >= 0:
+            return 0.0
+
+        delay = -self.tokens / self.rate
+        await asyncio.sleep(delay)
+
+        return delay
+
+
+def parse_retry_after(value):
+    """Returns the seconds of a Retry-After header, in seconds or as a date, or None"""
+    if value is None:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    return max((date - now).total_seconds(), 0.0)
+
+
+class Throttle:
+    """Shapes the HTTP traffic of a staging run
+
+    The requests and the downloaded bytes of the run share token buckets.
+    A throttled response pauses every request of the run to the same host
+    until its retry, instead of each request hitting the host on its own.
+
+    Args:
+        requests_per_second (float): the maximum request rate, unbounded when None
+        bytes_per_second (float): the maximum download rate, unbounded when None
+    """
+
+    def __init__(self, requests_per_second=None, bytes_per_second=None):
+        self.requests = (
+            TokenBucket(requests_per_second) if requests_per_second else None
+        )
+        self.bytes = TokenBucket(bytes_per_second) if bytes_per_second else None
+        self.paused_until = {}
+        self.throttled = 0
+        self.retry_after = 0
+        self.waited = 0.0
+
+    async def request(self, host):
+        """Waits for the pause of host and for a request token"""
+        delay = self.paused_until.get(host, 0) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+            self.waited += delay
+
+        if self.requests is not None:
+            self.waited += await self.requests.acquire()
+
+    async def receive(self, size):
+        """Waits for the tokens of size downloaded bytes"""
+        if self.bytes is not None:
+            self.waited += await self.bytes.acquire(size)
+
+    def pause(self, host, delay, retry_after=False):
+        """Records a throttled response of host and pauses the host for delay seconds"""
+        self.throttled += 1
+        self.retry_after += retry_after
+        self.paused_until[host] = max(
+            self.paused_until.get(host, 0), time.monotonic() + delay
+        )
+
+    def trace_config(self):
+        """Returns the aiohttp trace config waiting for the throttle before each request"""
+
+        async def on_request_start(session, context, params):
+            await self.request(params.url.host)
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+
+        return trace_config
+
+    def summary(self):
+        """Returns the throttle events of the run"""
+        return (
+            f"{self.throttled} throttled responses, {self.retry_after} with "
+            f"Retry-After, {self.waited:.1f} seconds waited"
+        )
+
+
+class ThrottleRetry(ExponentialRetry):
+    """Retries with a jittered exponential backoff honoring Retry-After
+
+    The backoff is drawn between half and all of the exponential timeout so
+    that the clients throttled at once do not retry at once. A throttled
+    response waits at least its Retry-After and pauses its host in the
+    throttle.
+    """
+
+    def __init__(self, throttle=None, **kwargs):
+        super().__init__(statuses=THROTTLE_STATUSES, **kwargs)
+        self.throttle = throttle
+
+    def get_timeout(self, attempt, response=None):
+        backoff = super().get_timeout(attempt, response)
+        timeout = random.uniform(backoff / 2, backoff)
+
+        if response is None:
+            return timeout
+
+        # the response retried is dropped, its connection goes back to the pool
+        response.release()
+
+        if response.status not in THROTTLE_STATUSES:
+            return timeout
+
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        if retry_after is not None:
+            timeout += retry_after
+
+        if self.throttle is not None:
+            self.throttle.pause(response.url.host, timeout, retry_after is not None)
+
+        return timeout
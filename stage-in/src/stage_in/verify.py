@@ -0,0 +1,194 @@
+import hashlib
+import os
+import struct
+
+# multihash code: hashlib name, see https://github.com/multiformats/multicodec
+MULTIHASH_CODES = {
+    0x11: "sha1",
+    0x12: "sha256",
+    0x13: "sha512",
+    0xD5: "md5",
+    0xB220: "blake2b",
+}
+
+# TIFF tags of the offsets and byte counts of the strips and tiles
+STRIP_OFFSETS, STRIP_BYTE_COUNTS = 273, 279
+TILE_OFFSETS, TILE_BYTE_COUNTS = 324, 325
+
+# TIFF field type: (struct format, size)
+TIFF_TYPES = {3: ("H", 2), 4: ("I", 4), 16: ("Q", 8)}
+
+
+class CorruptAssetError(Exception):
+    """Raised when a downloaded asset does not match its size, checksum or format"""
+
+
+def read_varint(data, offset):
+    """Returns the unsigned varint at offset in data and the offset past it"""
+    value, shift = 0, 0
+    while True:
+        byte = data[offset]
+        value |= (byte & 0x7F) << shift
+        offset += 1
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def parse_multihash(checksum):
+    """Returns the hashlib object and the expected hex digest of a multihash
+
+    Returns None for the hash functions hashlib does not provide.
+    """
+    data = bytes.fromhex(checksum)
+    code, offset = read_varint(data, 0)
+    length, offset = read_varint(data, offset)
+
+    name = MULTIHASH_CODES.get(code)
+    if name is None:
+        return None
+
+    hasher = (
+        hashlib.blake2b(digest_size=length) if name == "blake2b" else hashlib.new(name)
+    )
+
+    return hasher, data[offset : offset + length].hex()
+
+
+class Verifier:
+    """Hashes an asset as its bytes are written and checks it once complete
+
+    Args:
+        name (str): the asset name, for the error messages
+        size (int): the expected size in bytes, unchecked when None
+        checksum (str): the expected file:checksum multihash, unchecked when None
+    """
+
+    def __init__(self, name, size=None, checksum=None):
+        self.name = name
+        self.size = size
+        self.received = 0
+        self.hasher, self.digest = None, None
+
+        if checksum:
+            parsed = parse_multihash(checksum)
+            if parsed is not None:
+                self.hasher, self.digest = parsed
+
+    def update(self, chunk):
+        """Hashes the next chunk of the asset"""
+        self.received += len(chunk)
+        if self.hasher is not None:
+            self.hasher.update(chunk)
+
+    def skip(self, length):
+        """Counts the next length bytes of the asset when there is no checksum to hash them for"""
+        if self.hasher is not None:
+            raise ValueError(f"{self.name} has a checksum, its bytes must be hashed")
+        self.received += length
+
+    def check(self):
+        """Raises CorruptAssetError when the asset does not match its size or checksum"""
+        if self.size is not None and self.received != self.size:
+            raise CorruptAssetError(
+                f"{self.name} has {self.received} bytes instead of {self.size}"
+            )
+
+        if self.hasher is not None and self.hasher.hexdigest() != self.digest:
+            raise CorruptAssetError(f"{self.name} does not match its file:checksum")
+
+
+def check_geotiff(path, max_ifds=64):
+    """Raises CorruptAssetError when the TIFF structure of a file is inconsistent
+
+    The header, the chain of image file directories and the strips or tiles
+    they reference are checked to lie within the file, which catches
+    truncated and garbled downloads without decoding the pixels.
+    """
+    size = os.path.getsize(path)
+
+    def fail(reason):
+        raise CorruptAssetError(f"{path} is not a valid GeoTIFF: {reason}")
+
+    with open(path, "rb") as f:
+
+        def read(offset, length):
+            if offset + length > size:
+                fail(f"{length} bytes at offset {offset} past the end of the file")
+            f.seek(offset)
+            return f.read(length)
+
+        header = read(0, 8)
+        if header[:2] not in (b"II", b"MM"):
+            fail("no TIFF byte order mark")
+
+        order = "<" if header[:2] == b"II" else ">"
+        (version,) = struct.unpack(f"{order}H", header[2:4])
+
+        if version == 42:
+            (offset,) = struct.unpack(f"{order}I", header[4:8])
+            count_format, entry_format, next_format = "H", "HHII", "I"
+        elif version == 43:
+            (offset,) = struct.unpack(f"{order}Q", read(8, 8))
+            count_format, entry_format, next_format = "Q", "HHQQ", "Q"
+        else:
+            fail(f"unknown TIFF version {version}")
+
+        count_size = struct.calcsize(count_format)
+        entry_size = struct.calcsize(f"{order}{entry_format}")
+        value_size = struct.calcsize(next_format)
+
+        ifds = 0
+        while offset:
+            ifds += 1
+            if ifds > max_ifds:
+                fail("too many image file directories")
+
+            (count,) = struct.unpack(f"{order}{count_format}", read(offset, count_size))
+            entries = read(offset + count_size, count * entry_size)
+
+            arrays = {}
+            for index in range(count):
+                entry = entries[index * entry_size : (index + 1) * entry_size]
+                tag, field_type, length, value = struct.unpack(
+                    f"{order}{entry_format}", entry
+                )
+
+                if tag not in (
+                    STRIP_OFFSETS,
+                    STRIP_BYTE_COUNTS,
+                    TILE_OFFSETS,
+                    TILE_BYTE_COUNTS,
+                ):
+                    continue
+
+                if field_type not in TIFF_TYPES:
+                    fail(f"unexpected type {field_type} of the tag {tag}")
+
+                item_format, item_size = TIFF_TYPES[field_type]
+                if length * item_size <= value_size:
+                    # the values fitting in the entry are stored in its last field
+                    data = entry[-value_size:][: length * item_size]
+                else:
+                    data = read(value, length * item_size)
+
+                arrays[tag] = struct.unpack(f"{order}{length}{item_format}", data)
+
+            for offsets_tag, counts_tag in [
+                (STRIP_OFFSETS, STRIP_BYTE_COUNTS),
+                (TILE_OFFSETS, TILE_BYTE_COUNTS),
+            ]:
+                offsets = arrays.get(offsets_tag, ())
+                counts = arrays.get(counts_tag, ())
+
+                if len(offsets) != len(counts):
+                    fail("the strip or tile offsets and byte counts differ in length")
+
+                for block_offset, block_count in zip(offsets, counts):
+                    if block_count and block_offset + block_count > size:
+                        fail("a strip or tile lies past the end of the file")
+
+            (offset,) = struct.unpack(
+                f"{order}{next_format}",
+                read(offset + count_size + count * entry_size, value_size),
+            )
@@ -0,0 +1,356 @@
+import contextlib
+import datetime
+import hashlib
+import http.server
+import json
+import os
+import re
+import socket
+import threading
+import time
+
+import numpy as np
+import pystac
+import rasterio
+import rasterio.shutil
+from rasterio.transform import from_origin
+
+
+def create_cog(path, shape, transform, seed=0):
+    """Writes a uint16 EPSG:32611 Cloud Optimized GeoTIFF with 256x256 tiles"""
+    data = np.random.default_rng(seed).integers(7000, 30000, shape, dtype=np.uint16)
+
+    with rasterio.MemoryFile() as memfile:
+        with memfile.open(
+            driver="GTiff",
+            dtype="uint16",
+            count=1,
+            height=shape[0],
+            width=shape[1],
+            crs="EPSG:32611",
+            transform=transform,
+            nodata=0,
+        ) as dataset:
+            dataset.write(data, 1)
+            rasterio.shutil.copy(
+                dataset, path, driver="COG", blocksize=256, overviews="NONE"
+            )
+
+    return data
+
+
+def create_item(
+    directory,
+    bands=("red", "green", "nir08"),
+    item_id="synthetic-item",
+    base_url=None,
+    shape=None,
+    checksums=False,
+):
+    """Creates a STAC Item with one data asset per common band name plus metadata assets
+
+    With shape set, the .tif assets are synthetic COGs of that shape and the
+    item has the proj fields of their grid. With base_url set, the asset hrefs
+    are base_url/file name instead of local paths. With checksums set, the
+    assets have the file:checksum (sha2-256 multihash) and file:size fields.
+    """
+    properties = {}
+    transform = from_origin(300000, 4300000, 30, 30)
+
+    if shape:
+        properties = {
+            "proj:epsg": 32611,
+            "proj:shape": list(shape),
+            "proj:transform": list(transform)[:6],
+        }
+
+    item = pystac.Item(
+        id=item_id,
+        geometry={
+            "type": "Polygon",
+            "coordinates": [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]],
+        },
+        bbox=[0, 0, 1, 1],
+        datetime=datetime.datetime(2023, 10, 15, tzinfo=datetime.timezone.utc),
+        properties=properties,
+    )
+
+    assets = [
+        (band, f"{band}.tif", ["data"], [{"name": band, "common_name": band}])
+        for band in bands
+    ]
+    assets += [
+        ("qa_pixel", "qa_pixel.tif", ["cloud"], None),
+        ("thumbnail", "thumbnail.png", ["thumbnail"], None),
+        ("mtl.json", "mtl.json", ["metadata"], None),
+    ]
+
+    for index, (key, file_name, roles, eo_bands) in enumerate(assets):
+        path = os.path.join(directory, file_name)
+
+        if shape and file_name.endswith(".tif"):
+            create_cog(path, shape, transform, seed=index)
+        else:
+            with open(path, "wb") as f:
+                f.write(key.encode() * 100)
+
+        href = f"{base_url}/{file_name}" if base_url else path
+
+        extra_fields = {"eo:bands": eo_bands} if eo_bands else {}
+
+        if checksums:
+            with open(path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            extra_fields["file:checksum"] = f"1220{digest}"
+            extra_fields["file:size"] = os.path.getsize(path)
+
+        asset = pystac.Asset(href=href, roles=roles, extra_fields=extra_fields)
+        item.add_asset(key, asset)
+
+    item.set_self_href(os.path.join(directory, "item.json"))
+    item.save_object()
+
+    return item
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves the files of a directory with keep-alive and single byte range requests
+
+    The path and the number of body bytes of each GET request are appended
+    to the server requests list and the client address of the connection is
+    added to the server connections set. The path of each HEAD request is
+    appended to the server heads list.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def do_HEAD(self):
+        self.server.heads.append(self.path)
+        self.respond(send_body=False)
+
+    def respond(self, send_body):
+        path = self.translate_path(self.path)
+
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        size = os.path.getsize(path)
+        start, end, status = 0, size - 1, 200
+
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if match:
+            start = int(match[1])
+            end = min(int(match[2]) if match[2] else size - 1, size - 1)
+            status = 206
+
+        with open(path, "rb") as f:
+            f.seek(start)
+            body = f.read(end - start + 1)
+
+        self.send_response(status)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{os.stat(path).st_mtime_ns}-{size}"')
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+
+        if not send_body:
+            return
+
+        self.write_body(body)
+
+        self.server.requests.append((self.path, len(body)))
+        self.server.connections.add(self.client_address)
+
+    def write_body(self, body):
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class IgnoringRangeRequestHandler(RangeRequestHandler):
+    """Advertises the byte range requests but answers them with the whole file"""
+
+    def do_GET(self):
+        del self.headers["Range"]
+        super().do_GET()
+
+
+class ClosingRequestHandler(RangeRequestHandler):
+    """Drops the connection when a request is sent on a reused connection
+
+    Reproduces a server closing an idle keep-alive connection while the
+    client reuses it.
+    """
+
+    served = False
+
+    def do_GET(self):
+        if self.served:
+            self.close_connection = True
+            return
+
+        super().do_GET()
+        self.served = True
+
+
+class DroppingRequestHandler(RangeRequestHandler):
+    """Drops the connection halfway through the next response of the paths in drop"""
+
+    drop = set()
+
+    def write_body(self, body):
+        if self.path not in self.drop:
+            super().write_body(body)
+            return
+
+        self.drop.discard(self.path)
+        self.wfile.write(body[: len(body) // 2])
+        self.wfile.flush()
+        self.close_connection = True
+        self.connection.shutdown(socket.SHUT_RDWR)
+
+
+class DisconnectingRequestHandler(RangeRequestHandler):
+    """Closes the connection without answering the next GET requests of the paths in disconnect
+
+    The disconnect dictionary maps a path to the number of requests to drop,
+    a dropped request is appended to the server requests list with 0 bytes.
+    """
+
+    disconnect = {}
+
+    def do_GET(self):
+        if self.disconnect.get(self.path, 0) <= 0:
+            super().do_GET()
+            return
+
+        self.disconnect[self.path] -= 1
+        self.server.requests.append((self.path, 0))
+        self.close_connection = True
+
+
+class CorruptingRequestHandler(RangeRequestHandler):
+    """Flips the first byte of the next responses of the paths in corrupt
+
+    The corrupt dictionary maps a path to the number of responses to corrupt.
+    """
+
+    corrupt = {}
+
+    def write_body(self, body):
+        if self.corrupt.get(self.path, 0) > 0 and body:
+            self.corrupt[self.path] -= 1
+            body = bytes([body[0] ^ 0xFF]) + body[1:]
+
+        super().write_body(body)
+
+
+class ThrottlingRequestHandler(RangeRequestHandler):
+    """Answers 429 Too Many Requests to the next GET requests of the paths in throttle
+
+    The throttle dictionary maps a path to the number of requests to throttle,
+    the 429 responses carry the retry_after header when set. The time of each
+    GET request is appended to the server times list.
+    """
+
+    throttle = {}
+    retry_after = None
+
+    def do_GET(self):
+        self.server.times.append((self.path, time.monotonic()))
+
+        if self.throttle.get(self.path, 0) <= 0:
+            super().do_GET()
+            return
+
+        self.throttle[self.path] -= 1
+        self.server.requests.append((self.path, 0))
+
+        self.send_response(429)
+        if self.retry_after is not None:
+            self.send_header("Retry-After", self.retry_after)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class StacApiRequestHandler(RangeRequestHandler):
+    """Serves the server items as a STAC API POST /search paged with a token
+
+    The pages after the first are delayed by the server page_delay seconds.
+    """
+
+    def do_POST(self):
+        if self.path != "/search":
+            self.send_error(404)
+            return
+
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        start, limit = body.get("token", 0), body["limit"]
+
+        items = [
+            item
+            for item in self.server.items
+            if item["collection"] in body.get("collections", [item["collection"]])
+        ]
+
+        if start:
+            time.sleep(self.server.page_delay)
+
+        collection = {
+            "type": "FeatureCollection",
+            "features": items[start : start + limit],
+            "links": [],
+        }
+
+        if start + limit < len(items):
+            collection["links"].append(
+                {
+                    "rel": "next",
+                    "href": f"http://{self.headers['Host']}/search",
+                    "method": "POST",
+                    "body": {"token": start + limit},
+                    "merge": True,
+                }
+            )
+
+        data = json.dumps(collection).encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/geo+json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+        self.server.requests.append((self.path, len(data)))
+
+
+@contextlib.contextmanager
+def serve(directory, handler_class=RangeRequestHandler):
+    """Serves a directory over HTTP on localhost, yields the base URL and the server"""
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0),
+        lambda *args: handler_class(*args, directory=directory),
+    )
+    server.requests = []
+    server.heads = []
+    server.connections = set()
+    server.items = []
+    server.page_delay = 0
+    server.times = []
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield f"http://127.0.0.1:{server.server_port}", server
+    finally:
+        server.shutdown()
+        server.server_close()
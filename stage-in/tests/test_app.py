@@ -0,0 +1,461 @@
+import asyncio
+import concurrent.futures
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pystac
+import rasterio
+import stac_asset
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+
+from stage_in.app import main, select_assets, stage_items
+from stage_in.cache import AssetCache
+from stage_in.scheduler import ByteBudget, read_hrefs
+from tests.helpers import (
+    ClosingRequestHandler,
+    DisconnectingRequestHandler,
+    RangeRequestHandler,
+    create_item,
+    serve,
+)
+
+
+class TestStageIn(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp_dir, "source")
+        self.output_dir = os.path.join(self.tmp_dir, "output")
+        os.makedirs(self.source_dir)
+
+        self.item = create_item(self.source_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_select_assets(self):
+        self.assertEqual(
+            select_assets(self.item, common_names=["green", "nir08"]),
+            ["green", "nir08"],
+        )
+        self.assertEqual(
+            select_assets(self.item, asset_keys=["red", "qa_pixel"], roles=["data"]),
+            ["red"],
+        )
+        self.assertEqual(
+            select_assets(self.item, roles=["data"]), ["red", "green", "nir08"]
+        )
+        self.assertEqual(len(select_assets(self.item)), 6)
+
+    def test_stage_common_names(self):
+        cat = asyncio.run(
+            main(
+                self.item.get_self_href(),
+                self.output_dir,
+                common_names=["green", "nir08"],
+            )
+        )
+
+        item = next(cat.get_items())
+        target_dir = os.path.join(self.output_dir, item.id)
+
+        self.assertEqual(sorted(item.assets), ["green", "nir08"])
+        self.assertEqual(
+            sorted(f for f in os.listdir(target_dir) if f.endswith(".tif")),
+            ["green.tif", "nir08.tif"],
+        )
+
+        staged = next(
+            pystac.read_file(os.path.join(target_dir, "catalog.json")).get_items()
+        )
+        self.assertEqual(sorted(staged.assets), ["green", "nir08"])
+        for asset in staged.assets.values():
+            self.assertTrue(os.path.exists(asset.get_absolute_href()))
+
+    def test_stage_no_match(self):
+        with self.assertRaises(ValueError):
+            asyncio.run(
+                main(self.item.get_self_href(), self.output_dir, common_names=["swir"])
+            )
+
+
+class TestStageInAoi(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp_dir, "source")
+        self.output_dir = os.path.join(self.tmp_dir, "output")
+        os.makedirs(self.source_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_stage_aoi(self):
+        with serve(self.source_dir) as (base_url, server):
+            item = create_item(self.source_dir, base_url=base_url, shape=(1024, 1024))
+
+            cat = asyncio.run(
+                main(
+                    item.get_self_href(),
+                    self.output_dir,
+                    asset_keys=["red", "nir08", "mtl.json"],
+                    aoi="303000,4289500,306000,4292500",
+                    epsg="EPSG:32611",
+                )
+            )
+
+        staged = next(cat.get_items())
+
+        self.assertEqual(sorted(staged.assets), ["mtl.json", "nir08", "red"])
+        self.assertEqual(staged.properties["proj:shape"], [100, 100])
+        self.assertEqual(
+            staged.properties["proj:transform"],
+            [30.0, 0.0, 303000.0, 0.0, -30.0, 4292500.0],
+        )
+        self.assertEqual(
+            staged.bbox,
+            list(
+                transform_bounds(
+                    "EPSG:32611", "EPSG:4326", 303000, 4289500, 306000, 4292500
+                )
+            ),
+        )
+
+        for key in ["red", "nir08"]:
+            href = staged.assets[key].get_absolute_href()
+            self.assertTrue(href.startswith(self.output_dir))
+
+            with rasterio.open(os.path.join(self.source_dir, f"{key}.tif")) as src:
+                expected = src.read(1, window=Window(100, 250, 100, 100))
+
+            with rasterio.open(href) as dst:
+                self.assertEqual(dst.shape, (100, 100))
+                np.testing.assert_array_equal(dst.read(1), expected)
+
+        self.assertTrue(os.path.exists(staged.assets["mtl.json"].get_absolute_href()))
+
+        # only the header and the intersecting tiles are transferred
+        transferred = sum(size for path, size in server.requests if path == "/red.tif")
+        self.assertLess(
+            transferred, os.path.getsize(os.path.join(self.source_dir, "red.tif")) / 4
+        )
+
+
+class TestStageInHttp(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp_dir, "source")
+        self.output_dir = os.path.join(self.tmp_dir, "output")
+        os.makedirs(self.source_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _stage(self, handler_class):
+        with serve(self.source_dir, handler_class) as (base_url, server):
+            item = create_item(
+                self.source_dir,
+                bands=["red", "green", "nir08", "swir16"],
+                base_url=base_url,
+            )
+            cat = asyncio.run(
+                main(item.get_self_href(), self.output_dir, connections_per_host=2)
+            )
+
+        staged = next(cat.get_items())
+        self.assertEqual(len(staged.assets), 7)
+        for asset in staged.assets.values():
+            self.assertTrue(os.path.exists(asset.get_absolute_href()))
+
+        return server
+
+    def test_stage_keep_alive(self):
+        server = self._stage(RangeRequestHandler)
+
+        self.assertEqual(len(server.requests), 7)
+        self.assertLessEqual(len(server.connections), 2)
+
+    def test_stage_server_closed_connections(self):
+        server = self._stage(ClosingRequestHandler)
+
+        self.assertEqual(len(server.requests), 7)
+
+    def test_stage_disconnected_asset_attempts(self):
+        DisconnectingRequestHandler.disconnect = {"/red.tif": 100}
+
+        with serve(self.source_dir, DisconnectingRequestHandler) as (base_url, server):
+            item = create_item(self.source_dir, base_url=base_url)
+            cat = asyncio.run(main(item.get_self_href(), self.output_dir))
+
+        self.assertNotIn("red", next(cat.get_items()).assets)
+
+        # the session does not retry the requests the download retries, aiohttp
+        # only sends a request dropped on a reused connection once again
+        attempts = stac_asset.Config().http_max_attempts
+        gets = [path for path, _ in server.requests if path == "/red.tif"]
+        self.assertGreaterEqual(len(gets), attempts)
+        self.assertLessEqual(len(gets), 2 * attempts)
+
+
+class TestStageItems(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.tmp_dir, "output")
+
+        self.hrefs = []
+        for item_id in ["item-1", "item-2", "item-3"]:
+            source_dir = os.path.join(self.tmp_dir, item_id)
+            os.makedirs(source_dir)
+            item = create_item(source_dir, item_id=item_id)
+            self.hrefs.append(item.get_self_href())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_stage_items(self):
+        cats = asyncio.run(
+            stage_items(
+                self.hrefs,
+                self.output_dir,
+                concurrency=2,
+                max_bytes_in_flight=1000,
+                common_names=["red"],
+            )
+        )
+
+        self.assertEqual(len(cats), 3)
+
+        for item_id in ["item-1", "item-2", "item-3"]:
+            cat = pystac.read_file(
+                os.path.join(self.output_dir, item_id, "catalog.json")
+            )
+            items = list(cat.get_items())
+            self.assertEqual([item.id for item in items], [item_id])
+            self.assertTrue(os.path.exists(items[0].assets["red"].get_absolute_href()))
+
+    def test_stage_items_combined(self):
+        asyncio.run(stage_items(self.hrefs, self.output_dir, combined=True))
+
+        cat = pystac.read_file(os.path.join(self.output_dir, "catalog.json"))
+        items = sorted(cat.get_items(), key=lambda item: item.id)
+
+        self.assertEqual([item.id for item in items], ["item-1", "item-2", "item-3"])
+        for item in items:
+            self.assertEqual(len(item.assets), 6)
+            for asset in item.assets.values():
+                self.assertTrue(os.path.exists(asset.get_absolute_href()))
+
+    def _assert_staged(self, output_dir, item_ids):
+        for item_id in item_ids:
+            cat = pystac.read_file(os.path.join(output_dir, item_id, "catalog.json"))
+            item = next(cat.get_items())
+            self.assertEqual(
+                os.path.dirname(item.assets["red"].get_absolute_href()),
+                os.path.join(output_dir, item_id),
+            )
+
+    def test_concurrent_runs_in_one_loop(self):
+        cwd = os.getcwd()
+        output_dirs = [os.path.join(self.tmp_dir, f"run-{run}") for run in range(3)]
+
+        async def run():
+            return await asyncio.gather(
+                *[
+                    stage_items(self.hrefs[run:], output_dir, concurrency=2)
+                    for run, output_dir in enumerate(output_dirs)
+                ]
+            )
+
+        runs = asyncio.run(run())
+
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertEqual([len(cats) for cats in runs], [3, 2, 1])
+        for run, output_dir in enumerate(output_dirs):
+            self._assert_staged(output_dir, [f"item-{i + 1}" for i in range(run, 3)])
+
+    def test_concurrent_runs_in_threads(self):
+        cwd = os.getcwd()
+        output_dirs = [os.path.join(self.tmp_dir, f"run-{run}") for run in range(3)]
+
+        def run(output_dir):
+            return asyncio.run(stage_items(self.hrefs, output_dir, concurrency=2))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            runs = list(executor.map(run, output_dirs))
+
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertEqual([len(cats) for cats in runs], [3, 3, 3])
+        for output_dir in output_dirs:
+            self._assert_staged(output_dir, ["item-1", "item-2", "item-3"])
+
+    def test_read_hrefs(self):
+        path = os.path.join(self.tmp_dir, "hrefs.jsonl")
+        with open(path, "w") as f:
+            f.write("# items\n")
+            f.write(f"{self.hrefs[0]}\n\n")
+            f.write(f'"{self.hrefs[1]}"\n')
+            f.write(f'{{"href": "{self.hrefs[2]}"}}\n')
+
+        self.assertEqual(read_hrefs(path), self.hrefs)
+
+        item = pystac.read_file(self.hrefs[0])
+        item.clear_links()
+        with open(path, "a") as f:
+            f.write(f"{json.dumps(item.to_dict())}\n")
+
+        with self.assertRaisesRegex(ValueError, "line 6 "):
+            read_hrefs(path)
+
+    def test_byte_budget(self):
+        budget = ByteBudget(100)
+        in_flight = []
+
+        async def download(size):
+            async with budget.reserve(size):
+                in_flight.append(budget.in_flight)
+                await asyncio.sleep(0.01)
+
+        async def run():
+            await asyncio.gather(*[download(size) for size in [60, 30, 50, 150, 20]])
+
+        asyncio.run(run())
+
+        self.assertEqual(budget.in_flight, 0)
+        self.assertIn(150, in_flight)
+        self.assertTrue(all(size <= 100 or size == 150 for size in in_flight))
+
+
+class TestAssetCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp_dir, "source")
+        self.cache_dir = os.path.join(self.tmp_dir, "cache")
+        os.makedirs(self.source_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _stage(self, output_dir):
+        cat = asyncio.run(
+            main(
+                os.path.join(self.source_dir, "item.json"),
+                os.path.join(self.tmp_dir, output_dir),
+                cache_dir=self.cache_dir,
+            )
+        )
+        return next(cat.get_items())
+
+    def test_cache_hits_skip_downloads(self):
+        for checksums in [True, False]:
+            with self.subTest(checksums=checksums):
+                shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+                with serve(self.source_dir) as (base_url, server):
+                    create_item(self.source_dir, base_url=base_url, checksums=checksums)
+
+                    first = self._stage(f"first-{checksums}")
+                    downloads = len(server.requests)
+                    second = self._stage(f"second-{checksums}")
+
+                self.assertEqual(downloads, 6)
+                self.assertEqual(len(server.requests), downloads)
+                self.assertEqual(sorted(first.assets), sorted(second.assets))
+
+                for key in first.assets:
+                    with open(first.assets[key].get_absolute_href(), "rb") as f:
+                        expected = f.read()
+                    with open(second.assets[key].get_absolute_href(), "rb") as f:
+                        self.assertEqual(f.read(), expected)
+
+    def test_one_head_per_asset(self):
+        with serve(self.source_dir) as (base_url, server):
+            item = create_item(self.source_dir, base_url=base_url)
+            cat = asyncio.run(
+                main(
+                    item.get_self_href(),
+                    os.path.join(self.tmp_dir, "output"),
+                    cache_dir=self.cache_dir,
+                    max_bytes_in_flight=2**30,
+                )
+            )
+
+        self.assertEqual(len(next(cat.get_items()).assets), 6)
+
+        # the cache version, the size and the download share the HEAD request
+        self.assertEqual(sorted(server.heads), sorted(set(server.heads)))
+        self.assertEqual(len(server.heads), 6)
+
+    def test_cache_eviction(self):
+        cache = AssetCache(self.cache_dir, max_size=250)
+
+        for index, key in enumerate(["a" * 64, "b" * 64, "c" * 64]):
+            source = os.path.join(self.source_dir, key)
+            with open(source, "wb") as f:
+                f.write(b"x" * 100)
+            os.utime(source, (index, index))
+            cache.put(key, source)
+
+            # the most recent use orders the eviction
+            if index == 1:
+                self.assertTrue(cache.get("a" * 64, os.path.join(self.tmp_dir, "a")))
+
+        self.assertTrue(os.path.exists(cache.path("a" * 64)))
+        self.assertFalse(os.path.exists(cache.path("b" * 64)))
+        self.assertTrue(os.path.exists(cache.path("c" * 64)))
+
+    def test_cache_shared_eviction(self):
+        cache = AssetCache(self.cache_dir, max_size=300)
+        keys = ["a" * 64, "b" * 64, "c" * 64, "d" * 64]
+
+        for index, key in enumerate(keys[:3]):
+            source = os.path.join(self.source_dir, key)
+            with open(source, "wb") as f:
+                f.write(b"x" * 100)
+            os.utime(source, (index, index))
+            cache.put(key, source)
+
+        # another run evicts the entries listed by this one
+        walk = os.walk
+
+        def shared_walk(directory):
+            listing = list(walk(directory))
+            os.remove(cache.path(keys[0]))
+            return listing
+
+        remove = os.remove
+
+        def shared_remove(path):
+            remove(path)
+            if path == cache.path(keys[1]):
+                raise FileNotFoundError(path)
+
+        source = os.path.join(self.source_dir, keys[3])
+        with open(source, "wb") as f:
+            f.write(b"x" * 100)
+
+        cache.max_size = 250
+        with mock.patch("stage_in.cache.os.walk", shared_walk):
+            with mock.patch("stage_in.cache.os.remove", shared_remove):
+                cache.put(keys[3], source)
+
+        self.assertEqual(
+            [os.path.exists(cache.path(key)) for key in keys],
+            [False, False, True, True],
+        )
+
+        # the entry is evicted between its link and its use
+        target = os.path.join(self.tmp_dir, "c")
+        with mock.patch("stage_in.cache.os.utime", side_effect=FileNotFoundError):
+            self.assertFalse(cache.get(keys[2], target))
+
+        self.assertFalse(os.path.exists(target))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
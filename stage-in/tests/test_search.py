@@ -0,0 +1,63 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+import pystac
+
+from stage_in.app import stage_items
+from tests.helpers import StacApiRequestHandler, create_item, serve
+
+
+class TestSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.tmp_dir, "output")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_stage_search(self):
+        with serve(self.tmp_dir, StacApiRequestHandler) as (base_url, server):
+            for index in range(7):
+                item_id = f"item-{index}"
+                os.makedirs(os.path.join(self.tmp_dir, item_id))
+                item = create_item(
+                    os.path.join(self.tmp_dir, item_id),
+                    item_id=item_id,
+                    base_url=f"{base_url}/{item_id}",
+                )
+                item.collection_id = "landsat-c2-l2" if index != 3 else "other"
+                server.items.append(item.to_dict(include_self_link=False))
+
+            server.page_delay = 0.5
+
+            asyncio.run(
+                stage_items(
+                    [f"{base_url}/item-3/item.json"],
+                    self.output_dir,
+                    combined=True,
+                    search={
+                        "url": base_url,
+                        "collections": ["landsat-c2-l2"],
+                        "max_items": 5,
+                        "page_size": 2,
+                    },
+                    common_names=["red"],
+                )
+            )
+
+        cat = pystac.read_file(os.path.join(self.output_dir, "catalog.json"))
+        self.assertEqual(
+            sorted(item.id for item in cat.get_items()),
+            ["item-0", "item-1", "item-2", "item-3", "item-4", "item-5"],
+        )
+
+        paths = [path for path, _ in server.requests]
+        self.assertEqual(paths.count("/search"), 3)
+
+        # the first items are staged while the next pages are fetched
+        last_page = max(index for index, path in enumerate(paths) if path == "/search")
+        self.assertLess(paths.index("/item-0/red.tif"), last_page)
@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import aiohttp
+
+from stage_in.app import main
+from stage_in.segmented import download_segmented, split
+from stage_in.verify import CorruptAssetError, Verifier
+from tests.helpers import (
+    DisconnectingRequestHandler,
+    DroppingRequestHandler,
+    IgnoringRangeRequestHandler,
+    create_item,
+    serve,
+)
+
+
+class TestSegmented(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp_dir, "source")
+        self.output_dir = os.path.join(self.tmp_dir, "output")
+        os.makedirs(self.source_dir)
+
+        self.data = os.urandom(5 * 2**20 + 123)
+        with open(os.path.join(self.source_dir, "large.bin"), "wb") as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _stage(self, base_url):
+        item = create_item(self.source_dir, base_url=base_url)
+        item.assets["red"].href = f"{base_url}/large.bin"
+        item.save_object()
+
+        cat = asyncio.run(
+            main(
+                item.get_self_href(),
+                self.output_dir,
+                asset_keys=["red", "green"],
+                segment_threshold=2**20,
+                segments=4,
+            )
+        )
+        staged = next(cat.get_items())
+
+        with open(staged.assets["red"].get_absolute_href(), "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.output_dir, item.id))),
+            ["catalog.json", "green.tif", "large.bin", item.id, f"{item.id}.json"],
+        )
+
+    def test_stage_segmented(self):
+        with serve(self.source_dir) as (base_url, server):
+            self._stage(base_url)
+
+        ranges = [size for path, size in server.requests if path == "/large.bin"]
+        self.assertEqual(len(ranges), 4)
+        self.assertEqual(sum(ranges), len(self.data))
+
+    def test_stage_segmented_dropped_connection(self):
+        DroppingRequestHandler.drop = {"/large.bin"}
+
+        with serve(self.source_dir, DroppingRequestHandler) as (base_url, server):
+            self._stage(base_url)
+
+        # each range is requested again from its last written byte
+        ranges = [size for path, size in server.requests if path == "/large.bin"]
+        self.assertEqual(len(ranges), 5)
+
+    def test_stage_segmented_removed(self):
+        DisconnectingRequestHandler.disconnect = {"/large.bin": 1000}
+
+        with serve(self.source_dir, DisconnectingRequestHandler) as (base_url, _):
+            item = create_item(self.source_dir, base_url=base_url)
+            item.assets["red"].href = f"{base_url}/large.bin"
+            item.save_object()
+
+            cat = asyncio.run(
+                main(
+                    item.get_self_href(),
+                    self.output_dir,
+                    asset_keys=["red", "green"],
+                    segment_threshold=2**20,
+                    segments=4,
+                )
+            )
+
+        self.assertNotIn("red", next(cat.get_items()).assets)
+
+        # the partial download files of the removed asset are not staged
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.output_dir, item.id))),
+            ["catalog.json", "green.tif", item.id, f"{item.id}.json"],
+        )
+
+    def test_stage_segmented_ranges_ignored(self):
+        with serve(self.source_dir, IgnoringRangeRequestHandler) as (base_url, server):
+            self._stage(base_url)
+
+        # the asset is downloaded again in one request
+        self.assertIn(
+            ("/large.bin", len(self.data)),
+            server.requests[-2:],
+        )
+
+    def test_resume(self):
+        path = os.path.join(self.output_dir, "large.bin")
+        os.makedirs(self.output_dir)
+
+        # an interrupted download wrote the first half of each range
+        segments = split(len(self.data), 4)
+        with open(f"{path}.part", "wb") as f:
+            f.truncate(len(self.data))
+            for segment in segments:
+                segment[1] = (segment[0] + segment[2]) // 2
+                f.seek(segment[0])
+                f.write(self.data[segment[0] : segment[1]])
+
+        async def resume(base_url):
+            async with aiohttp.ClientSession() as session:
+                async with session.head(f"{base_url}/large.bin") as response:
+                    validator = response.headers["ETag"]
+
+                with open(f"{path}.part.json", "w") as f:
+                    json.dump(
+                        {
+                            "size": len(self.data),
+                            "validator": validator,
+                            "segments": segments,
+                        },
+                        f,
+                    )
+
+                await download_segmented(
+                    session, f"{base_url}/large.bin", path, len(self.data), validator
+                )
+
+        with serve(self.source_dir) as (base_url, server):
+            asyncio.run(resume(base_url))
+
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+        transferred = sum(size for _, size in server.requests)
+        remaining = sum(end - position for _, position, end in segments)
+        self.assertEqual(transferred, remaining)
+        self.assertFalse(os.path.exists(f"{path}.part"))
+        self.assertFalse(os.path.exists(f"{path}.part.json"))
+
+    def test_verify_segmented(self):
+        path = os.path.join(self.output_dir, "large.bin")
+        os.makedirs(self.output_dir)
+        checksum = f"1220{hashlib.sha256(self.data).hexdigest()}"
+        wrong = f"1220{hashlib.sha256(b'data').hexdigest()}"
+
+        async def download(base_url, verifier):
+            async with aiohttp.ClientSession() as session:
+                await download_segmented(
+                    session,
+                    f"{base_url}/large.bin",
+                    path,
+                    len(self.data),
+                    verifier=verifier,
+                )
+
+        with serve(self.source_dir) as (base_url, _):
+            # without a checksum the bytes are counted, never read back
+            with mock.patch("os.pread", side_effect=AssertionError("read back")):
+                verifier = Verifier("large.bin", len(self.data))
+                asyncio.run(download(base_url, verifier))
+            self.assertEqual(verifier.received, len(self.data))
+
+            os.remove(path)
+            asyncio.run(download(base_url, Verifier("large.bin", None, checksum)))
+
+            os.remove(path)
+            with self.assertRaises(CorruptAssetError):
+                asyncio.run(download(base_url, Verifier("large.bin", None, wrong)))
+
+        self.assertFalse(os.path.exists(path))
@@ -0,0 +1,125 @@
+import asyncio
+import email.utils
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from stage_in.app import stage_item
+from stage_in.client import create_connector
+from stage_in.throttle import Throttle, TokenBucket, parse_retry_after
+from tests.helpers import ThrottlingRequestHandler, create_item, serve
+
+
+class TestThrottle(unittest.TestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(100, capacity=1)
+
+        async def run():
+            start = time.monotonic()
+            for _ in range(11):
+                await bucket.acquire()
+            return time.monotonic() - start
+
+        self.assertGreaterEqual(asyncio.run(run()), 0.09)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after("2"), 2)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after("later"))
+
+        date = email.utils.formatdate(time.time() + 60, usegmt=True)
+        self.assertAlmostEqual(parse_retry_after(date), 60, delta=2)
+
+    def test_pause(self):
+        throttle = Throttle()
+        throttle.pause("example.com", 0.2, retry_after=True)
+
+        async def elapsed(host):
+            start = time.monotonic()
+            await throttle.request(host)
+            return time.monotonic() - start
+
+        self.assertLess(asyncio.run(elapsed("example.org")), 0.1)
+        self.assertGreaterEqual(asyncio.run(elapsed("example.com")), 0.15)
+        self.assertEqual((throttle.throttled, throttle.retry_after), (1, 1))
+
+
+class TestStageInThrottled(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp_dir, "source")
+        self.output_dir = os.path.join(self.tmp_dir, "output")
+        os.makedirs(self.source_dir)
+
+        ThrottlingRequestHandler.throttle = {"/red.tif": 2}
+        ThrottlingRequestHandler.retry_after = "1"
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_stage_throttled(self):
+        throttle = Throttle()
+
+        with serve(self.source_dir, ThrottlingRequestHandler) as (base_url, server):
+            item = create_item(self.source_dir, base_url=base_url)
+
+            async def run():
+                async with create_connector() as connector:
+                    return await stage_item(
+                        item,
+                        self.output_dir,
+                        connector,
+                        asset_keys=["red", "green"],
+                        throttle=throttle,
+                    )
+
+            staged = asyncio.run(run())
+
+        with open(staged.assets["red"].get_absolute_href(), "rb") as f:
+            self.assertEqual(f.read(), b"red" * 100)
+
+        self.assertEqual((throttle.throttled, throttle.retry_after), (2, 2))
+
+        times = [at for path, at in server.times if path == "/red.tif"]
+        self.assertEqual(len(times), 3)
+
+        # each retry waited at least the Retry-After of the 429 response
+        for before, after in zip(times, times[1:]):
+            self.assertGreaterEqual(after - before, 1)
+
+    def test_clip_throttled(self):
+        ThrottlingRequestHandler.throttle = {}
+        throttle = Throttle(bytes_per_second=2**16)
+
+        with serve(self.source_dir, ThrottlingRequestHandler) as (base_url, server):
+            item = create_item(self.source_dir, base_url=base_url, shape=(1024, 1024))
+
+            async def run():
+                # a throttled response of the host pauses the range reads too
+                throttle.pause("127.0.0.1", 1.0)
+                start = time.monotonic()
+
+                async with create_connector() as connector:
+                    staged = await stage_item(
+                        item,
+                        self.output_dir,
+                        connector,
+                        asset_keys=["red"],
+                        aoi="303000,4289500,306000,4292500",
+                        epsg="EPSG:32611",
+                        throttle=throttle,
+                    )
+
+                return staged, start
+
+            staged, start = asyncio.run(run())
+
+        self.assertTrue(staged.assets["red"].get_absolute_href().endswith("red.tif"))
+
+        times = [at for path, at in server.times if path == "/red.tif"]
+        self.assertGreaterEqual(min(times) - start, 1)
+        self.assertGreater(throttle.waited, 1)
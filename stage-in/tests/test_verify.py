@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from rasterio.transform import from_origin
+
+from stage_in.app import main
+from stage_in.verify import (
+    CorruptAssetError,
+    Verifier,
+    check_geotiff,
+    parse_multihash,
+)
+from tests.helpers import CorruptingRequestHandler, create_cog, create_item, serve
+
+
+class TestVerifier(unittest.TestCase):
+
+    def test_parse_multihash(self):
+        digest = hashlib.sha256(b"data").hexdigest()
+        hasher, expected = parse_multihash(f"1220{digest}")
+
+        hasher.update(b"data")
+        self.assertEqual(hasher.hexdigest(), expected)
+
+        # blake3 is not in hashlib
+        self.assertIsNone(parse_multihash(f"1e20{digest}"))
+
+    def test_verifier(self):
+        checksum = f"1220{hashlib.sha256(b'data').hexdigest()}"
+
+        verifier = Verifier("asset", 4, checksum)
+        verifier.update(b"da")
+        verifier.update(b"ta")
+        verifier.check()
+
+        for size, chunk in [(4, b"date"), (5, b"data")]:
+            with self.subTest(size=size, chunk=chunk):
+                verifier = Verifier("asset", size, checksum)
+                verifier.update(chunk)
+                with self.assertRaises(CorruptAssetError):
+                    verifier.check()
+
+    def test_check_geotiff(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "cog.tif")
+            create_cog(path, (600, 600), from_origin(300000, 4300000, 30, 30))
+            check_geotiff(path)
+
+            with open(path, "rb") as f:
+                data = f.read()
+
+            for name, corrupt in [
+                ("truncated", data[: len(data) - 1000]),
+                ("header", b"XX" + data[2:]),
+                ("ifd", data[:4] + (len(data) + 8).to_bytes(4, "little") + data[8:]),
+            ]:
+                with self.subTest(name=name):
+                    with open(path, "wb") as f:
+                        f.write(corrupt)
+                    with self.assertRaises(CorruptAssetError):
+                        check_geotiff(path)
+
+
+class TestStageInVerify(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp_dir, "source")
+        self.output_dir = os.path.join(self.tmp_dir, "output")
+        os.makedirs(self.source_dir)
+
+        CorruptingRequestHandler.corrupt = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _stage(self, base_url, **kwargs):
+        item = create_item(
+            self.source_dir, base_url=base_url, shape=(600, 600), checksums=True
+        )
+        cat = asyncio.run(
+            main(item.get_self_href(), self.output_dir, asset_keys=["red"], **kwargs)
+        )
+
+        return item, next(cat.get_items())
+
+    def _assert_staged(self, staged):
+        with open(staged.assets["red"].get_absolute_href(), "rb") as f:
+            staged_data = f.read()
+        with open(os.path.join(self.source_dir, "red.tif"), "rb") as f:
+            self.assertEqual(staged_data, f.read())
+
+    def test_corrupt_asset_retried(self):
+        for segments in [1, 4]:
+            with self.subTest(segments=segments):
+                CorruptingRequestHandler.corrupt = {"/red.tif": 1}
+
+                with serve(self.source_dir, CorruptingRequestHandler) as (
+                    base_url,
+                    server,
+                ):
+                    _, staged = self._stage(
+                        base_url, segments=segments, segment_threshold=2**16
+                    )
+
+                self._assert_staged(staged)
+
+                gets = [path for path, _ in server.requests if path == "/red.tif"]
+                self.assertEqual(len(gets), 2 * segments)
+
+                shutil.rmtree(self.output_dir)
+
+    def test_corrupt_asset_not_staged(self):
+        CorruptingRequestHandler.corrupt = {"/red.tif": 100}
+
+        with serve(self.source_dir, CorruptingRequestHandler) as (base_url, _):
+            item, staged = self._stage(base_url)
+
+        self.assertNotIn("red", staged.assets)
+        self.assertEqual(
+            [
+                name
+                for name in os.listdir(os.path.join(self.output_dir, item.id))
+                if name.startswith("red")
+            ],
+            [],
+        )
+
+    def test_verify_geotiff(self):
+        with serve(self.source_dir) as (base_url, _):
+            item = create_item(self.source_dir, base_url=base_url, shape=(600, 600))
+
+            # a file truncated at the source still matches its Content-Length
+            path = os.path.join(self.source_dir, "red.tif")
+            os.truncate(path, os.path.getsize(path) - 1000)
+
+            cat = asyncio.run(
+                main(
+                    item.get_self_href(),
+                    self.output_dir,
+                    asset_keys=["red", "green"],
+                    verify_geotiff=True,
+                )
+            )
+
+        staged = next(cat.get_items())
+
+        self.assertEqual(list(staged.assets), ["green"])